@@ -0,0 +1,405 @@
+import json
+import sqlite3
+import sys
+import numpy as np
+import pandas as pd
+import performances
+from connections import reader, writer
+from migrations import create_accumulator_states
+from snapshot import get_data_versions
+
+# Accumulateurs en flux des métriques de performance.
+# L'état de chaque série (valeur, plus haut, drawdown maximal, nombre d'observations, moyenne et
+# somme des carrés des écarts) tient en quelques tableaux de taille fixe : une nouvelle date coûte
+# O(séries) et la mémoire reste constante quelle que soit la longueur de l'historique. Les données
+# peuvent être fournies jour par jour (update) ou par blocs (update_chunk), par exemple depuis un
+# curseur SQLite (feed_cursor). Les conventions sont celles de performances.compute_all_metrics :
+# un jour sans retour laisse la valeur inchangée et n'entre pas dans la moyenne ni la variance.
+# Les métriques des portefeuilles (retours pondérés par les positions) sont tenues à jour par
+# refresh_wallet_metrics, qui reprend l'état enregistré dans la table AccumulatorStates et n'intègre
+# que les nouvelles dates tant que la base n'a reçu que des ajouts postérieurs à cet état.
+
+# Rendement cumulé, plus haut courant et drawdown, un jour ou un bloc de jours à la fois
+class DrawdownAccumulator:
+    def __init__(self, n_series=1):
+        self.value = np.ones(n_series)
+        self.peak = np.ones(n_series)
+        self.max_drawdown = np.zeros(n_series)
+        self.count = np.zeros(n_series, dtype=int)
+
+    def update(self, row):
+        row = np.asarray(row, dtype=float)
+        available = ~np.isnan(row)
+        self.value = np.where(available, self.value * (1 + np.where(available, row, 0)), self.value)
+        self.peak = np.maximum(self.peak, self.value)
+        self.max_drawdown = np.maximum(self.max_drawdown, self.drawdown())
+        self.count += available
+
+    def update_chunk(self, block):
+        # Bloc (dates x séries) : mêmes résultats que des update successifs, en une passe vectorisée
+        block = np.asarray(block, dtype=float)
+        if not len(block):
+            return
+        available = ~np.isnan(block)
+        values = self.value * np.cumprod(1 + np.where(available, block, 0), axis=0)
+        peaks = np.maximum(self.peak, np.maximum.accumulate(values, axis=0))
+        drawdowns = np.where(available, (peaks - values) / peaks, 0)
+        self.value = values[-1]
+        self.peak = peaks[-1]
+        self.max_drawdown = np.maximum(self.max_drawdown, drawdowns.max(axis=0))
+        self.count += available.sum(axis=0)
+
+    def cumulative_return(self):
+        return np.where(self.count > 0, self.value - 1, np.nan)
+
+    def drawdown(self):
+        return (self.peak - self.value) / self.peak
+
+    def maximum_drawdown(self):
+        return np.where(self.count > 0, self.max_drawdown, np.nan)
+
+# Moyenne et variance en ligne (algorithme de Welford, blocs fusionnés par la formule de Chan)
+class MomentsAccumulator:
+    def __init__(self, n_series=1):
+        self.count = np.zeros(n_series, dtype=int)
+        self.mean = np.zeros(n_series)
+        self.m2 = np.zeros(n_series)
+
+    def update(self, row):
+        row = np.asarray(row, dtype=float)
+        available = ~np.isnan(row)
+        self.count += available
+        delta = np.where(available, row - self.mean, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = self.mean + np.where(available, delta / self.count, 0)
+        self.m2 = self.m2 + np.where(available, delta * (row - self.mean), 0)
+
+    def update_chunk(self, block):
+        block = np.asarray(block, dtype=float)
+        if not len(block):
+            return
+        available = ~np.isnan(block)
+        block_count = available.sum(axis=0)
+        total = self.count + block_count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            block_mean = np.where(block_count > 0, np.where(available, block, 0).sum(axis=0) / block_count, 0)
+            block_m2 = (np.where(available, block - block_mean, 0) ** 2).sum(axis=0)
+            delta = block_mean - self.mean
+            self.mean = np.where(total > 0, self.mean + delta * block_count / total, 0)
+            self.m2 = self.m2 + block_m2 + np.where(total > 0, delta ** 2 * self.count * block_count / total, 0)
+        self.count = total
+
+    def variance(self, ddof=1):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > ddof, self.m2 / (self.count - ddof), np.nan)
+
+    def std(self, ddof=1):
+        return np.sqrt(self.variance(ddof))
+
+# Covariance avec le benchmark et variance du benchmark aux dates communes (co-moments fusionnés par bloc)
+class BetaAccumulator:
+    def __init__(self, n_series=1):
+        self.count = np.zeros(n_series, dtype=int)
+        self.mean_port = np.zeros(n_series)
+        self.mean_bench = np.zeros(n_series)
+        self.comoment = np.zeros(n_series)
+        self.m2_bench = np.zeros(n_series)
+
+    def update_chunk(self, block, benchmark):
+        # Bloc (dates x séries) et retours du benchmark aux mêmes dates (NaN si inconnus)
+        block = np.asarray(block, dtype=float)
+        if not len(block):
+            return
+        benchmark = np.broadcast_to(np.asarray(benchmark, dtype=float)[:, None], block.shape)
+        common = ~np.isnan(block) & ~np.isnan(benchmark)
+        block_count = common.sum(axis=0)
+        total = self.count + block_count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            block_port = np.where(block_count > 0, np.where(common, block, 0).sum(axis=0) / block_count, 0)
+            block_bench = np.where(block_count > 0, np.where(common, benchmark, 0).sum(axis=0) / block_count, 0)
+            port_dev = np.where(common, block - block_port, 0)
+            bench_dev = np.where(common, benchmark - block_bench, 0)
+            delta_port = block_port - self.mean_port
+            delta_bench = block_bench - self.mean_bench
+            weight = np.where(total > 0, self.count * block_count / total, 0)
+            self.comoment = self.comoment + (port_dev * bench_dev).sum(axis=0) + delta_port * delta_bench * weight
+            self.m2_bench = self.m2_bench + (bench_dev ** 2).sum(axis=0) + delta_bench ** 2 * weight
+            self.mean_port = np.where(total > 0, self.mean_port + delta_port * block_count / total, 0)
+            self.mean_bench = np.where(total > 0, self.mean_bench + delta_bench * block_count / total, 0)
+        self.count = total
+
+    def beta(self):
+        # Conventions de performances.compute_beta : covariance (ddof=1) sur variance du benchmark (ddof=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cov = self.comoment / (self.count - 1)
+            var = self.m2_bench / self.count
+            return np.where((self.count > 0) & (var != 0), cov / var, np.nan)
+
+# Métriques de performance en flux d'un ensemble de portefeuilles (ou de produits)
+class PerformanceAccumulator:
+    def __init__(self, columns):
+        self.columns = pd.Index(columns)
+        self.drawdowns = DrawdownAccumulator(len(self.columns))
+        self.moments = MomentsAccumulator(len(self.columns))
+        self.betas = BetaAccumulator(len(self.columns))
+        # Dernière date intégrée : les dates déjà vues sont ignorées, un rafraîchissement peut être rejoué
+        self.last_date = None
+        # État de la base intégré (voir refresh_wallet_metrics), None s'il n'est pas connu
+        self.versions = None
+
+    def update(self, date, row, benchmark_return=np.nan):
+        """Intégrer les retours d'une date (Series indexée comme les colonnes, ou tableau dans leur ordre)."""
+        date = pd.Timestamp(date)
+        if self.last_date is not None and date <= self.last_date:
+            return
+        if isinstance(row, pd.Series):
+            row = row.reindex(self.columns)
+        self.drawdowns.update(row)
+        self.moments.update(row)
+        self.betas.update_chunk(np.asarray(row, dtype=float)[None, :], [benchmark_return])
+        self.last_date = date
+
+    def update_chunk(self, returns, benchmark_df=None):
+        """
+        Intégrer un bloc de retours (DataFrame dates x colonnes, dates croissantes) et, pour le
+        bêta, les retours du benchmark (DataFrame date, return comme pour compute_all_metrics).
+        """
+        if self.last_date is not None:
+            returns = returns.loc[pd.DatetimeIndex(returns.index) > self.last_date]
+        if returns.empty:
+            return
+        block = returns.reindex(columns=self.columns).to_numpy(dtype=float)
+        self.drawdowns.update_chunk(block)
+        self.moments.update_chunk(block)
+        if benchmark_df is not None and not benchmark_df.empty:
+            benchmark = benchmark_df.set_index('date')['return'].reindex(returns.index).to_numpy(dtype=float)
+        else:
+            benchmark = np.full(len(block), np.nan)
+        self.betas.update_chunk(block, benchmark)
+        self.last_date = pd.Timestamp(returns.index[-1])
+
+    def get_state(self):
+        """État complet de l'accumulateur sous forme sérialisable en JSON (voir from_state)."""
+        return {
+            "columns": self.columns.tolist(),
+            "index_name": self.columns.name,
+            "last_date": None if self.last_date is None else self.last_date.strftime('%Y-%m-%d'),
+            "versions": self.versions,
+            "accumulators": {name: {field: values.tolist() for field, values in vars(accumulator).items()}
+                             for name, accumulator in (("drawdowns", self.drawdowns), ("moments", self.moments),
+                                                       ("betas", self.betas))},
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Reconstruire un accumulateur à partir de get_state."""
+        accumulator = cls(pd.Index(state["columns"], name=state["index_name"]))
+        for name, fields in state["accumulators"].items():
+            target = getattr(accumulator, name)
+            for field, values in fields.items():
+                setattr(target, field, np.asarray(values, dtype=getattr(target, field).dtype))
+        accumulator.last_date = None if state["last_date"] is None else pd.Timestamp(state["last_date"])
+        accumulator.versions = state["versions"]
+        return accumulator
+
+    def metrics(self):
+        """
+        Métriques courantes (sharpe_ratio, volatility, cumulative_return, max_drawdown, beta), indexées
+        comme les colonnes, égales à celles de performances.compute_all_metrics sur tout l'historique reçu.
+        """
+        daily_rf = performances.RISK_FREE_RATE_ANNUAL / performances.TRADING_DAYS
+        std_dev = self.moments.std()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sharpe = np.where(std_dev == 0, np.nan,
+                              (self.moments.mean - daily_rf) / std_dev * np.sqrt(performances.TRADING_DAYS))
+        metrics = pd.DataFrame({
+            'sharpe_ratio': sharpe,
+            'volatility': std_dev * np.sqrt(performances.TRADING_DAYS),
+            'cumulative_return': self.drawdowns.cumulative_return(),
+            'max_drawdown': self.drawdowns.maximum_drawdown(),
+            'beta': self.betas.beta(),
+        }, index=self.columns)
+        metrics.index.name = self.columns.name
+        return metrics
+
+# Fonction pour alimenter un accumulateur depuis un curseur (date, colonne, retour) trié par date
+def feed_cursor(accumulator, cursor, chunk_size=50000):
+    """
+    Lire le curseur par blocs de chunk_size lignes (fetchmany) et intégrer chaque bloc pivoté
+    (dates x colonnes). La dernière date d'un bloc peut se poursuivre dans le suivant : ses lignes
+    sont gardées et intégrées avec le bloc suivant. La mémoire utilisée ne dépend que de chunk_size.
+    """
+    pending = []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        rows = pending + rows
+        last_date = rows[-1][0]
+        complete = [row for row in rows if row[0] != last_date]
+        pending = [row for row in rows if row[0] == last_date]
+        _feed_rows(accumulator, complete)
+    _feed_rows(accumulator, pending)
+    return accumulator
+
+def _feed_rows(accumulator, rows):
+    if not rows:
+        return
+    chunk = pd.DataFrame(rows, columns=['date', 'column', 'return'])
+    chunk = chunk.pivot_table(index='date', columns='column', values='return', aggfunc='last')
+    chunk.index = pd.to_datetime(chunk.index)
+    accumulator.update_chunk(chunk.sort_index())
+
+# Fonction pour calculer en flux les métriques de chaque produit depuis la table Returns
+def stream_product_metrics(conn, start_date=performances.START_DATE, end_date=performances.END_DATE,
+                           accumulator=None, chunk_size=50000):
+    """
+    Calculer les métriques de tous les produits sans charger la table Returns en mémoire.
+    Un accumulateur déjà alimenté peut être passé : seules les dates postérieures à sa dernière
+    date sont alors lues, ce qui rend le rafraîchissement quotidien proportionnel aux nouvelles lignes.
+    """
+    try:
+        if accumulator is None:
+            product_ids = [row[0] for row in conn.execute("SELECT product_id FROM Products ORDER BY product_id")]
+            accumulator = PerformanceAccumulator(pd.Index(product_ids, name='product_id'))
+        if accumulator.last_date is not None:
+            start_date = max(pd.Timestamp(start_date), accumulator.last_date + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+        cursor = conn.execute("""
+        SELECT date, product_id, return_value
+        FROM Returns
+        WHERE date BETWEEN ? AND ?
+        ORDER BY date;
+        """, (start_date, end_date))
+        return feed_cursor(accumulator, cursor, chunk_size)
+    except sqlite3.Error as e:
+        print(f"Erreur SQLite : {e}")
+        return accumulator
+
+# Fonction pour lire les identifiants des portefeuilles (colonnes des accumulateurs de portefeuilles)
+def _wallet_ids(conn):
+    return [row[0] for row in conn.execute("SELECT wallet_id FROM Portfolios ORDER BY wallet_id")]
+
+# Fonction pour calculer en flux les métriques de chaque portefeuille (retours pondérés par les positions)
+def stream_wallet_metrics(conn, accumulator=None, start_date=performances.START_DATE,
+                          end_date=performances.END_DATE, benchmark_df=None):
+    """
+    Intégrer dans l'accumulateur (une colonne par wallet_id) les retours journaliers des portefeuilles
+    pondérés par leurs positions (performances.get_position_weighted_returns), pour les seules dates
+    postérieures à sa dernière date. Les positions et l'indice de prix sont reconstruits sur tout
+    l'historique, mais seuls les retours des nouvelles dates sont intégrés.
+    """
+    try:
+        if accumulator is None:
+            accumulator = PerformanceAccumulator(pd.Index(_wallet_ids(conn), name='wallet_id'))
+        return _feed_wallets(conn, accumulator, start_date, end_date, benchmark_df)
+    except sqlite3.Error as e:
+        print(f"Erreur SQLite : {e}")
+        return accumulator
+
+def _feed_wallets(conn, accumulator, start_date, end_date, benchmark_df):
+    if accumulator.last_date is not None:
+        start_date = max(pd.Timestamp(start_date), accumulator.last_date + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+    if pd.Timestamp(start_date) <= pd.Timestamp(end_date):
+        accumulator.update_chunk(performances.get_position_weighted_returns(conn, start_date, end_date), benchmark_df)
+    return accumulator
+
+# Fonction pour lire l'état des données dont dépendent les métriques des portefeuilles (None si la base n'est pas migrée)
+def _wallet_versions(conn, start_date, end_date, benchmark_df):
+    versions = get_data_versions(conn)
+    row = conn.execute("SELECT changes FROM DataVersions WHERE table_name = 'Portfolios'").fetchone() if versions else None
+    if row is None:
+        return None
+    benchmark_end = None
+    if benchmark_df is not None and not benchmark_df.empty:
+        benchmark_end = pd.Timestamp(benchmark_df['date'].max()).strftime('%Y-%m-%d')
+    return dict(versions, Portfolios=row[0], start_date=start_date, end_date=end_date, benchmark_end=benchmark_end)
+
+# Fonction pour vérifier qu'un accumulateur peut être complété au lieu d'être recalculé
+def _can_resume(conn, accumulator, versions):
+    """
+    L'état est réutilisable si Deals et Returns n'ont reçu que des insertions qui ne touchent pas les
+    dates déjà intégrées, si les portefeuilles sont les mêmes et si le benchmark couvrait déjà ces dates.
+    """
+    previous = accumulator.versions
+    if previous is None or versions is None or accumulator.last_date is None:
+        return False
+    if any(previous[key] != versions[key] for key in ("Portfolios", "start_date", "end_date")):
+        return False
+    if accumulator.columns.tolist() != _wallet_ids(conn):
+        return False
+    last_date = accumulator.last_date.strftime('%Y-%m-%d')
+    if previous["benchmark_end"] != versions["benchmark_end"] and (previous["benchmark_end"] or "") < last_date:
+        return False
+    for table, id_column in (("Deals", "deal_id"), ("Returns", "id_return")):
+        max_id, changes = previous[table]
+        if changes != versions[table][1]:
+            return False
+        first_date = conn.execute(f"SELECT MIN(date) FROM {table} WHERE {id_column} > ?", (max_id,)).fetchone()[0]
+        # Un deal daté du jour J ne pondère que les retours suivants ; un rendement compte dès sa date
+        if first_date is not None and (first_date < last_date if table == "Deals" else first_date <= last_date):
+            return False
+    return True
+
+# Fonction pour lire l'accumulateur enregistré sous un nom (None s'il n'existe pas)
+def load_accumulator(conn, name):
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'AccumulatorStates'").fetchone():
+            return None
+        row = conn.execute("SELECT state FROM AccumulatorStates WHERE name = ?", (name,)).fetchone()
+        return PerformanceAccumulator.from_state(json.loads(row[0])) if row else None
+    except (sqlite3.Error, ValueError, KeyError) as e:
+        print(f"État de l'accumulateur {name} illisible : {e}")
+        return None
+
+# Fonction pour enregistrer un accumulateur sous un nom (écrivain unique de la base)
+def save_accumulator(database, name, accumulator):
+    with writer(database) as conn:
+        create_accumulator_states(conn)
+        conn.execute("INSERT OR REPLACE INTO AccumulatorStates (name, state) VALUES (?, ?)",
+                     (name, json.dumps(accumulator.get_state())))
+
+# Fonction pour tenir à jour les métriques de tous les portefeuilles
+def refresh_wallet_metrics(database, conn=None, benchmark_df=None, accumulator=None, update=True,
+                           name="wallet_metrics", start_date=performances.START_DATE, end_date=performances.END_DATE):
+    """
+    Retourner l'accumulateur des métriques des portefeuilles à jour (metrics() donne la même table que
+    performances.compute_all_metrics sur les retours pondérés par les positions).
+
+    L'accumulateur fourni, ou à défaut celui enregistré sous `name`, est complété avec les seules
+    nouvelles dates s'il est encore valable (voir _can_resume), sinon recalculé sur toute la période.
+    Avec update=True, le nouvel état est enregistré pour les prochains appels ; les lecteurs en lecture
+    seule (service) passent update=False et gardent leur accumulateur en mémoire.
+    La connexion fournie ne doit pas être partagée entre threads (une transaction de lecture y est
+    ouverte). Retourne None en cas d'erreur SQLite.
+    """
+    try:
+        conn = conn or reader(database)
+        # Une seule transaction de lecture : l'état enregistré et les retours intégrés correspondent à la même base
+        own_transaction = not conn.in_transaction
+        if own_transaction:
+            conn.execute("BEGIN")
+        try:
+            versions = _wallet_versions(conn, start_date, end_date, benchmark_df)
+            accumulator = accumulator or load_accumulator(conn, name)
+            if versions is not None and accumulator is not None and accumulator.versions == versions:
+                return accumulator
+            if accumulator is None or not _can_resume(conn, accumulator, versions):
+                accumulator = PerformanceAccumulator(pd.Index(_wallet_ids(conn), name='wallet_id'))
+            _feed_wallets(conn, accumulator, start_date, end_date, benchmark_df)
+            accumulator.versions = versions
+        finally:
+            if own_transaction:
+                conn.commit()
+        if update:
+            save_accumulator(database, name, accumulator)
+        return accumulator
+    except sqlite3.Error as e:
+        print(f"Erreur SQLite : {e}")
+        return None
+
+if __name__ == "__main__":
+    # Mise à jour de l'état enregistré des métriques des portefeuilles (par exemple après les deals du jour)
+    database = sys.argv[1] if len(sys.argv) > 1 else performances.DB_PATH
+    refreshed = refresh_wallet_metrics(database, benchmark_df=performances.get_sp500_returns(reader(database)))
+    if refreshed is not None:
+        print(refreshed.metrics().to_string())
@@ -3,24 +3,208 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import ast
-import performances 
+import io
+import performances
+import risk
+import snapshot
 
 ### Avant de lancer l'app :
 #- S'assurer que performances.py est dans le même répertoire que app.py
 #- Pour lancer l'app : "streamlit run app.py" dans le terminal (dans le répertoire où se trouve app.py)
 
 
+##################################################################################
+# Connexion partagée et mise en cache des résultats
+##################################################################################
+# Streamlit ré-exécute le script à chaque interaction : les résultats des requêtes et les
+# métriques sont mis en cache par (wallet_id, version de la base). La version change dès
+# que de nouveaux deals ou rendements arrivent, ce qui invalide automatiquement le cache.
+
+# Le tableau de bord est en lecture seule : l'instantané colonnaire n'est lu que s'il est à jour,
+# sinon les requêtes passent par SQLite ; rien n'est écrit à côté de la base.
+snapshot.disable_updates()
+
+@st.cache_resource
+def get_shared_connection():
+    # Une seule connexion en lecture seule pour toutes les exécutions du script et toutes les sessions.
+    # La base est en WAL : le tableau de bord reste disponible pendant l'écriture d'un rebalancement.
+    return performances.connect_db(performances.DB_PATH, check_same_thread=False)
+
+@st.cache_data
+def load_portfolio_ids(db_version):
+    return performances.get_portfolio_ids(get_shared_connection())
+
+@st.cache_data(ttl=3600)
+def load_sp500_returns():
+    return performances.get_sp500_returns(get_shared_connection())
+
+@st.cache_data
+def load_all_portfolio_returns(db_version):
+    # Une seule lecture de la table Returns pour tous les portefeuilles
+    return performances.get_all_portfolio_returns(get_shared_connection(), weighting=performances.PORTFOLIO_WEIGHTING)
+
+@st.cache_data
+def load_all_metrics(db_version):
+    portfolio_returns = load_all_portfolio_returns(db_version)
+    if portfolio_returns.empty:
+        return pd.DataFrame()
+    return performances.compute_all_metrics(portfolio_returns, load_sp500_returns())
+
+@st.cache_data
+def load_risk_metrics(db_version):
+    # VaR, CVaR, Sortino, Calmar et ratio d'information de tous les portefeuilles en une passe
+    portfolio_returns = load_all_portfolio_returns(db_version)
+    if portfolio_returns.empty:
+        return pd.DataFrame()
+    return risk.compute_risk_metrics(portfolio_returns, load_sp500_returns())
+
+@st.cache_data
+def load_rolling_risk(db_version, window):
+    # Courbes glissantes de tous les portefeuilles, calculées une fois par taille de fenêtre :
+    # changer de métrique ou de portefeuilles affichés ne relance aucun calcul
+    portfolio_returns = load_all_portfolio_returns(db_version)
+    if portfolio_returns.empty:
+        return {}
+    return risk.compute_rolling_risk(portfolio_returns, load_sp500_returns(), window=window, var_window=window)
+
+@st.cache_data
+def load_portfolio_performance(wallet_id, db_version):
+    """Retourne les retours cumulés et les métriques de performance d'un portefeuille."""
+    df_returns = performances.extract_portfolio_returns(load_all_portfolio_returns(db_version), wallet_id)
+    if df_returns.empty:
+        return df_returns, {}
+    df_cum = performances.compute_cumulative_returns(df_returns)
+    wallet_metrics = load_all_metrics(db_version).loc[wallet_id]
+    metrics = {
+        'sharpe_ratio': wallet_metrics['sharpe_ratio'],
+        'beta': wallet_metrics['beta'],
+        'final_cum_return': wallet_metrics['cumulative_return'],
+        'volatility': wallet_metrics['volatility'],
+        'max_drawdown': wallet_metrics['max_drawdown'],
+    }
+    return df_cum, metrics
+
+@st.cache_data
+def load_best_manager(db_version):
+    """Retourne le meilleur manager et son meilleur portefeuille (ou None)."""
+    mapping_df = performances.get_portfolio_manager_mapping(get_shared_connection())
+    if mapping_df.empty:
+        return None
+    metrics = load_all_metrics(db_version)
+    if metrics.empty:
+        return None
+    final_cum_returns_all = {wallet_name: metrics['cumulative_return'].get(port_id, np.nan)
+                             for wallet_name, port_id in load_portfolio_ids(db_version).items()}
+    mapping_df['final_return'] = mapping_df['wallet_name'].map(final_cum_returns_all)
+    manager_perf = mapping_df.groupby('manager_name')['final_return'].mean()
+    best_manager = manager_perf.idxmax()
+    # Sélectionne le portefeuille géré par ce manager ayant le meilleur rendement
+    best_portfolio_df = mapping_df[mapping_df['manager_name'] == best_manager]
+    best_portfolio = best_portfolio_df.sort_values(by='final_return', ascending=False)['wallet_name'].iloc[0]
+    return best_manager, best_portfolio
+
+@st.cache_data
+def load_portfolio_content(wallet_name, db_version):
+    conn = get_shared_connection()
+    query = "SELECT products FROM Portfolios WHERE wallet_name = ?"
+    df_portfolio = pd.read_sql_query(query, conn, params=(wallet_name,))
+    if df_portfolio.empty:
+        return None
+    products_str = df_portfolio.iloc[0]['products']
+    try:
+        product_ids = ast.literal_eval(products_str)
+    except Exception as e:
+        st.write(f"Erreur de conversion pour {wallet_name}: {e}")
+        product_ids = []
+    # Récupération de la correspondance entre product_id et nom depuis la table Products
+    prod_query = "SELECT product_id, name FROM Products"
+    prod_df = pd.read_sql_query(prod_query, conn)
+    product_dict = dict(zip(prod_df['product_id'], prod_df['name']))
+    product_names = [product_dict.get(pid, f"ID {pid}") for pid in product_ids]
+    return pd.DataFrame({'Actifs': product_names})
+
+@st.cache_data
+def load_recent_deals(wallet_id, db_version, limit=50):
+    return performances.get_recent_deals(get_shared_connection(), wallet_id, limit=limit)
+
+def figure_to_png(fig):
+    # Le rendu matplotlib est l'étape la plus coûteuse : l'image est mise en cache plutôt que la figure
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    plt.close(fig)
+    return buffer.getvalue()
+
+@st.cache_data
+def render_portfolio_chart(wallet_id, wallet_name, db_version):
+    """Graphique de performance cumulée d'un portefeuille avec comparaison SP500 (image PNG)."""
+    df_cum, _ = load_portfolio_performance(wallet_id, db_version)
+    sp500_df = load_sp500_returns()
+    plt.style.use('ggplot')
+    fig, ax = plt.subplots(figsize=(12, 8))
+    ax.plot(df_cum['date'], df_cum['cum_return'], linewidth=2, label=wallet_name)
+
+    # Calcul et tracé de la performance cumulée du SP500
+    if not sp500_df.empty:
+        sp500_cum = performances.compute_cumulative_returns(sp500_df)
+        ax.plot(sp500_cum['date'], sp500_cum['cum_return'], linewidth=2, linestyle='--', label='SP500')
+
+    ax.set_xlabel("Date", fontsize=12, fontweight='bold')
+    ax.set_ylabel("Retour Cumulé", fontsize=12, fontweight='bold')
+    ax.set_title("Performance Cumulée", fontsize=14, fontweight='bold')
+    ax.legend(title="Portefeuille", fontsize=10)
+    ax.grid(True, linestyle='--', alpha=0.6)
+    fig.autofmt_xdate()
+    plt.tight_layout()
+    return figure_to_png(fig)
+
+@st.cache_data
+def render_comparison_chart(db_version):
+    """Graphique comparatif de tous les portefeuilles avec le SP500 (image PNG, ou None sans données)."""
+    cumulative_data_all = {}
+    for wallet_name, port_id in load_portfolio_ids(db_version).items():
+        df_cum_all, _ = load_portfolio_performance(port_id, db_version)
+        if not df_cum_all.empty:
+            cumulative_data_all[wallet_name] = df_cum_all
+    if not cumulative_data_all:
+        return None
+
+    sp500_df = load_sp500_returns()
+    plt.style.use('ggplot')
+    fig_all, ax_all = plt.subplots(figsize=(12, 8))
+    for wallet_name, df in cumulative_data_all.items():
+        ax_all.plot(df['date'], df['cum_return'], linewidth=2, label=wallet_name)
+    # Ajout de la courbe du SP500
+    if not sp500_df.empty:
+        sp500_cum_all = performances.compute_cumulative_returns(sp500_df)
+        ax_all.plot(sp500_cum_all['date'], sp500_cum_all['cum_return'], linewidth=2, linestyle='--', label='SP500')
+    ax_all.set_xlabel("Date", fontsize=12, fontweight='bold')
+    ax_all.set_ylabel("Retour Cumulé", fontsize=12, fontweight='bold')
+    ax_all.set_title("Comparaison des performances cumulées", fontsize=14, fontweight='bold')
+    ax_all.legend(title="Portefeuilles", fontsize=10)
+    ax_all.grid(True, linestyle='--', alpha=0.6)
+    fig_all.autofmt_xdate()
+    plt.tight_layout()
+    return figure_to_png(fig_all)
+
+
 st.title("Dashboard de performance du fonds")
 st.write("Veuillez sélectionner un portefeuille dans le menu de gauche afin d’afficher les détails de sa performance.")
 
-# Connexion à la base de données via performances.py
-conn = performances.connect_db(performances.DB_PATH)
+# Connexion à la base de données via performances.py (partagée entre les exécutions)
+conn = get_shared_connection()
 if conn is None:
     st.error("Erreur de connexion à la base de données.")
     st.stop()
 
+# Invalidation explicite du cache (par exemple après un rechargement manuel des données)
+if st.sidebar.button("Rafraîchir les données"):
+    st.cache_data.clear()
+
+# Version courante des données : clé d'invalidation de tous les résultats en cache
+db_version = performances.get_db_version(conn)
+
 # Récupération des portefeuilles : dictionnaire {wallet_name: wallet_id}
-portfolio_dict = performances.get_portfolio_ids(conn)
+portfolio_dict = load_portfolio_ids(db_version)
 if not portfolio_dict:
     st.error("Aucun portefeuille trouvé dans la base de données.")
     st.stop()
@@ -33,97 +217,56 @@ selected_portfolio = st.sidebar.selectbox("Sélectionnez votre portefeuille", li
 wallet_id = portfolio_dict[selected_portfolio]
 
 # Calcul du meilleur manager et de son portefeuille
-mapping_df = performances.get_portfolio_manager_mapping(conn)
-if not mapping_df.empty:
-    final_cum_returns_all = {}
-    for wallet_name, port_id in portfolio_dict.items():  # Remplacer wallet_id par port_id ici
-         df_ret = performances.get_portfolio_returns(conn, port_id)
-         if not df_ret.empty:
-             df_cum = performances.compute_cumulative_returns(df_ret)
-             final_cum_returns_all[wallet_name] = df_cum['cum_return'].iloc[-1]
-    mapping_df['final_return'] = mapping_df['wallet_name'].map(final_cum_returns_all)
-    manager_perf = mapping_df.groupby('manager_name')['final_return'].mean()
-    best_manager = manager_perf.idxmax()
-    # Sélectionne le portefeuille géré par ce manager ayant le meilleur rendement
-    best_portfolio_df = mapping_df[mapping_df['manager_name'] == best_manager]
-    best_portfolio = best_portfolio_df.sort_values(by='final_return', ascending=False)['wallet_name'].iloc[0]
+best_manager_result = load_best_manager(db_version)
+if best_manager_result is not None:
+    best_manager, best_portfolio = best_manager_result
     st.sidebar.subheader("Meilleur Manager")
     st.sidebar.write(f"**{best_manager}** avec le portefeuille **{best_portfolio}**")
 
 
 ###############################################
-# Détails du Portefeuille 
+# Détails du Portefeuille
 ###############################################
 st.header(f"Informations pour le portefeuille {selected_portfolio}")
 
-# Récupération des retours journaliers du portefeuille sélectionné
-df_returns = performances.get_portfolio_returns(conn, wallet_id)
-if df_returns.empty:
+# Récupération des retours journaliers et des métriques du portefeuille sélectionné
+df_cum, metrics = load_portfolio_performance(wallet_id, db_version)
+if df_cum.empty:
     st.write("Aucune donnée de retour pour ce portefeuille.")
 else:
-    # Calcul des métriques de performance
-    sharpe_ratio = performances.compute_sharpe_ratio(df_returns['return'])
-    sp500_df = performances.get_sp500_returns()
-    beta = performances.compute_beta(df_returns, sp500_df) if not sp500_df.empty else np.nan
-    df_cum = performances.compute_cumulative_returns(df_returns)
-    final_cum_return = df_cum['cum_return'].iloc[-1]
-    
-    # Calcul de la volatilité annualisée et du max drawdown
-    volatility = performances.compute_volatility(df_returns['return'])
-    max_drawdown = performances.compute_max_drawdown(df_cum)
-    
     st.subheader("Métriques de performance du portefeuille")
     st.write("Les métriques de performance sont calculées sur la période du 01/01/2023 au 31/12/2024")
-    st.write(f"**➡️ Ratio de Sharpe** : {sharpe_ratio:.3f}")
-    st.write(f"**➡️ Bêta** : {beta:.3f}")
-    st.write(f"**➡️ Rendement cumulé** : {final_cum_return*100:.2f}%")
-    st.write(f"**➡️ Volatilité annualisée** : {volatility:.3f}")
-    st.write(f"**➡️ Max Drawdown** : {max_drawdown*100:.2f}%")
-    
+    st.write(f"**➡️ Ratio de Sharpe** : {metrics['sharpe_ratio']:.3f}")
+    st.write(f"**➡️ Bêta** : {metrics['beta']:.3f}")
+    st.write(f"**➡️ Rendement cumulé** : {metrics['final_cum_return']*100:.2f}%")
+    st.write(f"**➡️ Volatilité annualisée** : {metrics['volatility']:.3f}")
+    st.write(f"**➡️ Max Drawdown** : {metrics['max_drawdown']*100:.2f}%")
+
+    # Métriques de risque extrême et ratios ajustés du risque
+    risk_metrics = load_risk_metrics(db_version)
+    if wallet_id in risk_metrics.index:
+        wallet_risk = risk_metrics.loc[wallet_id]
+        st.write(f"**➡️ VaR 95% historique / paramétrique** : {wallet_risk['var_historical']*100:.2f}% / {wallet_risk['var_parametric']*100:.2f}%")
+        st.write(f"**➡️ CVaR 95% historique / paramétrique** : {wallet_risk['cvar_historical']*100:.2f}% / {wallet_risk['cvar_parametric']*100:.2f}%")
+        st.write(f"**➡️ Ratio de Sortino** : {wallet_risk['sortino_ratio']:.3f}")
+        st.write(f"**➡️ Ratio de Calmar** : {wallet_risk['calmar_ratio']:.3f}")
+        st.write(f"**➡️ Ratio d'information** : {wallet_risk['information_ratio']:.3f}")
+
     # Graphique de performance cumulée pour le portefeuille sélectionné avec comparaison SP500
     st.subheader("Graphique de la performance cumulée du portefeuille")
-    plt.style.use('ggplot')
-    fig, ax = plt.subplots(figsize=(12, 8))
-    ax.plot(df_cum['date'], df_cum['cum_return'], linewidth=2, label=selected_portfolio)
-    
-    # Calcul et tracé de la performance cumulée du SP500
-    if not sp500_df.empty:
-        sp500_cum = performances.compute_cumulative_returns(sp500_df)
-        ax.plot(sp500_cum['date'], sp500_cum['cum_return'], linewidth=2, linestyle='--', label='SP500')
-    
-    ax.set_xlabel("Date", fontsize=12, fontweight='bold')
-    ax.set_ylabel("Retour Cumulé", fontsize=12, fontweight='bold')
-    ax.set_title("Performance Cumulée", fontsize=14, fontweight='bold')
-    ax.legend(title="Portefeuille", fontsize=10)
-    ax.grid(True, linestyle='--', alpha=0.6)
-    fig.autofmt_xdate()
-    plt.tight_layout()
-    st.pyplot(fig)
+    st.image(render_portfolio_chart(wallet_id, selected_portfolio, db_version))
 
 # Affichage du contenu du portefeuille sous forme de tableau
 st.subheader("Contenu du portefeuille")
-query = "SELECT products FROM Portfolios WHERE wallet_name = ?"
-df_portfolio = pd.read_sql_query(query, conn, params=(selected_portfolio,))
-if df_portfolio.empty:
+df_content = load_portfolio_content(selected_portfolio, db_version)
+if df_content is None:
     st.write("Aucun portefeuille trouvé pour ce nom.")
 else:
-    products_str = df_portfolio.iloc[0]['products']
-    try:
-        product_ids = ast.literal_eval(products_str)
-    except Exception as e:
-        st.write(f"Erreur de conversion pour {selected_portfolio}: {e}")
-        product_ids = []
-    # Récupération de la correspondance entre product_id et nom depuis la table Products
-    prod_query = "SELECT product_id, name FROM Products"
-    prod_df = pd.read_sql_query(prod_query, conn)
-    product_dict = dict(zip(prod_df['product_id'], prod_df['name']))
-    product_names = [product_dict.get(pid, f"ID {pid}") for pid in product_ids]
-    df_content = pd.DataFrame({'Actifs': product_names})
     st.dataframe(df_content)
 
 # Affichage des 50 dernières transactions du portefeuille sélectionné
 st.subheader("Les 50 dernières transactions du portefeuille")
-df_deals = performances.get_recent_deals(conn, wallet_id, limit=50)
+df_deals = load_recent_deals(wallet_id, db_version, limit=50)
 if df_deals.empty:
     st.write("Aucun deal trouvé pour ce portefeuille.")
 else:
@@ -133,31 +276,34 @@ else:
 # Graphique comparatif de tous les portefeuilles avec la performance du SP500
 ##################################################################################
 st.header("Comparaison des performances de tous les portefeuilles")
-cumulative_data_all = {}
-for wallet_name, wallet_id in portfolio_dict.items():
-    df_ret = performances.get_portfolio_returns(conn, wallet_id)
-    if not df_ret.empty:
-        df_cum_all = performances.compute_cumulative_returns(df_ret)
-        cumulative_data_all[wallet_name] = df_cum_all
-
-if cumulative_data_all:
-    plt.style.use('ggplot')
-    fig_all, ax_all = plt.subplots(figsize=(12, 8))
-    for wallet_name, df in cumulative_data_all.items():
-        ax_all.plot(df['date'], df['cum_return'], linewidth=2, label=wallet_name)
-    # Ajout de la courbe du SP500
-    if not sp500_df.empty:
-        sp500_cum_all = performances.compute_cumulative_returns(sp500_df)
-        ax_all.plot(sp500_cum_all['date'], sp500_cum_all['cum_return'], linewidth=2, linestyle='--', label='SP500')
-    ax_all.set_xlabel("Date", fontsize=12, fontweight='bold')
-    ax_all.set_ylabel("Retour Cumulé", fontsize=12, fontweight='bold')
-    ax_all.set_title("Comparaison des performances cumulées", fontsize=14, fontweight='bold')
-    ax_all.legend(title="Portefeuilles", fontsize=10)
-    ax_all.grid(True, linestyle='--', alpha=0.6)
-    fig_all.autofmt_xdate()
-    plt.tight_layout()
-    st.pyplot(fig_all)
+comparison_chart = render_comparison_chart(db_version)
+if comparison_chart is not None:
+    st.image(comparison_chart)
 else:
     st.write("Aucune donnée de performance disponible pour la comparaison.")
 
-conn.close()
+##################################################################################
+# Courbes de risque glissantes (tous les portefeuilles calculés en une passe)
+##################################################################################
+st.header("Risque glissant des portefeuilles")
+rolling_labels = {
+    'sharpe_ratio': "Ratio de Sharpe",
+    'volatility': "Volatilité annualisée",
+    'var_historical': "VaR 95% historique",
+    'beta': "Bêta",
+}
+rolling_window = st.select_slider("Taille de la fenêtre (jours de bourse)", options=[21, 63, 126, 252], value=63)
+rolling_risk = load_rolling_risk(db_version, rolling_window)
+if not rolling_risk:
+    st.write("Aucune donnée de retour disponible pour le risque glissant.")
+else:
+    rolling_metric = st.selectbox("Métrique", list(rolling_risk), format_func=rolling_labels.get)
+    displayed_portfolios = st.multiselect("Portefeuilles affichés", list(portfolio_dict.keys()), default=[selected_portfolio])
+    curves = rolling_risk[rolling_metric]
+    displayed_ids = [portfolio_dict[name] for name in displayed_portfolios if portfolio_dict[name] in curves.columns]
+    if displayed_ids:
+        # Graphique interactif rendu par le navigateur : adapté à des centaines de courbes
+        wallet_names = {port_id: name for name, port_id in portfolio_dict.items()}
+        st.line_chart(curves[displayed_ids].rename(columns=wallet_names))
+    else:
+        st.write("Aucune courbe à afficher pour les portefeuilles sélectionnés.")
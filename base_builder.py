@@ -4,7 +4,13 @@ from datetime import date
 from faker import Faker
 import json
 import random
+from itertools import islice
 import data_collector as dc
+from holdings import ensure_holdings_tables, record_holdings
+from migrations import ensure_returns_unique_index, migrate
+from connections import connect, timed_phase
+# Profils de risque acceptés pour les clients et les produits : ceux du registre des stratégies
+from strategy import strategy_registry
 
 # Initialiser Faker pour générer des données fictives
 faker = Faker()
@@ -16,11 +22,14 @@ project_database = "project_database.db"
 dict_products = dc.dict_products
 dict_risk_type = dc.dict_risk_type
 
+# Taille des lots de transactions pour le chargement en masse
+bulk_batch_size = 100000
+
 # Fonction pour créer une table dans la base de données SQLite
 def create_table(create_table_query, table, database_name=project_database):
     try:
         # Connexion à la base de données SQLite
-        conn = sqlite3.connect(database_name)
+        conn = connect(database_name)
         cursor = conn.cursor()
 
         # Création de la table
@@ -49,13 +58,13 @@ class Client:
         self.risk_profile = risk_profile
 
     def clients_to_base(self, database=project_database):
-        if self.risk_profile not in ["low_risk", "low_turnover", "high_yield_equity_only"]:
+        if self.risk_profile not in strategy_registry:
             raise ValueError(f"Profil de risque '{self.risk_profile}' non valide!")
 
         client_data = []
         try:
             # Connexion à la base de données SQLite
-            conn = sqlite3.connect(database)
+            conn = connect(database)
             cursor = conn.cursor()
             # Insertion des données dans la table Clients
             insert_query = """
@@ -98,11 +107,11 @@ class Products:
         self.name = name
 
     def products_to_base(self, database=project_database):
-        if self.product_risk_profile not in ["low_risk", "low_turnover", "high_yield_equity_only"]:
+        if self.product_risk_profile not in strategy_registry:
             raise ValueError(f"Profil de risque '{self.product_risk_profile}' non valide!")
         product_data = []
         try:
-            conn = sqlite3.connect(database)
+            conn = connect(database)
             cursor = conn.cursor()
 
             insert_query = """INSERT INTO Products (ticker, product_risk_profile, name) VALUES (?, ?, ?);"""
@@ -137,7 +146,7 @@ class Wallet:
 
         try:
             # Connexion à la base de données SQLite
-            conn = sqlite3.connect(database)
+            conn = connect(database)
             cursor = conn.cursor()
 
             # Insertion des données dans la table Portfolios
@@ -161,7 +170,7 @@ class Wallet:
 def get_tickers_by_risk_profile(database_name=project_database):
     try:
         # Connexion à la base de données SQLite
-        conn = sqlite3.connect(database_name)
+        conn = connect(database_name)
         cursor = conn.cursor()
 
         # Exécution de la requête pour obtenir uniquement les tickers groupés par profil de risque
@@ -209,7 +218,7 @@ class Manager:
 
     def manager_to_base(self, database=project_database):
         try:
-            conn = sqlite3.connect(database)
+            conn = connect(database)
             cursor = conn.cursor()
 
             # Insérer les données du gestionnaire dans la table Managers
@@ -229,7 +238,7 @@ class Manager:
 # Fonction pour obtenir les identifiants des portefeuilles
 def get_wallet_id(database=project_database):
     try:
-        conn = sqlite3.connect(database)
+        conn = connect(database)
         cursor = conn.cursor()
         select_query = """SELECT wallet_id FROM Portfolios"""
         cursor.execute(select_query)
@@ -273,7 +282,8 @@ class Deal:
 
     def deal_to_base(self, database=project_database):
         try:
-            conn = sqlite3.connect(database)
+            conn = connect(database)
+            ensure_holdings_tables(conn)
             cursor = conn.cursor()
 
             # Insérer les données de la transaction dans la table Deals
@@ -281,7 +291,10 @@ class Deal:
             INSERT INTO Deals (date, wallet_id, manager_id, product_id, qty)
             VALUES (?, ?, ?, ?, ?);
             """
-            cursor.execute(insert_query, (self.date, self.wallet_id, self.manager_id, self.product_id, self.qty))
+            deal_data = (self.date, self.wallet_id, self.manager_id, self.product_id, self.qty)
+            cursor.execute(insert_query, deal_data)
+            # Mettre à jour les positions dans la même transaction
+            record_holdings(cursor, [deal_data])
             conn.commit()
             print(f"Transaction du gestionnaire {self.manager_id} et sur son portefeuille {self.wallet_id} ajoutée à la table")
         except sqlite3.Error as e:
@@ -290,6 +303,108 @@ class Deal:
             if conn:
                 conn.close()
 
+# Fonctions d'insertion en masse : executemany sur une connexion partagée, sans commit
+# (l'appelant valide une seule transaction pour l'ensemble du chargement)
+def insert_clients(cursor, clients):
+    def rows():
+        for client in clients:
+            if client.risk_profile not in strategy_registry:
+                raise ValueError(f"Profil de risque '{client.risk_profile}' non valide!")
+            yield (client.name, client.first_name, client.birth_date, client.address, client.phone_number,
+                   client.email, client.entry_date, client.risk_profile)
+    cursor.executemany("""
+    INSERT INTO Clients (name, first_name, birth_date, address, phone_number, email, entry_date, risk_profile)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+    """, rows())
+    return cursor.rowcount
+
+def insert_products(cursor, products):
+    def rows():
+        for product in products:
+            if product.product_risk_profile not in strategy_registry:
+                raise ValueError(f"Profil de risque '{product.product_risk_profile}' non valide!")
+            yield (product.ticker, product.product_risk_profile, product.name)
+    cursor.executemany("INSERT INTO Products (ticker, product_risk_profile, name) VALUES (?, ?, ?);", rows())
+    return cursor.rowcount
+
+def insert_wallets(cursor, wallets):
+    cursor.executemany("INSERT INTO Portfolios (wallet_name, risk_profile, products) VALUES (?, ?, ?);",
+                       ((wallet.wallet_name, wallet.risk_profile, json.dumps(wallet.products)) for wallet in wallets))
+    return cursor.rowcount
+
+def insert_managers(cursor, managers):
+    cursor.executemany("INSERT INTO Managers (manager_name, email, wallets_managed_id) VALUES (?, ?, ?);",
+                       ((manager.manager_name, manager.email, manager.wallets_managed) for manager in managers))
+    return cursor.rowcount
+
+def insert_deals(cursor, deals, batch_size=bulk_batch_size):
+    # Les transactions sont insérées par lots pour borner la mémoire, positions mises à jour à chaque lot
+    deals = iter(deals)
+    inserted = 0
+    while True:
+        batch = [(deal.date, deal.wallet_id, deal.manager_id, deal.product_id, deal.qty)
+                 for deal in islice(deals, batch_size)]
+        if not batch:
+            return inserted
+        cursor.executemany("""
+        INSERT INTO Deals (date, wallet_id, manager_id, product_id, qty)
+        VALUES (?, ?, ?, ?, ?);
+        """, batch)
+        record_holdings(cursor, batch)
+        inserted += len(batch)
+
+# Fonction pour insérer en masse des clients, produits, portefeuilles, gestionnaires et transactions
+@timed_phase("seeding")
+def bulk_to_base(database=project_database, clients=(), products=(), wallets=(), managers=(), deals=(), conn=None):
+    """
+    Insérer des itérables d'objets Client, Products, Wallet, Manager et Deal sur une seule
+    connexion et dans une seule transaction. Une connexion ouverte peut être fournie (elle
+    n'est alors ni validée ni fermée) : les insertions sont faites sous un SAVEPOINT, annulées
+    en cas d'erreur sans toucher au reste de la transaction de l'appelant, et l'erreur est
+    relancée. Retourne le nombre de lignes insérées par table.
+    """
+    own_connection = conn is None
+    savepoint = False
+    try:
+        if own_connection:
+            conn = connect(database)
+        else:
+            # Une transaction est ouverte si besoin : libérer le SAVEPOINT ne valide alors rien
+            if not conn.in_transaction:
+                conn.execute("BEGIN")
+            conn.execute("SAVEPOINT bulk_to_base")
+            savepoint = True
+        ensure_holdings_tables(conn, commit=own_connection)
+        cursor = conn.cursor()
+        inserted = {
+            "Clients": insert_clients(cursor, clients),
+            "Products": insert_products(cursor, products),
+            "Portfolios": insert_wallets(cursor, wallets),
+            "Managers": insert_managers(cursor, managers),
+            "Deals": insert_deals(cursor, deals),
+        }
+        if own_connection:
+            conn.commit()
+        else:
+            conn.execute("RELEASE SAVEPOINT bulk_to_base")
+        print(f"Insertion en masse terminée : {inserted}")
+        return inserted
+
+    except (sqlite3.Error, ValueError) as e:
+        print(f"Erreur lors de l'insertion en masse : {e}")
+        if not own_connection:
+            if savepoint and conn.in_transaction:
+                conn.execute("ROLLBACK TO SAVEPOINT bulk_to_base")
+                conn.execute("RELEASE SAVEPOINT bulk_to_base")
+            raise
+        if conn:
+            conn.rollback()
+        return None
+
+    finally:
+        if own_connection and conn:
+            conn.close()
+
 # Fonction pour récupérer les identifiants des produits
 def fetch_product_ids(database=project_database):
     """
@@ -297,7 +412,7 @@ def fetch_product_ids(database=project_database):
     Suppose que la table 'Products' a les colonnes 'product_id' et 'ticker'.
     """
     try:
-        conn = sqlite3.connect(database)
+        conn = connect(database)
         cursor = conn.cursor()
 
         cursor.execute("SELECT product_id, ticker FROM Products")
@@ -317,7 +432,7 @@ def fetch_product_name(database=project_database):
     Suppose que la table 'Products' a les colonnes 'name' et 'ticker'.
     """
     try:
-        conn = sqlite3.connect(database)
+        conn = connect(database)
         cursor = conn.cursor()
 
         cursor.execute("SELECT name, ticker FROM Products")
@@ -331,34 +446,58 @@ def fetch_product_name(database=project_database):
         return {}
 
 # Fonction pour peupler la table des rendements
-def populate_returns_table(dict_product_id, dict_product_name, returns_df, database=project_database):
+@timed_phase("seeding")
+def populate_returns_table(dict_product_id, dict_product_name, returns_df, database=project_database, incremental=True):
     """
     Peupler la table Returns en utilisant le DataFrame produit par main().
+
+    En mode incrémental, seules les lignes (product_id, date) postérieures à la dernière date
+    stockée pour chaque produit sont insérées. Sinon, toutes les lignes sont insérées et les
+    rendements déjà présents sont mis à jour. L'index unique sur (product_id, date) garantit
+    qu'une nouvelle exécution ne crée jamais de doublons.
     """
     try:
-        conn = sqlite3.connect(database)
+        conn = connect(database)
         cursor = conn.cursor()
-        insert_data = []
-        for date, row in returns_df.iterrows():
-            date = date.strftime('%Y-%m-%d')
-            print(f"Traitement de la date : {date}")  # Débogage
-            for product_name, return_value in row.items():
-                print(product_name)
-                ticker = dict_product_name.get(product_name)
-                product_id = dict_product_id.get(ticker)  # Obtenir l'identifiant du produit pour le ticker
-                if product_id is not None:
-                    insert_data.append((product_id, ticker, date, return_value))
-
-        if insert_data:
-            insert_query = """
-            INSERT INTO Returns (product_id, ticker, date, return_value)
-            VALUES (?, ?, ?, ?)
-            """
-            cursor.executemany(insert_query, insert_data)
-            conn.commit()
-            print(f"{len(insert_data)} lignes insérées dans la table Returns.")
+        ensure_returns_unique_index(conn)
+
+        # Passage du format large (dates x produits) au format long en une seule opération
+        long_df = returns_df.rename_axis('date').reset_index().melt(
+            id_vars='date', var_name='product_name', value_name='return_value'
+        )
+        long_df['ticker'] = long_df['product_name'].map(dict_product_name)
+        long_df['product_id'] = long_df['ticker'].map(dict_product_id)
+        long_df = long_df.dropna(subset=['product_id', 'return_value'])
+        long_df['product_id'] = long_df['product_id'].astype(int)
+        long_df['date'] = pd.to_datetime(long_df['date']).dt.strftime('%Y-%m-%d')
+
+        if incremental:
+            # Dernière date stockée pour chaque produit (lecture directe de l'index unique)
+            cursor.execute("SELECT product_id, MAX(date) FROM Returns GROUP BY product_id")
+            last_dates = dict(cursor.fetchall())
+            long_df = long_df[long_df['date'] > long_df['product_id'].map(last_dates).fillna('')]
+            conflict_clause = "DO NOTHING"
+            action = "insérées"
         else:
-            print("Aucune donnée valide à insérer.")
+            conflict_clause = "DO UPDATE SET ticker = excluded.ticker, return_value = excluded.return_value"
+            action = "insérées ou mises à jour"
+
+        if long_df.empty:
+            print("Aucune nouvelle donnée à insérer.")
+            return
+
+        insert_data = list(zip(
+            long_df['product_id'].tolist(), long_df['ticker'].tolist(),
+            long_df['date'].tolist(), long_df['return_value'].tolist()
+        ))
+        insert_query = f"""
+        INSERT INTO Returns (product_id, ticker, date, return_value)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (product_id, date) {conflict_clause}
+        """
+        cursor.executemany(insert_query, insert_data)
+        conn.commit()
+        print(f"{cursor.rowcount} lignes {action} dans la table Returns.")
 
     except sqlite3.Error as e:
         print(f"Erreur SQLite lors de l'insertion des données de rendements : {e}")
@@ -366,6 +505,16 @@ def populate_returns_table(dict_product_id, dict_product_name, returns_df, datab
     finally:
         conn.close()
 
+# Fonction pour peupler la table des rendements chunk par chunk (univers de grande taille)
+def populate_returns_table_streaming(dict_product_id, dict_product_name, database=project_database,
+                                     chunk_size=50, max_workers=4, **collector_options):
+    """
+    Collecter et insérer les rendements par chunks de tickers : chaque chunk est écrit
+    (en mode incrémental) dès qu'il est prêt, sans garder l'univers complet en mémoire.
+    """
+    for returns_chunk in dc.iter_returns_chunks(chunk_size=chunk_size, max_workers=max_workers, **collector_options):
+        populate_returns_table(dict_product_id, dict_product_name, returns_chunk, database)
+
 # Requêtes SQL pour créer les tables
 create_clients_query = """
 CREATE TABLE IF NOT EXISTS Clients (
@@ -407,7 +556,7 @@ CREATE TABLE IF NOT EXISTS Managers (
 """
 
 create_returns_query = """
-CREATE TABLE Returns (
+CREATE TABLE IF NOT EXISTS Returns (
     id_return INTEGER PRIMARY KEY AUTOINCREMENT,
     product_id INTEGER,
     ticker TEXT,
@@ -430,6 +579,7 @@ CREATE TABLE IF NOT EXISTS Deals (
 """
 
 # Fonction principale pour exécuter le script
+@timed_phase("seeding")
 def main(database=project_database, clients_query=create_clients_query, products_query=create_products_query,
          wallets_query=create_wallet_query, managers_query=create_managers_query, deals_query=create_deals_query,
          returns_query=create_returns_query, dict_prod=dict_products, dict_risk_profile=dict_risk_type):
@@ -442,6 +592,8 @@ def main(database=project_database, clients_query=create_clients_query, products
     create_table(managers_query, "managers", database)
     create_table(deals_query, "deals", database)
     create_table(returns_query, "returns", database)
+    # Index, contraintes d'unicité et tables dérivées (mise à niveau versionnée du schéma)
+    migrate(database)
     # Peuplement des bases de données
     pop_clients_base(dict_risk_profile)
     pop_products_base(dict_prod, dict_risk_profile)
@@ -0,0 +1,229 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+import base_builder as bb
+import connections
+import performances
+import snapshot
+import strategy
+import synthetic_data as sd
+
+# Banc d'essai des chemins critiques (chargement des rendements, backtest, transactions, rapports).
+# Chaque mesure est faite sur une copie d'une base synthétique de référence : toutes les mesures
+# partent du même état et les résultats JSON peuvent être comparés d'un commit à l'autre.
+
+# Dossier des bases de référence (générées une fois par taille, puis réutilisées)
+benchmark_directory = "benchmark_data"
+
+# Tailles de bases synthétiques : paramètres de build_synthetic_database
+benchmark_sizes = {
+    "small": {"n_clients": 1000, "wallets_per_profile": 5, "deals_per_month": 20},
+    "medium": {"n_clients": 100000, "wallets_per_profile": 30, "deals_per_month": 50},
+    "large": {"n_clients": 1000000, "wallets_per_profile": 70, "deals_per_month": 100},
+}
+
+# Fonction pour mesurer une fonction : temps écoulé et, lors de l'exécution instrumentée,
+# pic de mémoire Python, nombre de requêtes SQL (un executemany compte pour une) et temps SQL
+def measure(function, instrumented=True):
+    if instrumented:
+        connections.reset_metrics()
+        connections.enable_instrumentation()
+        tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            wall_time = time.perf_counter() - start
+    finally:
+        if instrumented:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            connections.disable_instrumentation()
+    if not instrumented:
+        return {"wall_time_s": round(wall_time, 4)}
+    metrics = connections.get_metrics()
+    return {
+        "wall_time_s": round(wall_time, 4),
+        "peak_memory_mb": round(peak_memory / 2**20, 2),
+        "sql_queries": metrics["query_count"],
+        "sql_time_s": round(metrics["query_time_s"], 4),
+        "slow_queries": len(metrics["slow_queries"]),
+    }
+
+# Fonction pour obtenir (et générer si besoin) la base de référence d'une taille donnée
+def get_reference_database(size, directory=benchmark_directory, seed=42):
+    os.makedirs(directory, exist_ok=True)
+    database = os.path.join(directory, f"{size}_seed{seed}.db")
+    if not os.path.exists(database):
+        print(f"Génération de la base de référence {database}...")
+        with contextlib.redirect_stdout(io.StringIO()):
+            sd.build_synthetic_database(database + ".tmp", seed=seed, **benchmark_sizes[size])
+        os.replace(database + ".tmp", database)
+    return database
+
+# Points d'entrée mesurés : chacun reçoit le chemin d'une copie de la base de référence
+def bench_populate_returns_table(database):
+    # Rechargement complet des rendements (mise à jour de toutes les lignes existantes)
+    returns_df = sd.generate_returns(bb.dict_products, bb.dict_risk_type,
+                                     sd.start_date_synthetic, sd.end_date_synthetic, seed=0)
+    dict_product_id, dict_product_name = bb.fetch_product_ids(database), bb.fetch_product_name(database)
+    return lambda: bb.populate_returns_table(dict_product_id, dict_product_name, returns_df, database,
+                                             incremental=False)
+
+def bench_run_weekly_updates(database):
+    # Régime établi : l'instantané colonnaire est déjà construit
+    snapshot.refresh_snapshot(database)
+    return lambda: strategy.run_weekly_updates(database)
+
+def bench_record_deals(database):
+    # Une décision d'achat sur chaque produit autorisé, pour chaque portefeuille
+    conn = connections.connect(database)
+    wallets = conn.execute("SELECT wallet_id, products FROM Portfolios").fetchall()
+    tickers = dict(conn.execute("SELECT product_id, ticker FROM Products").fetchall())
+    conn.close()
+    decisions = {wallet_id: {tickers[product_id]: 10 for product_id in json.loads(products)}
+                 for wallet_id, products in wallets}
+
+    def run():
+        for wallet_id, wallet_decisions in decisions.items():
+            strategy.record_deals(wallet_decisions, "2025-01-06", wallet_id, database)
+    return run
+
+def bench_fetch_returns_from_db(database):
+    # Lecture depuis l'instantané colonnaire, construit avant la mesure
+    strategy.fetch_returns_from_db(database)
+    return lambda: strategy.fetch_returns_from_db(database)
+
+def bench_fetch_returns_sql(database):
+    return lambda: strategy.fetch_returns_from_db(database, use_snapshot=False)
+
+def bench_performance_metrics(database):
+    snapshot.refresh_snapshot(database)
+
+    def run():
+        conn = performances.connect_db(database)
+        portfolio_returns = performances.get_all_portfolio_returns(conn, weighting=performances.PORTFOLIO_WEIGHTING)
+        performances.compute_all_metrics(portfolio_returns)
+        conn.close()
+    return run
+
+benchmarks = {
+    "populate_returns_table": bench_populate_returns_table,
+    "run_weekly_updates": bench_run_weekly_updates,
+    "record_deals": bench_record_deals,
+    "fetch_returns_from_db": bench_fetch_returns_from_db,
+    "fetch_returns_sql": bench_fetch_returns_sql,
+    "performance_metrics": bench_performance_metrics,
+}
+
+# Fonction pour récupérer le commit courant (pour comparer les résultats entre commits)
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Fonction principale : mesurer chaque point d'entrée sur chaque taille de base
+def run_benchmarks(sizes=("small",), names=None, repeat=3, output=None, directory=benchmark_directory, seed=42):
+    """
+    Mesurer les points d'entrée `names` (tous par défaut) sur les bases synthétiques `sizes`.
+    Chaque mesure est répétée `repeat` fois sur une copie fraîche de la base de référence : la
+    première exécution, instrumentée, mesure le pic de mémoire et les requêtes SQL ; le meilleur
+    temps est pris sur les suivantes (sans instrumentation). Les résultats sont écrits en JSON
+    dans `output` si fourni, et retournés.
+    """
+    results = []
+    for size in sizes:
+        reference_database = get_reference_database(size, directory, seed)
+        for name in names or benchmarks:
+            runs = []
+            for run_index in range(repeat):
+                database = os.path.join(directory, f"{size}_work.db")
+                shutil.copyfile(reference_database, database)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    function = benchmarks[name](database)
+                runs.append(measure(function, instrumented=(run_index == 0)))
+                # Les connexions partagées pointent sur le fichier supprimé : elles sont fermées
+                connections.close_all()
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(database + suffix):
+                        os.remove(database + suffix)
+                shutil.rmtree(snapshot.get_snapshot_directory(database), ignore_errors=True)
+            result = {
+                "size": size,
+                "benchmark": name,
+                "wall_time_s": min(run["wall_time_s"] for run in (runs[1:] or runs)),
+                "peak_memory_mb": runs[0]["peak_memory_mb"],
+                "sql_queries": runs[0]["sql_queries"],
+                "sql_time_s": runs[0]["sql_time_s"],
+                "slow_queries": runs[0]["slow_queries"],
+                "repeat": repeat,
+            }
+            results.append(result)
+            print(f"{size:>6} {name:<24} {result['wall_time_s']:>9.3f} s {result['peak_memory_mb']:>9.1f} Mo "
+                  f"{result['sql_queries']:>8} requêtes")
+
+    report = {
+        "commit": get_git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": seed,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Résultats écrits dans {output}")
+    return report
+
+# Fonction pour comparer deux fichiers de résultats (ratio nouveau / ancien par mesure)
+def compare_results(old_file, new_file, threshold=1.10):
+    with open(old_file) as f:
+        old_results = {(r["size"], r["benchmark"]): r for r in json.load(f)["results"]}
+    with open(new_file) as f:
+        new_report = json.load(f)
+
+    regressions = []
+    for result in new_report["results"]:
+        key = (result["size"], result["benchmark"])
+        if key not in old_results:
+            continue
+        old = old_results[key]
+        ratio = result["wall_time_s"] / old["wall_time_s"] if old["wall_time_s"] else float("nan")
+        flag = "  <- régression" if ratio > threshold else ""
+        print(f"{key[0]:>6} {key[1]:<24} {old['wall_time_s']:>9.3f} s -> {result['wall_time_s']:>9.3f} s "
+              f"(x{ratio:.2f}), requêtes {old['sql_queries']} -> {result['sql_queries']}{flag}")
+        if ratio > threshold:
+            regressions.append(key)
+    return regressions
+
+if __name__ == "__main__":
+    # Exemples : python benchmarks.py run --sizes small medium --output bench.json
+    #            python benchmarks.py compare bench_avant.json bench_apres.json
+    parser = argparse.ArgumentParser(description="Banc d'essai des chemins critiques du projet")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--sizes", nargs="+", default=["small"], choices=list(benchmark_sizes))
+    run_parser.add_argument("--benchmarks", nargs="+", default=None, choices=list(benchmarks))
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--output", default="benchmark_results.json")
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=1.10)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run_benchmarks(args.sizes, args.benchmarks, args.repeat, args.output)
+    else:
+        compare_results(args.old, args.new, args.threshold)
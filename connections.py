@@ -0,0 +1,320 @@
+import os
+import sqlite3
+import threading
+import time
+import logging
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+# Couche d'accès SQLite partagée par tous les modules.
+# Désactivée (par défaut), connect() renvoie une connexion sqlite3 ordinaire : aucun surcoût.
+# Activée (enable_instrumentation() ou variable d'environnement PROJECT_INSTRUMENTATION=1),
+# chaque requête est chronométrée, ses lignes lues ou modifiées sont comptées et les requêtes
+# lentes sont journalisées. Les résultats des requêtes ne sont jamais modifiés.
+# Les mesures faites dans des processus séparés (ProcessPoolExecutor) ne sont pas remontées.
+#
+# Le gestionnaire de connexions (reader, open_reader, writer) passe la base en journal WAL :
+# les lectures (tableau de bord, rapports) ne sont jamais bloquées par l'écriture d'un
+# rebalancement, et toutes les écritures d'un processus passent par un écrivain unique.
+
+logger = logging.getLogger("instrumentation")
+
+# Nombre maximal de requêtes lentes conservées dans les métriques
+slow_query_log_size = 1000
+
+_lock = threading.Lock()
+_settings = {
+    "enabled": os.environ.get("PROJECT_INSTRUMENTATION") == "1",
+    "slow_query_threshold": 0.1,
+}
+_metrics = {}
+_current_phase = threading.local()
+
+# Fonction pour remettre les métriques à zéro
+def reset_metrics():
+    with _lock:
+        _metrics.clear()
+        _metrics.update({
+            "connections": 0,
+            "query_count": 0,
+            "query_time_s": 0.0,
+            "rows": 0,
+            "queries": {},
+            "slow_queries": deque(maxlen=slow_query_log_size),
+            "phases": {},
+        })
+
+reset_metrics()
+
+# Fonction pour activer l'instrumentation (seuil en secondes au-delà duquel une requête est journalisée)
+def enable_instrumentation(slow_query_threshold=0.1):
+    _settings["enabled"] = True
+    _settings["slow_query_threshold"] = slow_query_threshold
+    # Les connexions du gestionnaire sont rouvertes pour être instrumentées
+    close_all()
+
+def disable_instrumentation():
+    _settings["enabled"] = False
+    close_all()
+
+def is_enabled():
+    return _settings["enabled"]
+
+# Fonction pour récupérer une copie des métriques sous forme de dictionnaire
+def get_metrics():
+    """
+    Retourner les métriques collectées depuis le dernier reset_metrics() :
+    nombre de connexions, nombre et durée totale des requêtes, lignes lues ou modifiées,
+    statistiques par requête (calls, total_time_s, max_time_s, rows), requêtes lentes
+    (sql, time_s, phase) et durée cumulée de chaque phase (calls, total_time_s).
+    """
+    with _lock:
+        return {
+            "enabled": _settings["enabled"],
+            "connections": _metrics["connections"],
+            "query_count": _metrics["query_count"],
+            "query_time_s": _metrics["query_time_s"],
+            "rows": _metrics["rows"],
+            "queries": {sql: dict(stats) for sql, stats in _metrics["queries"].items()},
+            "slow_queries": list(_metrics["slow_queries"]),
+            "phases": {phase: dict(stats) for phase, stats in _metrics["phases"].items()},
+        }
+
+def _record_query(sql, elapsed, rows, executions=1):
+    sql = " ".join(sql.split())
+    phase = getattr(_current_phase, "name", None)
+    with _lock:
+        _metrics["query_count"] += executions
+        _metrics["query_time_s"] += elapsed
+        _metrics["rows"] += rows
+        stats = _metrics["queries"].setdefault(sql, {"calls": 0, "total_time_s": 0.0, "max_time_s": 0.0, "rows": 0})
+        stats["calls"] += executions
+        stats["total_time_s"] += elapsed
+        stats["max_time_s"] = max(stats["max_time_s"], elapsed)
+        stats["rows"] += rows
+        slow = elapsed >= _settings["slow_query_threshold"]
+        if slow:
+            _metrics["slow_queries"].append({"sql": sql, "time_s": elapsed, "phase": phase})
+    if slow:
+        logger.warning("Requête lente (%.3f s, phase %s) : %s", elapsed, phase, sql)
+    else:
+        logger.debug("Requête (%.6f s, %d lignes) : %s", elapsed, rows, sql)
+
+# Curseur instrumenté : temps d'exécution et de lecture attribués à la dernière requête exécutée
+class InstrumentedCursor(sqlite3.Cursor):
+    _last_sql = None
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        elapsed = time.perf_counter() - start
+        self._last_sql = sql
+        _record_query(sql, elapsed, max(self.rowcount, 0))
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        elapsed = time.perf_counter() - start
+        self._last_sql = sql
+        _record_query(sql, elapsed, max(self.rowcount, 0))
+        return self
+
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        super().executescript(sql_script)
+        _record_query(sql_script, time.perf_counter() - start, 0)
+        return self
+
+    def _record_fetch(self, start, rows):
+        if self._last_sql is not None:
+            _record_query(self._last_sql, time.perf_counter() - start, rows, executions=0)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._record_fetch(start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._record_fetch(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._record_fetch(start, len(rows))
+        return rows
+
+# Connexion instrumentée : tous les curseurs (y compris ceux de conn.execute) sont instrumentés
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+# Fonction d'ouverture de connexion utilisée par tous les modules à la place de sqlite3.connect
+def connect(database, **kwargs):
+    if not _settings["enabled"]:
+        return sqlite3.connect(database, **kwargs)
+    with _lock:
+        _metrics["connections"] += 1
+    return sqlite3.connect(database, factory=InstrumentedConnection, **kwargs)
+
+# Chronomètre de phase (collecte, peuplement, stratégie, rapports), utilisable comme contexte
+class phase:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        # Une phase imbriquée dans une phase de même nom n'est comptée qu'une fois
+        if _settings["enabled"] and getattr(_current_phase, "name", None) != self.name:
+            self._previous = getattr(_current_phase, "name", None)
+            _current_phase.name = self.name
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if _settings["enabled"] and hasattr(self, "_start"):
+            elapsed = time.perf_counter() - self._start
+            _current_phase.name = self._previous
+            with _lock:
+                stats = _metrics["phases"].setdefault(self.name, {"calls": 0, "total_time_s": 0.0})
+                stats["calls"] += 1
+                stats["total_time_s"] += elapsed
+            logger.info("Phase %s terminée en %.3f s", self.name, elapsed)
+
+# Décorateur : chronométrer une fonction comme une phase (un simple test quand l'instrumentation est désactivée)
+def timed_phase(name):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _settings["enabled"]:
+                return function(*args, **kwargs)
+            with phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Pragmas appliqués à toutes les connexions du gestionnaire
+connection_pragmas = {
+    "synchronous": "NORMAL",   # Suffisant en WAL : seule la dernière transaction peut être perdue en cas de coupure
+    "cache_size": -65536,      # Cache de pages de 64 Mo par connexion
+    "mmap_size": 268435456,    # Lecture des pages par mmap (256 Mo)
+    "temp_store": "MEMORY",
+    "busy_timeout": 30000,     # Attente (ms) si un autre processus écrit
+}
+
+def _apply_pragmas(conn):
+    for pragma, value in connection_pragmas.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+
+# Fonction pour ouvrir une connexion en lecture seule (la connexion appartient à l'appelant)
+def open_reader(database, check_same_thread=True):
+    conn = connect(f"file:{os.path.abspath(database)}?mode=ro", uri=True, check_same_thread=check_same_thread)
+    _apply_pragmas(conn)
+    conn.execute("PRAGMA query_only = 1")
+    return conn
+
+# Lecteur d'un thread : gardé dans un threading.local, sa connexion est fermée quand le thread se termine
+class _ThreadReader:
+    def __init__(self, conn):
+        self.conn = conn
+        self.close = weakref.finalize(self, conn.close)
+
+# Gestionnaire des connexions d'une base : un lecteur en lecture seule par thread et un écrivain unique
+class ConnectionManager:
+    def __init__(self, database):
+        self.database = database
+        self._local = threading.local()
+        self._readers = weakref.WeakSet()
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._readers_lock = threading.Lock()
+
+    def reader(self):
+        """Connexion en lecture seule propre au thread courant, réutilisée d'un appel à l'autre (ne pas la fermer)."""
+        thread_reader = getattr(self._local, "reader", None)
+        if thread_reader is None or not thread_reader.close.alive:
+            # Le fichier doit être en WAL avant qu'un lecteur ne l'ouvre en lecture seule
+            self._ensure_wal()
+            # La connexion peut être fermée depuis un autre thread (close_all, fin du thread propriétaire)
+            thread_reader = _ThreadReader(open_reader(self.database, check_same_thread=False))
+            self._local.reader = thread_reader
+            with self._readers_lock:
+                self._readers.add(thread_reader)
+        return thread_reader.conn
+
+    def _ensure_wal(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = connect(self.database, check_same_thread=False, timeout=30)
+                self._writer.execute("PRAGMA journal_mode = WAL")
+                _apply_pragmas(self._writer)
+
+    @contextmanager
+    def writer(self):
+        """
+        Écrivain unique de la base : les threads sont servis l'un après l'autre, la transaction
+        est validée à la sortie du bloc et annulée en cas d'exception.
+        """
+        with self._writer_lock:
+            self._ensure_wal()
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+    def close(self):
+        with self._readers_lock:
+            thread_readers = list(self._readers)
+            self._readers.clear()
+        for thread_reader in thread_readers:
+            thread_reader.close()
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+# Fonction pour obtenir le gestionnaire de connexions d'une base (un par fichier et par processus)
+def get_manager(database):
+    key = (os.getpid(), os.path.abspath(database))
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = _managers[key] = ConnectionManager(database)
+        return manager
+
+def reader(database):
+    return get_manager(database).reader()
+
+def writer(database):
+    return get_manager(database).writer()
+
+# Fonction pour fermer toutes les connexions gérées (par exemple avant de supprimer ou remplacer un fichier)
+def close_all():
+    with _managers_lock:
+        managers = [manager for (pid, _), manager in _managers.items() if pid == os.getpid()]
+        _managers.clear()
+    for manager in managers:
+        manager.close()
+
+# Fonction pour retrouver le fichier d'une connexion ouverte
+def get_database_path(conn):
+    return conn.execute("PRAGMA database_list").fetchone()[2]
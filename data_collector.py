@@ -1,11 +1,21 @@
-import yfinance as yf
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
+from connections import connect, timed_phase
 
 # Définir les dates de début et de fin des données utiles au projet
 start_date_project = '2022-01-01'
 end_date_project = '2024-12-31'
 
+# Cache local des prix de clôture, pour ne télécharger que les périodes manquantes
+price_cache_database = "price_cache.db"
+
+# Mode hors ligne : seules les données déjà présentes dans le cache sont utilisées
+offline_mode = os.environ.get("DATA_COLLECTOR_OFFLINE", "0") == "1"
+
 # Dictionnaire des produits avec leurs tickers et noms
 dict_products = {
     'GOLD.PA': 'ETF Amundi Physical Gold', 'CW8.PA': 'ETF Amundi MSCI World', 'PRAC.DE': 'ETF Amundi Corporate Bonds',
@@ -29,34 +39,287 @@ dict_risk_type = {
     'MC.PA': 'high_yield_equity_only', 'RMS.PA': 'high_yield_equity_only', 'NVO': 'high_yield_equity_only'
 }
 
-# Fonction principale pour télécharger les données de rendement
-def main(dict_1=dict_products, start_date=start_date_project, end_date=end_date_project, extreme_threshold=0.50):
-    # Liste des tickers à télécharger
-    tickers = list(dict_1.keys())
+# Requêtes SQL pour créer les tables du cache de prix
+create_prices_query = """
+CREATE TABLE IF NOT EXISTS Prices (
+    ticker TEXT,
+    date DATE,
+    close REAL,
+    PRIMARY KEY (ticker, date)
+);
+"""
+create_coverage_query = """
+CREATE TABLE IF NOT EXISTS PriceCoverage (
+    ticker TEXT PRIMARY KEY,
+    start_date DATE,
+    end_date DATE
+);
+"""
+
+# Verrou autour des téléchargements : yfinance partage un état global entre ses appels
+download_lock = threading.Lock()
+
+# Fonction pour ouvrir le cache de prix en créant ses tables si besoin
+def connect_price_cache(cache_database=price_cache_database):
+    # Délai d'attente : plusieurs chunks peuvent écrire dans le cache en même temps
+    conn = connect(cache_database, timeout=30)
+    conn.execute(create_prices_query)
+    conn.execute(create_coverage_query)
+    return conn
+
+# Fonction pour déterminer les périodes [début, fin) absentes du cache pour un ticker
+def missing_ranges(coverage, start_date, end_date):
+    if coverage is None:
+        return [(start_date, end_date)]
+    covered_start, covered_end = coverage
+    ranges = []
+    # Chaque période manquante touche la période couverte : la couverture reste un seul intervalle,
+    # même si la demande est entièrement avant ou après (l'écart entre les deux est aussi téléchargé)
+    if start_date < covered_start:
+        ranges.append((start_date, covered_start))
+    if end_date > covered_end:
+        ranges.append((covered_end, end_date))
+    return ranges
+
+# Fonction pour télécharger les prix de clôture d'une liste de tickers sur une période
+def download_close_prices(tickers, start_date, end_date):
+    # Import local : yfinance n'est chargé que lorsqu'un téléchargement est réellement nécessaire
+    import yfinance as yf
+
+    with download_lock:
+        close_prices = yf.download(tickers, start=start_date, end=end_date)['Close']
+    if isinstance(close_prices, pd.Series):
+        close_prices = close_prices.to_frame(name=tickers[0])
+    return close_prices
+
+# Fonction pour charger les prix de clôture depuis le cache en téléchargeant uniquement les données manquantes
+def load_close_prices(tickers, start_date=start_date_project, end_date=end_date_project,
+                      cache_database=price_cache_database, offline=None):
+    if offline is None:
+        offline = offline_mode
+
+    conn = connect_price_cache(cache_database)
+    try:
+        placeholders = ",".join("?" for _ in tickers)
+        coverage = {
+            ticker: (covered_start, covered_end)
+            for ticker, covered_start, covered_end in conn.execute(
+                f"SELECT ticker, start_date, end_date FROM PriceCoverage WHERE ticker IN ({placeholders})", tickers
+            )
+        }
+
+        # Regrouper les tickers ayant la même période manquante pour les télécharger ensemble
+        to_download = {}
+        for ticker in tickers:
+            for missing_range in missing_ranges(coverage.get(ticker), start_date, end_date):
+                to_download.setdefault(missing_range, []).append(ticker)
+
+        if to_download and offline:
+            print(f"Mode hors ligne : {sum(len(t) for t in to_download.values())} périodes manquantes ignorées.")
+        elif to_download:
+            for (range_start, range_end), range_tickers in to_download.items():
+                close_prices = download_close_prices(range_tickers, range_start, range_end)
+                prices_long = (
+                    close_prices.rename_axis('date').reset_index()
+                    .melt(id_vars='date', var_name='ticker', value_name='close')
+                    .dropna(subset=['close'])
+                )
+                prices_long['date'] = pd.to_datetime(prices_long['date']).dt.strftime('%Y-%m-%d')
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO Prices (ticker, date, close) VALUES (?, ?, ?)",
+                        list(zip(prices_long['ticker'], prices_long['date'], prices_long['close']))
+                    )
+                    # Seuls les tickers effectivement reçus sont marqués comme couverts (les autres seront retentés)
+                    for ticker in prices_long['ticker'].unique():
+                        covered_start, covered_end = coverage.get(ticker, (range_start, range_end))
+                        coverage[ticker] = (min(covered_start, range_start), max(covered_end, range_end))
+                        conn.execute(
+                            "INSERT OR REPLACE INTO PriceCoverage (ticker, start_date, end_date) VALUES (?, ?, ?)",
+                            (ticker, *coverage[ticker])
+                        )
+
+        prices = pd.read_sql_query(
+            f"""SELECT ticker, date, close FROM Prices
+            WHERE ticker IN ({placeholders}) AND date >= ? AND date < ?""",
+            conn, params=(*tickers, start_date, end_date), parse_dates=['date']
+        )
+    finally:
+        conn.close()
+
+    # Remettre les prix au format large (dates x tickers triés) comme renvoyé par yfinance
+    close_prices = prices.pivot(index='date', columns='ticker', values='close')
+    return close_prices.reindex(columns=sorted(ticker for ticker in tickers if ticker in close_prices.columns))
+
+# Filtres de valeurs extrêmes : chacun renvoie un masque booléen (dates x produits) calculé sur toute la matrice
+class ThresholdFilter:
+    """Rendements dont la valeur absolue dépasse un seuil fixe."""
+    def __init__(self, threshold=0.50):
+        self.threshold = threshold
+        self.name = f"threshold_{threshold}"
+
+    def detect(self, returns_data):
+        return returns_data.abs() > self.threshold
+
+class RollingZScoreFilter:
+    """Rendements éloignés de plus de z_max écarts-types de la moyenne glissante des jours précédents."""
+    def __init__(self, window=60, z_max=6.0, min_periods=20):
+        self.window = window
+        self.z_max = z_max
+        self.min_periods = min_periods
+        self.name = f"rolling_zscore_{window}_{z_max}"
+
+    def detect(self, returns_data):
+        # Statistiques calculées sur les jours précédents uniquement (shift) pour ne pas inclure la valeur testée
+        rolling = returns_data.shift(1).rolling(window=self.window, min_periods=self.min_periods)
+        z_scores = (returns_data - rolling.mean()) / rolling.std()
+        return z_scores.abs() > self.z_max
+
+class MADFilter:
+    """Rendements éloignés de la médiane de plus de k fois l'écart absolu médian (normalisé) de chaque produit."""
+    def __init__(self, k=10.0):
+        self.k = k
+        self.name = f"mad_{k}"
+
+    def detect(self, returns_data):
+        values = returns_data.to_numpy(dtype=float)
+        median = np.nanmedian(values, axis=0)
+        mad = 1.4826 * np.nanmedian(np.abs(values - median), axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            flagged = np.abs(values - median) > self.k * mad
+        # Un produit sans dispersion (MAD nul) n'est pas filtré
+        flagged &= (mad > 0)
+        return pd.DataFrame(flagged, index=returns_data.index, columns=returns_data.columns)
+
+# Fonction pour calculer les rendements nettoyés à partir des prix de clôture (vectorisée sur toutes les colonnes)
+def clean_returns(close_prices, extreme_threshold=0.50, filters=None, calendar_aware=False, return_report=False):
+    """
+    Calculer les rendements quotidiens et remplacer les valeurs extrêmes par le rendement précédent.
+
+    Les filtres (par défaut un seuil fixe à extreme_threshold) sont appliqués dans l'ordre ;
+    le rapport compte, pour chacun, les valeurs qu'il a été le premier à signaler.
+    En mode calendar_aware, un jour de fermeture d'une place donne un rendement manquant
+    (et non nul) pour ses produits, ce qui permet de garder la ligne pour les autres produits.
+    """
+    if filters is None:
+        filters = [ThresholdFilter(extreme_threshold)]
 
-    # Télécharger les données de clôture ajustée pour les tickers spécifiés
     returns_data = (
-        yf.download(tickers, start=start_date, end=end_date)['Close']
+        close_prices
         .ffill()  # Remplir les valeurs manquantes avec la valeur précédente
         .pct_change()  # Calculer le rendement quotidien
         .replace([np.inf, -np.inf], 0)  # Remplacer les valeurs infinies par zéro
-        .rename(columns=dict_1)  # Renommer les colonnes avec les noms des produits
     )
+    trading_days = close_prices.notna()
 
-    # Détecter et gérer les valeurs extrêmes
-    extreme_values = (returns_data.abs() > extreme_threshold)
+    # Détecter les valeurs extrêmes avec chaque filtre
+    report = {}
+    extreme_values = pd.DataFrame(False, index=returns_data.index, columns=returns_data.columns)
+    for extreme_filter in filters:
+        flagged = extreme_filter.detect(returns_data).fillna(False).astype(bool)
+        report[extreme_filter.name] = int((flagged & ~extreme_values).to_numpy().sum())
+        extreme_values |= flagged
 
     # Remplacer les valeurs extrêmes par le rendement du jour précédent
-    for column in returns_data.columns:
-        returns_data[column] = returns_data[column].mask(extreme_values[column]).ffill()
+    returns_data = returns_data.mask(extreme_values).ffill()
+
+    if calendar_aware:
+        # Jours sans cotation du produit : rendement manquant plutôt que nul
+        returns_data = returns_data.where(trading_days)
+        report['non_trading_days'] = int((~trading_days.iloc[1:]).to_numpy().sum())
+
+    # Exclure la première ligne (qui contient NaN après pct_change)
+    returns_data = returns_data.iloc[1:]
+    if return_report:
+        return returns_data, report
+    return returns_data
+
+# Fonction principale pour télécharger les données de rendement
+@timed_phase("collection")
+def main(dict_1=dict_products, start_date=start_date_project, end_date=end_date_project, extreme_threshold=0.50,
+         cache_database=price_cache_database, offline=None, filters=None, calendar_aware=False):
+    # Liste des tickers à télécharger
+    tickers = list(dict_1.keys())
+
+    # Charger les prix de clôture depuis le cache local (téléchargement des seules périodes manquantes)
+    close_prices = load_close_prices(tickers, start_date, end_date, cache_database, offline)
 
-    # Filtrer les données pour exclure la première ligne (qui contient NaN après pct_change)
-    returns_data_filtered = returns_data.iloc[1:]
+    # Rendements nettoyés, colonnes renommées avec les noms des produits
+    returns_data_filtered, report = clean_returns(close_prices, extreme_threshold, filters, calendar_aware,
+                                                  return_report=True)
+    returns_data_filtered = returns_data_filtered.rename(columns=dict_1)
+    print(f"Valeurs modifiées par filtre : {report}")
 
-    # Supprimer les lignes avec des valeurs manquantes
-    final_returns = returns_data_filtered.dropna()
+    if calendar_aware:
+        # Seules les dates sans aucun rendement sont supprimées : chaque produit garde ses propres dates
+        final_returns = returns_data_filtered.dropna(how='all')
+    else:
+        # Supprimer les lignes avec des valeurs manquantes
+        final_returns = returns_data_filtered.dropna()
 
     return final_returns
 
-# Exemple d'utilisation de la fonction principale
-final_returns = main()
+# Fonction pour charger et nettoyer un chunk de tickers sans qu'un ticker en échec n'interrompe la collecte
+def load_chunk_returns(tickers, dict_1, start_date, end_date, extreme_threshold, cache_database, offline,
+                       filters=None, calendar_aware=True):
+    try:
+        close_prices = load_close_prices(tickers, start_date, end_date, cache_database, offline)
+    except Exception as e:
+        # En cas d'échec du chunk, chaque ticker est retenté seul et les tickers en erreur sont ignorés
+        print(f"Erreur lors du chargement du chunk {tickers[0]}..{tickers[-1]} : {e}")
+        prices_by_ticker = []
+        for ticker in tickers:
+            try:
+                prices_by_ticker.append(load_close_prices([ticker], start_date, end_date, cache_database, offline))
+            except Exception as ticker_error:
+                print(f"Ticker {ticker} ignoré : {ticker_error}")
+        if not prices_by_ticker:
+            return pd.DataFrame()
+        close_prices = pd.concat(prices_by_ticker, axis=1)
+
+    if close_prices.empty:
+        return pd.DataFrame()
+    returns_chunk, report = clean_returns(close_prices, extreme_threshold, filters, calendar_aware, return_report=True)
+    print(f"Chunk {tickers[0]}..{tickers[-1]} : valeurs modifiées par filtre : {report}")
+    return returns_chunk.rename(columns=dict_1).dropna(how='all')
+
+# Générateur de rendements par chunks de tickers, pour les univers de grande taille
+def iter_returns_chunks(dict_1=dict_products, start_date=start_date_project, end_date=end_date_project,
+                        extreme_threshold=0.50, chunk_size=50, max_workers=4,
+                        cache_database=price_cache_database, offline=None, filters=None, calendar_aware=True):
+    """
+    Produire les rendements nettoyés chunk par chunk (dates x produits d'un chunk).
+
+    Au plus max_workers chunks sont chargés simultanément : la mémoire reste bornée quelle que
+    soit la taille de l'univers, et chaque chunk peut être écrit en base dès qu'il est prêt.
+    Contrairement à main(), les lignes incomplètes ne sont pas supprimées : chaque produit
+    conserve toutes ses dates. Le mode calendar_aware est activé par défaut pour que les
+    rendements d'un produit ne dépendent pas des autres produits de son chunk.
+    """
+    tickers = list(dict_1.keys())
+    chunks = [tickers[i:i + chunk_size] for i in range(0, len(tickers), chunk_size)]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(
+                load_chunk_returns, chunk, dict_1, start_date, end_date, extreme_threshold, cache_database, offline,
+                filters, calendar_aware
+            ))
+            # Attendre le plus ancien chunk avant d'en lancer davantage (concurrence bornée)
+            if len(pending) >= max_workers:
+                returns_chunk = pending.popleft().result()
+                if not returns_chunk.empty:
+                    yield returns_chunk
+        while pending:
+            returns_chunk = pending.popleft().result()
+            if not returns_chunk.empty:
+                yield returns_chunk
+
+# Les rendements ne sont calculés qu'au premier accès à data_collector.final_returns (aucun réseau à l'import)
+def __getattr__(name):
+    if name == "final_returns":
+        global final_returns
+        final_returns = main()
+        return final_returns
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
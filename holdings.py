@@ -0,0 +1,111 @@
+import sqlite3
+from connections import connect
+
+# Requêtes SQL pour créer les tables de positions et de compteurs de transactions
+create_holdings_query = """
+CREATE TABLE IF NOT EXISTS Holdings (
+    wallet_id INTEGER,
+    product_id INTEGER,
+    qty INTEGER,
+    last_update DATE,
+    PRIMARY KEY (wallet_id, product_id),
+    FOREIGN KEY (wallet_id) REFERENCES Portfolios(wallet_id),
+    FOREIGN KEY (product_id) REFERENCES Products(product_id)
+);
+"""
+create_deal_counts_query = """
+CREATE TABLE IF NOT EXISTS DealCounts (
+    wallet_id INTEGER,
+    month TEXT,
+    deal_count INTEGER,
+    PRIMARY KEY (wallet_id, month),
+    FOREIGN KEY (wallet_id) REFERENCES Portfolios(wallet_id)
+);
+"""
+
+# Fonction pour reconstruire les positions et les compteurs mensuels à partir de la table Deals
+def rebuild_holdings(conn):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM Holdings")
+    cursor.execute("DELETE FROM DealCounts")
+    cursor.execute("""
+        INSERT INTO Holdings (wallet_id, product_id, qty, last_update)
+        SELECT wallet_id, product_id, SUM(qty), MAX(date)
+        FROM Deals GROUP BY wallet_id, product_id
+    """)
+    cursor.execute("""
+        INSERT INTO DealCounts (wallet_id, month, deal_count)
+        SELECT wallet_id, substr(date, 1, 7), COUNT(*)
+        FROM Deals GROUP BY wallet_id, substr(date, 1, 7)
+    """)
+
+# Fonction pour créer les tables Holdings et DealCounts si besoin (initialisées depuis Deals)
+# Avec commit=False, la création reste dans la transaction en cours de l'appelant
+def ensure_holdings_tables(conn, commit=True):
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Holdings'")
+    if cursor.fetchone():
+        return
+
+    cursor.execute(create_holdings_query)
+    cursor.execute(create_deal_counts_query)
+    # Une base existante peut déjà contenir des transactions : on reprend leur historique une seule fois
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Deals'")
+    if cursor.fetchone():
+        rebuild_holdings(conn)
+    if commit:
+        conn.commit()
+
+# Fonction pour répercuter des transactions sur les positions, dans la transaction SQLite en cours
+def record_holdings(cursor, deals):
+    """
+    Mettre à jour Holdings et DealCounts pour une liste de transactions
+    (date, wallet_id, manager_id, product_id, qty), sans valider la transaction.
+    L'appelant fait le commit en même temps que l'insertion dans Deals.
+    """
+    position_changes = {}
+    deal_counts = {}
+    for date, wallet_id, _, product_id, qty in deals:
+        qty_change, last_update = position_changes.get((wallet_id, product_id), (0, date))
+        position_changes[(wallet_id, product_id)] = (qty_change + qty, max(last_update, date))
+        deal_counts[(wallet_id, date[:7])] = deal_counts.get((wallet_id, date[:7]), 0) + 1
+
+    cursor.executemany("""
+        INSERT INTO Holdings (wallet_id, product_id, qty, last_update) VALUES (?, ?, ?, ?)
+        ON CONFLICT (wallet_id, product_id) DO UPDATE SET
+            qty = qty + excluded.qty,
+            last_update = max(last_update, excluded.last_update)
+    """, [(wallet_id, product_id, qty, last_update)
+          for (wallet_id, product_id), (qty, last_update) in position_changes.items()])
+    cursor.executemany("""
+        INSERT INTO DealCounts (wallet_id, month, deal_count) VALUES (?, ?, ?)
+        ON CONFLICT (wallet_id, month) DO UPDATE SET deal_count = deal_count + excluded.deal_count
+    """, [(wallet_id, month, count) for (wallet_id, month), count in deal_counts.items()])
+
+# Fonction pour récupérer les positions courantes d'un portefeuille : {product_id: qty}
+def get_positions(cursor, wallet_id):
+    cursor.execute("SELECT product_id, qty FROM Holdings WHERE wallet_id = ?", (wallet_id,))
+    return dict(cursor.fetchall())
+
+# Fonction pour récupérer le nombre de transactions d'un portefeuille sur un mois ('YYYY-MM')
+def get_month_deal_count(cursor, wallet_id, month):
+    cursor.execute("SELECT deal_count FROM DealCounts WHERE wallet_id = ? AND month = ?", (wallet_id, month))
+    result = cursor.fetchone()
+    return result[0] if result else 0
+
+# Fonction pour reconstruire les positions d'une base existante
+def main(database="project_database.db"):
+    try:
+        conn = connect(database)
+        ensure_holdings_tables(conn)
+        rebuild_holdings(conn)
+        conn.commit()
+        print("Tables Holdings et DealCounts reconstruites à partir de la table Deals.")
+    except sqlite3.Error as e:
+        print(f"Erreur SQLite : {e}")
+    finally:
+        if conn:
+            conn.close()
+
+if __name__ == "__main__":
+    main()
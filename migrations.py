@@ -0,0 +1,125 @@
+import sqlite3
+import sys
+from holdings import ensure_holdings_tables
+from snapshot import create_data_versions
+from connections import connect
+
+# Définir le nom du fichier de la base de données
+project_database = "project_database.db"
+
+# Fonction pour garantir l'unicité des rendements par produit et par date
+def ensure_returns_unique_index(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_returns_product_date'")
+    if cursor.fetchone():
+        return
+
+    # Supprimer les doublons existants en gardant la première occurrence avant de créer l'index
+    cursor.execute("""
+    DELETE FROM Returns
+    WHERE id_return NOT IN (SELECT MIN(id_return) FROM Returns GROUP BY product_id, date)
+    """)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_returns_product_date ON Returns (product_id, date);")
+    conn.commit()
+
+# Migration 2 : index sur les chemins d'accès de strategy et performances
+def add_access_path_indexes(conn):
+    cursor = conn.cursor()
+    # Deals filtrés par portefeuille et date (record_deals, get_recent_deals), colonnes lues incluses
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_deals_wallet_date ON Deals (wallet_id, date, product_id, qty);")
+    # Recherche du manager d'un portefeuille
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_managers_wallet ON Managers (wallets_managed_id, manager_id);")
+    # get_portfolio_ids identifie les portefeuilles par leur nom
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_portfolios_name ON Portfolios (wallet_name);")
+
+# Migration 4 : cache local des séries de benchmark
+def create_benchmark_tables(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS Benchmarks (
+        benchmark TEXT,
+        date DATE,
+        return_value REAL,
+        PRIMARY KEY (benchmark, date)
+    );
+    """)
+    # Période déjà téléchargée pour chaque benchmark (les jours fériés n'ont pas de ligne)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS BenchmarkCoverage (
+        benchmark TEXT PRIMARY KEY,
+        start_date DATE,
+        end_date DATE
+    );
+    """)
+
+# Migration 6 : compteurs de modifications des tables de référence (Portfolios, Products, Managers).
+# Contrairement à Deals et Returns, toute modification compte : ces tables sont petites et rarement modifiées.
+def create_reference_versions(conn):
+    create_data_versions(conn)
+    cursor = conn.cursor()
+    for table in ("Portfolios", "Products", "Managers"):
+        cursor.execute("INSERT OR IGNORE INTO DataVersions (table_name, changes) VALUES (?, 0);", (table,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table.lower()}_{event.lower()}_version AFTER {event} ON {table}
+            BEGIN
+                UPDATE DataVersions SET changes = changes + 1 WHERE table_name = '{table}';
+            END;
+            """)
+
+# Migration 7 : état persistant des accumulateurs de métriques (voir accumulators.refresh_wallet_metrics)
+def create_accumulator_states(conn):
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS AccumulatorStates (name TEXT PRIMARY KEY, state TEXT);")
+
+# Liste ordonnée des migrations : (version, description, fonction appliquée sur la connexion)
+MIGRATIONS = [
+    (1, "Index unique sur Returns (product_id, date)", ensure_returns_unique_index),
+    (2, "Index sur Deals, Managers et Portfolios", add_access_path_indexes),
+    (3, "Tables Holdings et DealCounts", ensure_holdings_tables),
+    (4, "Tables Benchmarks et BenchmarkCoverage", create_benchmark_tables),
+    (5, "Table DataVersions et déclencheurs (fraîcheur de l'instantané colonnaire)", create_data_versions),
+    (6, "Déclencheurs de version sur Portfolios, Products et Managers", create_reference_versions),
+    (7, "Table AccumulatorStates (métriques des portefeuilles en flux)", create_accumulator_states),
+]
+
+# Fonction pour lire la version du schéma stockée dans la base
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+# Fonction pour appliquer les migrations manquantes sur une base existante
+def migrate(database=project_database):
+    """
+    Mettre à niveau la base sur place en appliquant, dans l'ordre, les migrations
+    dont la version est supérieure à PRAGMA user_version. Les migrations sont
+    idempotentes : une migration interrompue est simplement rejouée au lancement suivant.
+    """
+    try:
+        conn = connect(database)
+        current_version = get_schema_version(conn)
+
+        for version, description, apply_migration in MIGRATIONS:
+            if version <= current_version:
+                continue
+            try:
+                apply_migration(conn)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            current_version = version
+            print(f"Migration {version} appliquée : {description}")
+
+        return current_version
+
+    except sqlite3.Error as e:
+        print(f"Erreur SQLite lors de la migration : {e}")
+        return None
+
+    finally:
+        if conn:
+            conn.close()
+
+if __name__ == "__main__":
+    migrate(sys.argv[1] if len(sys.argv) > 1 else project_database)
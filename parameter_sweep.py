@@ -0,0 +1,266 @@
+import argparse
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import performances
+import scheduler
+import snapshot
+import strategy
+from connections import reader, timed_phase
+
+# Balayage des paramètres des stratégies, entièrement en mémoire : aucune transaction n'est écrite.
+# Chaque configuration (profil de risque, paramètres) est simulée sur l'univers de produits du
+# profil avec le moteur vectorisé de strategy (rebalancement chaque lundi par défaut, sans position initiale),
+# puis ses retours sont pondérés par la valeur des positions comme dans performances.get_position_weighted_returns.
+# Les processus du pool lisent la même matrice des rendements par memmap (fichiers de l'instantané) :
+# elle n'est ni copiée ni envoyée à chaque tâche.
+
+# Grilles par défaut, par profil de risque
+default_grids = {
+    "low_risk": {
+        "volatility_target": [0.05, 0.10, 0.15, 0.20],
+        "volatility_window": [20, 30, 60],
+        "momentum_window": [10, 20, 30, 60],
+    },
+    "low_turnover": {
+        "momentum_window": [10, 20, 30, 60],
+        "max_deals_per_month": [1, 2, 4],
+    },
+    "high_yield_equity_only": {
+        "momentum_window": [5, 10, 20, 30],
+    },
+}
+
+# Colonnes de résultats (après le profil et les paramètres)
+metric_columns = ["sharpe_ratio", "volatility", "cumulative_return", "max_drawdown", "deals", "turnover"]
+
+# Métriques pour lesquelles la plus petite valeur est la meilleure
+lower_is_better = ["volatility", "max_drawdown", "turnover"]
+
+# Données partagées par les tâches d'un processus du pool
+_shared = {}
+
+def _init_worker(values_path, dates_path):
+    _shared["values"] = np.load(values_path, mmap_mode='r')
+    _shared["dates"] = np.load(dates_path, mmap_mode='r')
+    _shared["cache_key"] = None
+    _shared["cache"] = None
+
+# Fonction pour développer les grilles en une liste de configurations (profil, paramètres)
+def build_configurations(grids):
+    configurations = []
+    for risk_profile, grid in grids.items():
+        names = list(grid)
+        for values in itertools.product(*(grid[name] for name in names)):
+            configurations.append((risk_profile, dict(zip(names, values))))
+    return configurations
+
+# Fonction pour retrouver l'univers de produits de chaque profil (union des produits de ses portefeuilles)
+def get_profile_universes(database, tickers):
+    column_index = {ticker: i for i, ticker in enumerate(tickers)}
+    universes = {}
+    try:
+        cursor = reader(database).cursor()
+        product_tickers = dict(cursor.execute("SELECT product_id, ticker FROM Products").fetchall())
+        product_ids = {}
+        for risk_profile, products in cursor.execute("SELECT risk_profile, products FROM Portfolios").fetchall():
+            product_ids.setdefault(risk_profile, set()).update(json.loads(products))
+    except sqlite3.Error as e:
+        print(f"Erreur SQLite : {e}")
+        return universes
+    # Produits dans l'ordre des product_id, comme les tickers autorisés de update_portfolios
+    for risk_profile, ids in product_ids.items():
+        universe = [product_tickers[product_id] for product_id in sorted(ids)
+                    if product_tickers.get(product_id) in column_index]
+        if universe:
+            universes[risk_profile] = universe
+    return universes
+
+# Fonction pour simuler des décisions sur une période (sans écriture en base)
+def simulate_portfolio(selected_strategy, decisions, decision_start, values, dates, columns, rebalance_rows,
+                       rebalance_dates, start_date, end_date, trigger_threshold=None):
+    """
+    Simuler les transactions aux lignes `rebalance_rows` (indices de `dates`, -1 si aucune donnée)
+    à partir de la matrice de décisions dont la première ligne est la ligne `decision_start`, sans
+    position initiale. Retourne une DataFrame quotidienne de start_date à end_date : retour pondéré
+    par la valeur des positions ('return'), position totale en quantités ('position'), quantités
+    échangées ('traded') et nombre de transactions ('deals') du jour.
+    """
+    first_row = np.searchsorted(dates, np.datetime64(pd.Timestamp(start_date)), side='left')
+    last_row = np.searchsorted(dates, np.datetime64(pd.Timestamp(end_date)), side='right')
+    if first_row >= last_row:
+        return pd.DataFrame(columns=['return', 'position', 'traded', 'deals'], dtype=float)
+    rows = np.where(rebalance_rows >= decision_start, rebalance_rows - decision_start, -1)
+    if trigger_threshold is not None:
+        rows = scheduler.trigger_rows(decisions, rows, trigger_threshold)
+
+    # Simulation des transactions ; les identifiants de produits sont les colonnes + 1
+    wallet = {
+        'wallet_id': 0,
+        'manager_id': 0,
+        'product_ids': list(range(1, len(columns) + 1)),
+        'sort_by_magnitude': selected_strategy.sort_by_magnitude,
+        'apply_deal_limit': selected_strategy.apply_deal_limit,
+    }
+    deals = strategy.simulate_wallet_deals(wallet, decisions, rows, rebalance_dates,
+                                           max_deals_per_month=selected_strategy.params.get("max_deals_per_month", 2))
+
+    # Positions quotidiennes : un deal daté du jour J pondère les retours à partir du jour de bourse suivant
+    n_days = last_row - first_row
+    flows = np.zeros((n_days + 1, len(columns)))
+    traded = np.zeros(n_days)
+    deal_count = np.zeros(n_days)
+    if deals:
+        deal_dates = np.array([deal[0] for deal in deals], dtype='datetime64[ns]')
+        quantities = np.array([deal[4] for deal in deals], dtype=float)
+        deal_rows = np.clip(np.searchsorted(dates, deal_dates, side='right') - first_row, 0, n_days)
+        np.add.at(flows, (deal_rows, np.array([deal[3] for deal in deals]) - 1), quantities)
+        # Les transactions sont comptées le jour de bourse de leur date
+        trade_rows = np.clip(np.searchsorted(dates, deal_dates, side='left') - first_row, 0, n_days - 1)
+        np.add.at(traded, trade_rows, np.abs(quantities))
+        np.add.at(deal_count, trade_rows, 1)
+    positions = np.cumsum(flows, axis=0)[:-1]
+    period_returns = values[first_row:last_row][:, columns]
+    period_returns = np.where(np.isnan(period_returns), 0, period_returns)
+    total_position = positions.sum(axis=1)
+    # Poids : valeur des positions au prix de la veille (indice valant 1 à la première date, voir
+    # performances.compute_previous_prices)
+    history = values[:first_row][:, columns]
+    start_prices = np.prod(1 + np.where(np.isnan(history), 0, history), axis=0)
+    previous_prices = start_prices * np.vstack([np.ones((1, len(columns))), np.cumprod(1 + period_returns, axis=0)[:-1]])
+    position_values = positions * previous_prices
+    total_value = position_values.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        portfolio_returns = np.where(total_value > 0, (position_values * period_returns).sum(axis=1) / total_value, np.nan)
+    return pd.DataFrame({'return': portfolio_returns, 'position': total_position, 'traded': traded,
+                         'deals': deal_count}, index=pd.DatetimeIndex(dates[first_row:last_row], name='date'))
+
+# Fonction pour calculer les métriques de plusieurs portefeuilles simulés (tableaux dates x configurations)
+def summarize_portfolios(returns, positions, traded, deals):
+    metrics = performances.compute_all_metrics(returns)[['sharpe_ratio', 'volatility', 'cumulative_return', 'max_drawdown']]
+    mean_position = positions.to_numpy().mean(axis=0)
+    metrics['deals'] = deals.to_numpy().sum(axis=0).astype(int)
+    # Quantités échangées rapportées à la position moyenne, sur un an
+    with np.errstate(invalid='ignore', divide='ignore'):
+        metrics['turnover'] = np.where(mean_position > 0, traded.to_numpy().sum(axis=0) / mean_position
+                                       * performances.TRADING_DAYS / max(len(positions), 1), np.nan)
+    return metrics
+
+# Fonction pour simuler des décisions sur une période et calculer les métriques
+def evaluate_decisions(selected_strategy, decisions, decision_start, values, dates, columns, rebalance_rows,
+                       rebalance_dates, start_date, end_date, trigger_threshold=None):
+    """Retourner le dictionnaire des métriques et la série des retours quotidiens du portefeuille simulé."""
+    daily = simulate_portfolio(selected_strategy, decisions, decision_start, values, dates, columns, rebalance_rows,
+                               rebalance_dates, start_date, end_date, trigger_threshold)
+    if daily.empty:
+        return {}, daily['return']
+    metrics = summarize_portfolios(*(daily[[name]] for name in ('return', 'position', 'traded', 'deals')))
+    return metrics.to_dict('records')[0], daily['return']
+
+# Fonction pour simuler une configuration et calculer ses métriques (exécutée dans un processus du pool)
+def evaluate_configuration(task):
+    risk_profile, parameters, tickers, columns, start_date, end_date, frequency, calendar, trigger_threshold = task
+    values, dates = _shared["values"], _shared["dates"]
+    result = {"risk_profile": risk_profile, **parameters}
+    selected_strategy = strategy.get_strategy(risk_profile, **parameters)
+
+    schedule = scheduler.rebalance_dates(start_date, end_date, frequency, calendar)
+    rebalance_rows = scheduler.schedule_rows(dates, schedule)
+    valid_rows = rebalance_rows[rebalance_rows >= 0]
+    if not len(valid_rows):
+        return result
+
+    # Signaux partagés entre les configurations successives d'un même profil (tâches groupées par profil)
+    start = strategy.lookback_start(values, valid_rows.min(), selected_strategy.lookback(), columns)
+    cache_key = (risk_profile, tuple(columns), start)
+    if _shared["cache_key"] != cache_key:
+        _shared["cache_key"] = cache_key
+        _shared["cache"] = strategy.SignalCache(pd.DataFrame(values[start:valid_rows.max() + 1][:, columns],
+                                                             columns=tickers))
+    cache = _shared["cache"]
+    decisions = selected_strategy.signals(cache.returns_matrix, cache, valid_rows - start)
+
+    metrics, _ = evaluate_decisions(selected_strategy, decisions, start, values, dates, columns, rebalance_rows,
+                                    schedule.strftime('%Y-%m-%d'), start_date, end_date,
+                                    trigger_threshold if frequency == "signal" else None)
+    result.update(metrics)
+    return result
+
+# Fonction principale : évaluer toutes les configurations en parallèle et les classer
+@timed_phase("strategy")
+def run_sweep(database="project_database.db", grids=None, start_date=performances.START_DATE,
+              end_date=performances.END_DATE, max_workers=None, rank_by="sharpe_ratio", output=None,
+              frequency="weekly", calendar=None, trigger_threshold=None):
+    """
+    Évaluer chaque configuration des grilles ({profil: {paramètre: [valeurs]}}, default_grids par
+    défaut) sur la période et retourner une DataFrame classée selon `rank_by` avec, par
+    configuration, le ratio de Sharpe, la volatilité, le rendement cumulé, le max drawdown, le
+    nombre de transactions et le turnover annualisé. La base n'est jamais modifiée.
+    Les rebalancements suivent `frequency` et `calendar` (voir scheduler.rebalance_dates).
+    """
+    configurations = build_configurations(grids or default_grids)
+    for risk_profile, parameters in configurations:
+        # Profil inconnu ou paramètre invalide : erreur avant le lancement du pool
+        if strategy.get_strategy(risk_profile, **parameters) is None:
+            raise ValueError(f"Aucune stratégie enregistrée pour le profil '{risk_profile}'")
+
+    temporary_directory = None
+    # Le balayage n'écrit rien à côté de la base : l'instantané n'est utilisé que s'il est à jour
+    files = snapshot.get_returns_files(database, update=False)
+    if files is None:
+        # Base sans instantané à jour : la matrice est écrite une fois dans un fichier temporaire partagé
+        returns_matrix = strategy.fetch_returns_from_db(database, use_snapshot=False)
+        temporary_directory = tempfile.mkdtemp(prefix="sweep-")
+        files = (os.path.join(temporary_directory, "returns_values.npy"),
+                 os.path.join(temporary_directory, "returns_dates.npy"), list(returns_matrix.columns), None)
+        np.save(files[0], returns_matrix.to_numpy(dtype=float))
+        np.save(files[1], returns_matrix.index.values.astype('datetime64[ns]'))
+    values_path, dates_path, tickers, _ = files
+
+    try:
+        universes = get_profile_universes(database, tickers)
+        column_index = {ticker: i for i, ticker in enumerate(tickers)}
+        tasks = [(risk_profile, parameters, universes[risk_profile],
+                  [column_index[ticker] for ticker in universes[risk_profile]], start_date, end_date,
+                  frequency, calendar, trigger_threshold)
+                 for risk_profile, parameters in configurations if risk_profile in universes]
+        # Tâches contiguës par profil et fenêtres : les signaux en cache servent aux configurations voisines
+        tasks.sort(key=lambda task: (task[0], sorted(task[1].items())))
+        workers = max_workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(values_path, dates_path)) as executor:
+            results = list(executor.map(evaluate_configuration, tasks,
+                                        chunksize=max(1, len(tasks) // (workers * 4))))
+    finally:
+        if temporary_directory:
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+
+    ranking = pd.DataFrame(results)
+    ranking = ranking[[column for column in ranking.columns if column not in metric_columns]
+                      + [column for column in metric_columns if column in ranking.columns]]
+    if not ranking.empty and rank_by in ranking.columns:
+        ranking = ranking.sort_values(rank_by, ascending=rank_by in lower_is_better, na_position='last',
+                                      kind='stable').reset_index(drop=True)
+        ranking.insert(0, "rank", np.arange(1, len(ranking) + 1))
+    if output:
+        ranking.to_csv(output, index=False)
+        print(f"{len(ranking)} configurations évaluées, résultats écrits dans {output}")
+    return ranking
+
+if __name__ == "__main__":
+    # Exemple : python parameter_sweep.py project_database.db --workers 8 --output sweep.csv
+    parser = argparse.ArgumentParser(description="Balayage des paramètres des stratégies (sans écriture en base)")
+    parser.add_argument("database", nargs="?", default="project_database.db")
+    parser.add_argument("--start", default=performances.START_DATE)
+    parser.add_argument("--end", default=performances.END_DATE)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--rank-by", default="sharpe_ratio")
+    parser.add_argument("--output", default="sweep_results.csv")
+    args = parser.parse_args()
+    print(run_sweep(args.database, None, args.start, args.end, args.workers, args.rank_by, args.output).head(20))
@@ -2,8 +2,11 @@ import sqlite3
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-import yfinance as yf
 import ast
+import data_collector
+from migrations import create_benchmark_tables
+from connections import open_reader, writer, get_database_path, timed_phase
+import snapshot
 
 # Paramètres
 DB_PATH = "project_database.db"  
@@ -11,17 +14,45 @@ RISK_FREE_RATE_ANNUAL = 0.02 # Je prend un taux sans risque de 2%
 TRADING_DAYS = 252                 
 START_DATE = "2023-01-01"
 END_DATE = "2024-12-31"
+BENCHMARK_TICKER = "^GSPC"         # Benchmark par défaut (SP500)
+PORTFOLIO_WEIGHTING = "positions"  # "positions" : pondération par la valeur des positions issues des deals, "equal" : moyenne simple des produits
+HISTORY_START_DATE = "1900-01-01"  # Borne basse pour lire tout l'historique de Returns (indice de prix)
 
-def connect_db(db_path):
-    """Se connecter à la base de données SQLite."""
+def connect_db(db_path, check_same_thread=True):
+    """
+    Se connecter à la base de données SQLite en lecture seule.
+
+    La base est en journal WAL : les lectures ne sont pas bloquées pendant qu'un rebalancement
+    écrit. Les seules écritures de ce module (cache des benchmarks) passent par l'écrivain unique.
+    """
     try:
-        conn = sqlite3.connect(db_path)
+        conn = open_reader(db_path, check_same_thread=check_same_thread)
         print("Connexion à la base de données réussie.")
         return conn
     except Exception as e:
         print(f"Erreur de connexion à la base : {e}")
         raise
 
+def get_db_version(conn):
+    """
+    Renvoyer un identifiant de version des données de la base.
+
+    Il change dès que de nouveaux deals ou rendements sont enregistrés (identifiants maximaux),
+    qu'une ligne de Deals ou Returns est modifiée ou supprimée, ou que Portfolios, Products ou
+    Managers changent (compteurs de la table DataVersions, migrations 5 et 6), ou qu'une autre
+    connexion a modifié la base (PRAGMA data_version). Il sert de clé d'invalidation pour les
+    caches de résultats. Les compteurs sont conservés dans la base : ils restent valables d'une
+    connexion à l'autre, contrairement à PRAGMA data_version.
+    """
+    max_deal_id, max_return_id = conn.execute(
+        "SELECT (SELECT MAX(deal_id) FROM Deals), (SELECT MAX(id_return) FROM Returns)"
+    ).fetchone()
+    data_changes = None
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'DataVersions'").fetchone():
+        data_changes = tuple(conn.execute("SELECT table_name, changes FROM DataVersions ORDER BY table_name").fetchall())
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    return (max_deal_id, max_return_id, data_changes, data_version)
+
 def get_products_for_wallet(conn, wallet_id):
     """
     Récupérer la liste des product_id associés à un portefeuille.
@@ -40,9 +71,10 @@ def get_products_for_wallet(conn, wallet_id):
         print(f"Erreur lors de la conversion des produits pour le wallet {wallet_id}: {e}")
         return []
 
-def get_portfolio_returns(conn, wallet_id):
+def get_portfolio_returns(conn, wallet_id, start_date=START_DATE, end_date=END_DATE):
     """
-    Récupérer les retours journaliers agrégés pour un portefeuille donné sur la période [START_DATE, END_DATE].
+    Récupérer les retours journaliers agrégés pour un portefeuille donné sur la période [start_date, end_date]
+    (par défaut [START_DATE, END_DATE]).
 
     Pour le portefeuille identifié par wallet_id, on récupère la liste des produits associés 
     puis on interroge la table Returns pour obtenir, pour chaque date, la moyenne des return_value.
@@ -65,44 +97,168 @@ def get_portfolio_returns(conn, wallet_id):
     GROUP BY date
     ORDER BY date;
     """
-    # On ajoute START_DATE et END_DATE à la liste des paramètres
-    df = pd.read_sql_query(query, conn, params=tuple(products) + (START_DATE, END_DATE))
+    # On ajoute les bornes de la période à la liste des paramètres
+    df = pd.read_sql_query(query, conn, params=tuple(products) + (start_date, end_date))
     if not df.empty:
         df['date'] = pd.to_datetime(df['date'])
         df.sort_values(by='date', inplace=True)
         df.rename(columns={'return_value': 'return'}, inplace=True)
     return df
 
-def get_sp500_returns():
+class YahooBenchmark:
     """
-    Récupérer les retours journaliers du SP500 via Yahoo Finance pour la période d'évaluation.
-    
-    On utilise le ticker '^GSPC' et on calcule les retours à partir de la colonne de prix ajusté.
-    Si les colonnes sont en multi-index, on les aplatit pour faciliter l'accès.
+    Benchmark téléchargé depuis Yahoo Finance (par exemple '^GSPC' pour le SP500).
+
+    Les retours sont conservés dans la table Benchmarks : seuls les jours postérieurs
+    à la période déjà couverte sont téléchargés, et rien n'est téléchargé en mode hors ligne.
     """
-    sp500 = yf.download("^GSPC", start=START_DATE, end=END_DATE, auto_adjust=True)
-    if sp500.empty:
-        print("Erreur lors du téléchargement des données du SP500.")
-        return pd.DataFrame()
-    
-    if isinstance(sp500.columns, pd.MultiIndex):
-        sp500.columns = sp500.columns.get_level_values(0)
-    
-    sp500.reset_index(inplace=True)
-    
-    if 'Close' in sp500.columns:
-        price_col = 'Close'
-    elif 'Adj Close' in sp500.columns:
-        price_col = 'Adj Close'
-    else:
-        print("Aucune colonne de prix trouvée dans les données du SP500.")
+    def __init__(self, ticker=BENCHMARK_TICKER):
+        self.ticker = ticker
+        self.name = ticker
+
+    def download(self, start_date, end_date):
+        """
+        Télécharger les retours journaliers via Yahoo Finance.
+
+        On calcule les retours à partir de la colonne de prix ajusté.
+        Si les colonnes sont en multi-index, on les aplatit pour faciliter l'accès.
+        """
+        # Import local : yfinance n'est chargé que si un téléchargement est nécessaire
+        import yfinance as yf
+
+        benchmark = yf.download(self.ticker, start=start_date, end=end_date, auto_adjust=True)
+        if benchmark.empty:
+            print(f"Erreur lors du téléchargement des données du benchmark {self.ticker}.")
+            return pd.DataFrame()
+
+        if isinstance(benchmark.columns, pd.MultiIndex):
+            benchmark.columns = benchmark.columns.get_level_values(0)
+
+        benchmark.reset_index(inplace=True)
+
+        if 'Close' in benchmark.columns:
+            price_col = 'Close'
+        elif 'Adj Close' in benchmark.columns:
+            price_col = 'Adj Close'
+        else:
+            print(f"Aucune colonne de prix trouvée dans les données du benchmark {self.ticker}.")
+            return pd.DataFrame()
+
+        benchmark['date'] = pd.to_datetime(benchmark['Date'])
+        benchmark.sort_values(by='date', inplace=True)
+        benchmark['return'] = benchmark[price_col].pct_change()
+        benchmark.dropna(subset=['return'], inplace=True)
+        return benchmark[['date', 'return']]
+
+    def refresh(self, conn, start_date, end_date):
+        """Compléter le cache local pour couvrir [start_date, end_date]."""
+        database = get_database_path(conn)
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'BenchmarkCoverage'").fetchone():
+            with writer(database) as writer_conn:
+                create_benchmark_tables(writer_conn)
+        coverage = conn.execute(
+            "SELECT start_date, end_date FROM BenchmarkCoverage WHERE benchmark = ?", (self.name,)
+        ).fetchone()
+        if coverage and coverage[0] <= start_date and coverage[1] >= end_date:
+            return
+        if data_collector.offline_mode:
+            print(f"Mode hors ligne : le benchmark {self.name} n'est pas mis à jour.")
+            return
+
+        # Reprendre au dernier jour enregistré : son prix sert de base au premier nouveau retour
+        # (la fin de couverture est exclusive, comme le paramètre end de yfinance, et n'a pas de prix)
+        last_stored = conn.execute(
+            "SELECT MAX(date) FROM Benchmarks WHERE benchmark = ?", (self.name,)
+        ).fetchone()[0]
+        if coverage and coverage[0] <= start_date:
+            fetch_start = last_stored or coverage[0]
+            covered_start = coverage[0]
+        else:
+            fetch_start = covered_start = start_date
+        new_returns = self.download(fetch_start, end_date)
+        if new_returns.empty:
+            return
+
+        with writer(database) as writer_conn:
+            writer_conn.executemany(
+                "INSERT OR REPLACE INTO Benchmarks (benchmark, date, return_value) VALUES (?, ?, ?)",
+                [(self.name, date.strftime('%Y-%m-%d'), value)
+                 for date, value in zip(new_returns['date'], new_returns['return'])]
+            )
+            writer_conn.execute(
+                "INSERT OR REPLACE INTO BenchmarkCoverage (benchmark, start_date, end_date) VALUES (?, ?, ?)",
+                (self.name, covered_start, max(end_date, coverage[1]) if coverage else end_date)
+            )
+
+    def get_returns(self, conn, start_date=START_DATE, end_date=END_DATE):
+        self.refresh(conn, start_date, end_date)
+        query = """
+        SELECT date, return_value AS return
+        FROM Benchmarks
+        WHERE benchmark = ? AND date BETWEEN ? AND ?
+        ORDER BY date;
+        """
+        df = pd.read_sql_query(query, conn, params=(self.name, start_date, end_date))
+        df['date'] = pd.to_datetime(df['date'])
+        return df
+
+class ProductBenchmark:
+    """
+    Benchmark construit à partir d'un produit déjà présent dans la table Products
+    (par exemple 'CW8.PA' pour le MSCI World) : ses retours sont lus dans la table Returns,
+    sans aucun appel réseau.
+    """
+    def __init__(self, ticker):
+        self.ticker = ticker
+        self.name = ticker
+
+    def get_returns(self, conn, start_date=START_DATE, end_date=END_DATE):
+        query = """
+        SELECT date, return_value AS return
+        FROM Returns
+        WHERE ticker = ? AND date BETWEEN ? AND ?
+        ORDER BY date;
+        """
+        df = pd.read_sql_query(query, conn, params=(self.ticker, start_date, end_date))
+        df['date'] = pd.to_datetime(df['date'])
+        return df
+
+def get_benchmark_provider(conn, ticker=BENCHMARK_TICKER):
+    """
+    Choisir la source d'un benchmark : un ticker présent dans Products est lu localement,
+    tout autre ticker est récupéré (puis conservé en base) via Yahoo Finance.
+    """
+    if conn.execute("SELECT 1 FROM Products WHERE ticker = ?", (ticker,)).fetchone():
+        return ProductBenchmark(ticker)
+    return YahooBenchmark(ticker)
+
+def get_benchmark_returns(conn, provider=None, start_date=START_DATE, end_date=END_DATE):
+    """
+    Récupérer les retours journaliers d'un benchmark sur la période d'évaluation.
+    Le résultat est une DataFrame avec les colonnes date et return.
+    """
+    if provider is None:
+        provider = get_benchmark_provider(conn)
+    try:
+        return provider.get_returns(conn, start_date, end_date)
+    except sqlite3.Error as e:
+        print(f"Erreur SQLite lors de la récupération du benchmark {provider.name} : {e}")
         return pd.DataFrame()
-    
-    sp500['date'] = pd.to_datetime(sp500['Date'])
-    sp500.sort_values(by='date', inplace=True)
-    sp500['return'] = sp500[price_col].pct_change()
-    sp500.dropna(subset=['return'], inplace=True)
-    return sp500[['date', 'return']]
+
+def get_sp500_returns(conn=None):
+    """
+    Récupérer les retours journaliers du SP500 pour la période d'évaluation.
+
+    Les données sont lues dans le cache local (table Benchmarks) et seuls les jours
+    manquants sont téléchargés depuis Yahoo Finance avec le ticker '^GSPC'.
+    """
+    if conn is not None:
+        return get_benchmark_returns(conn, YahooBenchmark("^GSPC"))
+    conn = open_reader(DB_PATH)
+    try:
+        return get_benchmark_returns(conn, YahooBenchmark("^GSPC"))
+    finally:
+        conn.close()
 
 def get_portfolio_ids(conn):
     """
@@ -191,6 +347,234 @@ def compute_max_drawdown(df):
     max_drawdown = drawdown.max()
     return max_drawdown
 
+def load_returns_matrix(conn, start_date=START_DATE, end_date=END_DATE):
+    """
+    Retourner les retours journaliers (dates x product_id) sur la période, depuis l'instantané
+    colonnaire s'il est disponible, sinon par une requête sur la table Returns.
+    """
+    database = get_database_path(conn)
+    if database:
+        returns_matrix, product_ids = snapshot.load_returns(database, conn)
+        if returns_matrix is not None:
+            returns_matrix = returns_matrix.loc[start_date:end_date]
+            returns_matrix = returns_matrix.set_axis(pd.Index(product_ids, name='product_id'), axis=1)
+            # Seuls les produits ayant au moins un retour sur la période, comme le pivot SQL
+            return returns_matrix.loc[:, returns_matrix.notna().any().to_numpy()].sort_index(axis=1)
+    query = """
+    SELECT date, product_id, return_value
+    FROM Returns
+    WHERE date BETWEEN ? AND ?;
+    """
+    returns_df = pd.read_sql_query(query, conn, params=(start_date, end_date))
+    if returns_df.empty:
+        return pd.DataFrame()
+    returns_matrix = returns_df.pivot(index='date', columns='product_id', values='return_value')
+    returns_matrix.index = pd.to_datetime(returns_matrix.index)
+    return returns_matrix
+
+def load_deals(conn):
+    """Retourner le registre des deals (date, wallet_id, product_id, qty), depuis l'instantané si possible."""
+    database = get_database_path(conn)
+    if database:
+        deals = snapshot.load_deals(database, conn)
+        if deals is not None:
+            return deals[['date', 'wallet_id', 'product_id', 'qty']]
+    return pd.read_sql_query("SELECT date, wallet_id, product_id, qty FROM Deals", conn)
+
+@timed_phase("reporting")
+def get_all_portfolio_returns(conn, start_date=START_DATE, end_date=END_DATE, weighting="equal"):
+    """
+    Récupérer en une seule requête les retours journaliers de tous les portefeuilles.
+
+    La table Returns est lue une fois et pivotée (dates x produits), puis le retour de chaque
+    portefeuille est la moyenne des produits qui lui sont associés, comme dans get_portfolio_returns.
+    Avec weighting="positions", les retours sont pondérés par la valeur des positions issues de la table
+    Deals (voir get_position_weighted_returns).
+    Le résultat est une DataFrame (dates x wallet_id) ; une valeur manquante signifie
+    qu'aucun produit du portefeuille n'a de retour à cette date.
+    """
+    if weighting == "positions":
+        return get_position_weighted_returns(conn, start_date, end_date)
+    portfolios = pd.read_sql_query("SELECT wallet_id, products FROM Portfolios ORDER BY wallet_id", conn)
+    returns_matrix = load_returns_matrix(conn, start_date, end_date)
+    if portfolios.empty or returns_matrix.empty:
+        return pd.DataFrame()
+
+    # Matrice d'appartenance (produits x portefeuilles)
+    membership = np.zeros((returns_matrix.shape[1], len(portfolios)))
+    product_position = {product_id: i for i, product_id in enumerate(returns_matrix.columns)}
+    for j, products_str in enumerate(portfolios['products']):
+        try:
+            products_list = ast.literal_eval(products_str)
+        except Exception as e:
+            print(f"Erreur lors de la conversion des produits pour le wallet {portfolios['wallet_id'][j]}: {e}")
+            continue
+        for product_id in products_list:
+            if product_id in product_position:
+                membership[product_position[product_id], j] = 1
+
+    # Moyenne des retours disponibles : somme et nombre de produits obtenus par produit matriciel
+    values = returns_matrix.to_numpy()
+    available = ~np.isnan(values)
+    sums = np.where(available, values, 0) @ membership
+    counts = available.astype(float) @ membership
+    with np.errstate(invalid='ignore', divide='ignore'):
+        portfolio_returns = np.where(counts > 0, sums / counts, np.nan)
+    return pd.DataFrame(portfolio_returns, index=returns_matrix.index, columns=portfolios['wallet_id'])
+
+# Fonction pour calculer l'indice de prix de chaque produit à la clôture de la veille
+def compute_previous_prices(returns_matrix):
+    """
+    Indice de prix de chaque produit (dates x produits) à la clôture du jour de bourse précédent :
+    produit des (1 + retour) depuis la première date du tableau, qui vaut 1. Un retour manquant
+    laisse le prix inchangé.
+    """
+    growth = 1 + np.where(np.isnan(returns_matrix.to_numpy(dtype=float)), 0, returns_matrix.to_numpy(dtype=float))
+    prices = np.cumprod(np.vstack([np.ones((1, returns_matrix.shape[1])), growth]), axis=0)[:-1]
+    return pd.DataFrame(prices, index=returns_matrix.index, columns=returns_matrix.columns)
+
+def get_position_weighted_returns(conn, start_date=START_DATE, end_date=END_DATE):
+    """
+    Calculer les retours journaliers de tous les portefeuilles pondérés par la valeur de leurs positions.
+
+    Les positions quotidiennes sont reconstruites à partir de la table Deals par une somme cumulée
+    des quantités, par couple (portefeuille, produit). Un deal daté du jour J est exécuté à la
+    clôture : il pondère les retours à partir du jour de bourse suivant. Le poids d'une position
+    est sa quantité multipliée par le prix du produit à la clôture de la veille. La base ne contient
+    pas de prix : ils sont reconstruits à une constante près à partir de Returns (indice valant 1
+    à la première date de la table pour tous les produits), si bien que les poids suivent les
+    rendements de chaque produit depuis cette date et ne dépendent pas de start_date.
+    Le résultat est une DataFrame (dates x wallet_id) ; une valeur manquante signifie que le
+    portefeuille ne détient rien. compute_nav en donne la valeur liquidative.
+    """
+    portfolios = pd.read_sql_query("SELECT wallet_id FROM Portfolios ORDER BY wallet_id", conn)
+    deals = load_deals(conn)
+    # Tout l'historique jusqu'à end_date est lu pour l'indice de prix ; seule la période est restituée
+    history = load_returns_matrix(conn, HISTORY_START_DATE, end_date)
+    returns_matrix = history.loc[start_date:end_date] if not history.empty else history
+    if portfolios.empty or returns_matrix.empty:
+        return pd.DataFrame()
+    wallet_ids = portfolios['wallet_id'].tolist()
+    if deals.empty:
+        return pd.DataFrame(np.nan, index=returns_matrix.index, columns=pd.Index(wallet_ids, name='wallet_id'))
+
+    # Positions cumulées après chaque date de deal, par couple (portefeuille, produit)
+    deals = deals.assign(date=pd.to_datetime(deals['date']))
+    deal_flows = deals.pivot_table(index='date', columns=['wallet_id', 'product_id'], values='qty',
+                                   aggfunc='sum', fill_value=0).sort_index()
+    cumulative_positions = deal_flows.cumsum().to_numpy(dtype=float)
+
+    # Position détenue chaque jour de bourse : dernier cumul strictement antérieur à ce jour
+    last_deal = np.searchsorted(deal_flows.index.values, returns_matrix.index.values, side='left') - 1
+    positions = np.where(last_deal[:, None] >= 0, cumulative_positions[np.maximum(last_deal, 0)], 0)
+
+    # Retours et prix de la veille du produit de chaque couple ; un marché fermé donne un retour nul ce jour-là
+    pair_wallets = deal_flows.columns.get_level_values('wallet_id')
+    pair_products = deal_flows.columns.get_level_values('product_id')
+    pair_returns = returns_matrix.reindex(columns=pair_products).to_numpy()
+    pair_returns = np.where(np.isnan(pair_returns), 0, pair_returns)
+    previous_prices = compute_previous_prices(history).loc[returns_matrix.index]
+    pair_prices = previous_prices.reindex(columns=pair_products).fillna(1).to_numpy()
+
+    # Agrégation par portefeuille : somme des retours pondérés par la valeur sur la valeur totale
+    values = positions * pair_prices
+    membership = (np.asarray(pair_wallets)[:, None] == np.asarray(wallet_ids)[None, :]).astype(float)
+    weighted_sum = (values * pair_returns) @ membership
+    total_value = values @ membership
+    with np.errstate(invalid='ignore', divide='ignore'):
+        portfolio_returns = np.where(total_value > 0, weighted_sum / total_value, np.nan)
+    return pd.DataFrame(portfolio_returns, index=returns_matrix.index,
+                        columns=pd.Index(wallet_ids, name='wallet_id'))
+
+def compute_nav(portfolio_returns, initial_value=1.0):
+    """
+    Calculer la valeur liquidative (NAV) de chaque portefeuille à partir d'un tableau de retours
+    (dates x portefeuilles). Un jour sans retour laisse la NAV inchangée.
+    """
+    return initial_value * (1 + portfolio_returns.fillna(0)).cumprod()
+
+@timed_phase("reporting")
+def compute_all_metrics(portfolio_returns, benchmark_df=None):
+    """
+    Calculer toutes les métriques de performance pour tous les portefeuilles en une passe.
+
+    Les calculs sont faits colonne par colonne sur le tableau (dates x portefeuilles) avec les
+    mêmes conventions que compute_sharpe_ratio, compute_volatility, compute_cumulative_returns,
+    compute_max_drawdown et compute_beta. Le résultat est une DataFrame indexée par wallet_id
+    avec les colonnes sharpe_ratio, volatility, cumulative_return, max_drawdown et beta.
+    """
+    values = portfolio_returns.to_numpy(dtype=float)
+    available = ~np.isnan(values)
+    n_obs = available.sum(axis=0)
+    filled = np.where(available, values, 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Ratio de Sharpe et volatilité (écart-type avec ddof=1 comme pandas)
+        daily_rf = RISK_FREE_RATE_ANNUAL / TRADING_DAYS
+        mean_return = filled.sum(axis=0) / n_obs
+        deviations = np.where(available, values - mean_return, 0)
+        std_dev = np.sqrt((deviations ** 2).sum(axis=0) / (n_obs - 1))
+        sharpe = np.where(std_dev == 0, np.nan, (mean_return - daily_rf) / std_dev * np.sqrt(TRADING_DAYS))
+        volatility = std_dev * np.sqrt(TRADING_DAYS)
+
+        # Rendement cumulé et max drawdown (un jour sans donnée laisse la valeur inchangée)
+        portfolio_values = np.cumprod(1 + filled, axis=0)
+        running_max = np.maximum.accumulate(portfolio_values, axis=0)
+        drawdown = np.where(available, (running_max - portfolio_values) / running_max, 0)
+        cumulative_return = np.where(n_obs > 0, portfolio_values[-1] - 1, np.nan) if len(values) else np.nan
+        max_drawdown = np.where(n_obs > 0, drawdown.max(axis=0, initial=0), np.nan)
+
+        # Bêta : covariance (ddof=1) sur variance du benchmark (ddof=0) aux dates communes
+        beta = np.full(values.shape[1], np.nan)
+        if benchmark_df is not None and not benchmark_df.empty:
+            benchmark = (benchmark_df.set_index('date')['return']
+                         .reindex(portfolio_returns.index).to_numpy(dtype=float))
+            common = available & ~np.isnan(benchmark)[:, None]
+            n_common = common.sum(axis=0)
+            bench = np.where(common, benchmark[:, None], 0)
+            port = np.where(common, values, 0)
+            mean_bench = bench.sum(axis=0) / n_common
+            mean_port = port.sum(axis=0) / n_common
+            bench_dev = np.where(common, bench - mean_bench, 0)
+            port_dev = np.where(common, port - mean_port, 0)
+            cov = (port_dev * bench_dev).sum(axis=0) / (n_common - 1)
+            var = (bench_dev ** 2).sum(axis=0) / n_common
+            beta = np.where((n_common > 0) & (var != 0), cov / var, np.nan)
+
+    metrics = pd.DataFrame({
+        'sharpe_ratio': sharpe,
+        'volatility': volatility,
+        'cumulative_return': cumulative_return,
+        'max_drawdown': max_drawdown,
+        'beta': beta,
+    }, index=portfolio_returns.columns)
+    metrics.index.name = 'wallet_id'
+    return metrics
+
+def extract_portfolio_returns(portfolio_returns, wallet_id):
+    """
+    Extraire d'un tableau (dates x wallet_id) les retours d'un portefeuille,
+    au même format que get_portfolio_returns (colonnes date et return).
+    """
+    if portfolio_returns.empty or wallet_id not in portfolio_returns.columns:
+        return pd.DataFrame()
+    df = portfolio_returns[wallet_id].dropna().rename('return').rename_axis('date').reset_index()
+    return df
+
+@timed_phase("reporting")
+def get_all_metrics(conn, benchmark_df=None):
+    """
+    Calculer la table des métriques de tous les portefeuilles (une ligne par portefeuille),
+    avec le nom du portefeuille en première colonne.
+    """
+    portfolio_returns = get_all_portfolio_returns(conn, weighting=PORTFOLIO_WEIGHTING)
+    if portfolio_returns.empty:
+        return pd.DataFrame()
+    metrics = compute_all_metrics(portfolio_returns, benchmark_df)
+    wallet_names = {wallet_id: wallet_name for wallet_name, wallet_id in get_portfolio_ids(conn).items()}
+    metrics.insert(0, 'wallet_name', metrics.index.map(wallet_names))
+    return metrics
+
 def display_portfolio_content(conn, wallet_name):
     """
     Affiche le contenu du portefeuille spécifié par wallet_name.
@@ -226,7 +610,7 @@ def display_portfolio_content(conn, wallet_name):
     product_names = [product_dict.get(pid, f"ID {pid}") for pid in product_ids]
     print(f"Portefeuille {wallet_name} contient : {product_names}")
         
-def get_recent_deals(conn, wallet_id, limit=50):
+def get_recent_deals(conn, wallet_id, limit=50, offset=0):
     """
     Retourne les derniers deals pour le portefeuille spécifié (wallet_id).
 
@@ -240,6 +624,7 @@ def get_recent_deals(conn, wallet_id, limit=50):
         conn (sqlite3.Connection): La connexion à la base de données.
         wallet_id (int): L'identifiant du portefeuille.
         limit (int): Le nombre maximum de deals à retourner.
+        offset (int): Le nombre de deals récents à sauter (pagination).
 
     Returns:
         DataFrame: Un DataFrame contenant les deals triés par date décroissante.
@@ -249,10 +634,10 @@ def get_recent_deals(conn, wallet_id, limit=50):
     FROM Deals d
     JOIN Products pr ON d.product_id = pr.product_id
     WHERE d.wallet_id = ?
-    ORDER BY d.date DESC
-    LIMIT ?
+    ORDER BY d.date DESC, d.deal_id DESC
+    LIMIT ? OFFSET ?
     """
-    df_deals = pd.read_sql_query(query, conn, params=(wallet_id, limit))
+    df_deals = pd.read_sql_query(query, conn, params=(wallet_id, limit, offset))
     if not df_deals.empty:
         # On calcule d'abord l'opération à partir du signe original de qty
         df_deals['operation'] = df_deals['qty'].apply(lambda x: "Achat" if x > 0 else ("Vente" if x < 0 else "Inconnu"))
@@ -260,6 +645,7 @@ def get_recent_deals(conn, wallet_id, limit=50):
         df_deals['qty'] = df_deals['qty'].abs()
     return df_deals
     
+@timed_phase("reporting")
 def main():
     # Connexion à la base de données
     conn = connect_db(DB_PATH)
@@ -283,8 +669,8 @@ def main():
         else:
             print(df_deals.to_string(index=False))
     
-    # Récupération des données du SP500 pour le calcul du bêta
-    sp500_df = get_sp500_returns()
+    # Récupération des données du SP500 pour le calcul du bêta (cache local)
+    sp500_df = get_sp500_returns(conn)
     if sp500_df.empty:
         print("Impossible de récupérer les données du SP500 pour le calcul du bêta.")
     
@@ -296,34 +682,23 @@ def main():
     volatilities    = {}
     max_drawdowns   = {}
     
-    # Calcul des métriques pour chaque portefeuille
+    # Calcul des métriques de tous les portefeuilles en une seule passe (pondération par les positions)
+    portfolio_returns = get_all_portfolio_returns(conn, weighting=PORTFOLIO_WEIGHTING)
+    metrics = compute_all_metrics(portfolio_returns, sp500_df) if not portfolio_returns.empty else pd.DataFrame()
     for wallet_name, wallet_id in portfolios.items():
-        df = get_portfolio_returns(conn, wallet_id)
+        df = extract_portfolio_returns(portfolio_returns, wallet_id)
         if df.empty:
             print(f"Aucune donnée de retour pour le portefeuille {wallet_name}.")
             continue
-        
-        # Calcul du ratio de Sharpe
-        sharpe = compute_sharpe_ratio(df['return'])
-        sharpe_ratios[wallet_name] = sharpe
-        
-        # Calcul de la volatilité annualisée
-        vol = compute_volatility(df['return'])
-        volatilities[wallet_name] = vol
-        
-        # Calcul du rendement cumulé
-        df = compute_cumulative_returns(df)
-        cumulative_data[wallet_name] = df
-        final_cum_returns[wallet_name] = df['cum_return'].iloc[-1]
-        
-        # Calcul du max drawdown
-        max_dd = compute_max_drawdown(df)
-        max_drawdowns[wallet_name] = max_dd
-        
-        # Calcul du bêta avec le SP500
+
+        wallet_metrics = metrics.loc[wallet_id]
+        sharpe_ratios[wallet_name] = wallet_metrics['sharpe_ratio']
+        volatilities[wallet_name] = wallet_metrics['volatility']
+        cumulative_data[wallet_name] = compute_cumulative_returns(df)
+        final_cum_returns[wallet_name] = wallet_metrics['cumulative_return']
+        max_drawdowns[wallet_name] = wallet_metrics['max_drawdown']
         if not sp500_df.empty:
-            beta = compute_beta(df, sp500_df)
-            betas[wallet_name] = beta
+            betas[wallet_name] = wallet_metrics['beta']
 
     # Affichage des résultats
     print("\n=== Ratio de Sharpe par portefeuille ===")
@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+from statistics import NormalDist
+from numpy.lib.stride_tricks import sliding_window_view
+import performances
+
+# Analyse de risque vectorisée pour tous les portefeuilles à la fois.
+# Les entrées sont des tableaux de retours journaliers (dates x portefeuilles), comme ceux de
+# performances.get_all_portfolio_returns ; une valeur manquante signifie que le portefeuille n'a
+# pas de retour ce jour-là. Les fenêtres glissantes sont calculées par différences de sommes
+# cumulées (moyenne, écart-type, bêta) ou par vues glissantes sans copie (quantiles), jamais par
+# un apply pandas fenêtre par fenêtre. Une fenêtre n'a de valeur que si toutes ses dates en ont une.
+
+# Niveau de confiance par défaut de la VaR et de la CVaR
+VAR_LEVEL = 0.95
+
+# Nombre maximal de valeurs traitées à la fois par les quantiles glissants (borne la mémoire)
+quantile_chunk_size = 2_000_000
+
+# Fonction pour calculer les sommes glissantes d'un tableau (lignes = dates) par différence de sommes cumulées
+def _rolling_sum(values, window):
+    cumulative = np.cumsum(np.vstack([np.zeros((1,) + values.shape[1:]), values]), axis=0)
+    sums = np.full(values.shape, np.nan)
+    if window <= len(values):
+        sums[window - 1:] = cumulative[window:] - cumulative[:-window]
+    return sums
+
+# Fonction pour calculer la moyenne et l'écart-type glissants (ddof=1) des colonnes
+def _rolling_moments(values, window, available=None):
+    available = ~np.isnan(values) if available is None else available
+    filled = np.where(available, values, 0)
+    complete = _rolling_sum(available.astype(float), window) == window
+    mean = _rolling_sum(filled, window) / window
+    with np.errstate(invalid='ignore'):
+        variance = (_rolling_sum(filled ** 2, window) - window * mean ** 2) / (window - 1)
+    # Les erreurs d'arrondi des sommes cumulées peuvent donner une variance très légèrement négative
+    std = np.sqrt(np.maximum(variance, 0))
+    return np.where(complete, mean, np.nan), np.where(complete, std, np.nan)
+
+def _benchmark_values(portfolio_returns, benchmark_df):
+    return benchmark_df.set_index('date')['return'].reindex(portfolio_returns.index).to_numpy(dtype=float)
+
+def rolling_volatility(portfolio_returns, window=63):
+    """
+    Volatilité annualisée glissante de chaque portefeuille.
+    """
+    _, std = _rolling_moments(portfolio_returns.to_numpy(dtype=float), window)
+    return pd.DataFrame(std * np.sqrt(performances.TRADING_DAYS), index=portfolio_returns.index,
+                        columns=portfolio_returns.columns)
+
+def rolling_sharpe(portfolio_returns, window=63):
+    """
+    Ratio de Sharpe annualisé glissant, avec les conventions de performances.compute_sharpe_ratio.
+    """
+    daily_rf = performances.RISK_FREE_RATE_ANNUAL / performances.TRADING_DAYS
+    mean, std = _rolling_moments(portfolio_returns.to_numpy(dtype=float), window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sharpe = np.where(std == 0, np.nan, (mean - daily_rf) / std * np.sqrt(performances.TRADING_DAYS))
+    return pd.DataFrame(sharpe, index=portfolio_returns.index, columns=portfolio_returns.columns)
+
+def rolling_beta(portfolio_returns, benchmark_df, window=63):
+    """
+    Bêta glissant par rapport au benchmark (DataFrame date, return), avec les conventions de
+    performances.compute_beta : covariance (ddof=1) sur variance du benchmark (ddof=0).
+    """
+    values = portfolio_returns.to_numpy(dtype=float)
+    benchmark = np.broadcast_to(_benchmark_values(portfolio_returns, benchmark_df)[:, None], values.shape)
+    common = ~np.isnan(values) & ~np.isnan(benchmark)
+    port = np.where(common, values, 0)
+    bench = np.where(common, benchmark, 0)
+    complete = _rolling_sum(common.astype(float), window) == window
+    mean_port = _rolling_sum(port, window) / window
+    mean_bench = _rolling_sum(bench, window) / window
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = (_rolling_sum(port * bench, window) - window * mean_port * mean_bench) / (window - 1)
+        var = _rolling_sum(bench ** 2, window) / window - mean_bench ** 2
+        beta = np.where(complete & (var > 0), cov / var, np.nan)
+    return pd.DataFrame(beta, index=portfolio_returns.index, columns=portfolio_returns.columns)
+
+def rolling_var(portfolio_returns, window=252, level=VAR_LEVEL):
+    """
+    VaR historique glissante (perte positive au niveau `level`) de chaque portefeuille, par
+    quantile sur une vue glissante des retours, calculée par blocs de dates pour borner la mémoire.
+    """
+    values = portfolio_returns.to_numpy(dtype=float)
+    result = np.full(values.shape, np.nan)
+    if window <= len(values) and values.shape[1]:
+        windows = sliding_window_view(values, window, axis=0)
+        chunk = max(1, quantile_chunk_size // (window * values.shape[1]))
+        for start in range(0, len(windows), chunk):
+            block = windows[start:start + chunk]
+            # np.quantile renvoie NaN dès qu'une valeur manque : seules les fenêtres complètes ont une VaR
+            result[window - 1 + start:window - 1 + start + len(block)] = -np.quantile(block, 1 - level, axis=-1)
+    return pd.DataFrame(result, index=portfolio_returns.index, columns=portfolio_returns.columns)
+
+def compute_risk_metrics(portfolio_returns, benchmark_df=None, level=VAR_LEVEL):
+    """
+    Calculer les métriques de risque de tous les portefeuilles sur toute la période :
+    VaR et CVaR historiques et paramétriques (loi normale) au niveau `level`, exprimées en perte
+    positive, ratio de Sortino, ratio de Calmar et ratio d'information par rapport au benchmark.
+    Le résultat est une DataFrame indexée par wallet_id.
+    """
+    values = portfolio_returns.to_numpy(dtype=float)
+    available = ~np.isnan(values)
+    n_obs = available.sum(axis=0)
+    filled = np.where(available, values, 0)
+    daily_rf = performances.RISK_FREE_RATE_ANNUAL / performances.TRADING_DAYS
+    normal = NormalDist()
+    z = normal.inv_cdf(1 - level)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # VaR et CVaR historiques : quantile des retours et moyenne des retours au-delà
+        quantile = np.full(values.shape[1], np.nan)
+        observed = n_obs > 0
+        if len(values) and observed.any():
+            quantile[observed] = np.nanquantile(values[:, observed], 1 - level, axis=0)
+        tail = available & (values <= quantile)
+        cvar_historical = -np.where(tail, values, 0).sum(axis=0) / tail.sum(axis=0)
+
+        # VaR et CVaR paramétriques (loi normale de même moyenne et écart-type)
+        mean = filled.sum(axis=0) / n_obs
+        std = np.sqrt((np.where(available, values - mean, 0) ** 2).sum(axis=0) / (n_obs - 1))
+        var_parametric = -(mean + z * std)
+        cvar_parametric = -(mean - std * normal.pdf(z) / (1 - level))
+
+        # Sortino : rendement excédentaire sur écart-type des seuls retours sous le taux sans risque
+        downside = np.where(available, np.minimum(values - daily_rf, 0), 0)
+        downside_deviation = np.sqrt((downside ** 2).sum(axis=0) / n_obs)
+        sortino = np.where(downside_deviation == 0, np.nan,
+                           (mean - daily_rf) / downside_deviation * np.sqrt(performances.TRADING_DAYS))
+
+        # Calmar : rendement annualisé sur max drawdown (mêmes conventions que compute_all_metrics)
+        metrics = performances.compute_all_metrics(portfolio_returns)
+        annual_return = (1 + metrics['cumulative_return'].to_numpy()) ** (performances.TRADING_DAYS / n_obs) - 1
+        max_drawdown = metrics['max_drawdown'].to_numpy()
+        calmar = np.where(max_drawdown > 0, annual_return / max_drawdown, np.nan)
+
+        # Ratio d'information : rendement actif moyen sur son écart-type, aux dates communes
+        information_ratio = np.full(values.shape[1], np.nan)
+        if benchmark_df is not None and not benchmark_df.empty:
+            active = values - _benchmark_values(portfolio_returns, benchmark_df)[:, None]
+            common = ~np.isnan(active)
+            n_common = common.sum(axis=0)
+            active_mean = np.where(common, active, 0).sum(axis=0) / n_common
+            active_std = np.sqrt((np.where(common, active - active_mean, 0) ** 2).sum(axis=0) / (n_common - 1))
+            information_ratio = np.where(active_std > 0,
+                                         active_mean / active_std * np.sqrt(performances.TRADING_DAYS), np.nan)
+
+    risk_metrics = pd.DataFrame({
+        'var_historical': -quantile,
+        'cvar_historical': cvar_historical,
+        'var_parametric': var_parametric,
+        'cvar_parametric': cvar_parametric,
+        'sortino_ratio': sortino,
+        'calmar_ratio': calmar,
+        'information_ratio': information_ratio,
+    }, index=portfolio_returns.columns)
+    risk_metrics.index.name = 'wallet_id'
+    return risk_metrics
+
+def compute_rolling_risk(portfolio_returns, benchmark_df=None, window=63, var_window=252, level=VAR_LEVEL):
+    """
+    Calculer toutes les courbes de risque glissantes de tous les portefeuilles : dictionnaire
+    {nom: DataFrame dates x portefeuilles} avec sharpe_ratio, volatility, var_historical et,
+    si un benchmark est fourni, beta.
+    """
+    curves = {
+        'sharpe_ratio': rolling_sharpe(portfolio_returns, window),
+        'volatility': rolling_volatility(portfolio_returns, window),
+        'var_historical': rolling_var(portfolio_returns, var_window, level),
+    }
+    if benchmark_df is not None and not benchmark_df.empty:
+        curves['beta'] = rolling_beta(portfolio_returns, benchmark_df, window)
+    return curves
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+# Calendriers de bourse, dates de rebalancement et fenêtres glissantes (walk-forward).
+# Un calendrier est un DatetimeIndex trié de jours de bourse (par exemple l'index de la matrice
+# des rendements). Sans calendrier, les dates de rebalancement sont des dates calendaires,
+# comme dans la boucle historique (chaque lundi) ; avec un calendrier, chaque date est reportée
+# au jour de bourse suivant.
+
+# Fréquences de rebalancement acceptées ("signal" : date candidate chaque jour, rebalancement
+# seulement si une décision atteint le seuil, voir trigger_rows)
+frequencies = {
+    "daily": "D",
+    "weekly": "W-MON",
+    "monthly": "MS",
+    "signal": "D",
+}
+
+# Fonction pour construire un calendrier de bourse (jours ouvrés hors jours fériés)
+def trading_calendar(start_date, end_date, holidays=(), weekmask="Mon Tue Wed Thu Fri"):
+    return pd.bdate_range(start_date, end_date, freq='C', holidays=list(holidays), weekmask=weekmask)
+
+# Fonction pour calculer les dates de rebalancement entre deux dates
+def rebalance_dates(start_date, end_date, frequency="weekly", calendar=None):
+    """
+    Retourner les dates de rebalancement (DatetimeIndex) : chaque jour, chaque lundi ou chaque
+    premier jour du mois. Avec un calendrier, chaque date est reportée au premier jour de bourse
+    qui la suit (un lundi férié devient le mardi) et les doublons sont retirés.
+    """
+    if frequency not in frequencies:
+        raise ValueError(f"Fréquence '{frequency}' inconnue ({', '.join(frequencies)})")
+    dates = pd.date_range(start_date, end_date, freq=frequencies[frequency])
+    if calendar is None:
+        return dates
+    calendar = pd.DatetimeIndex(calendar)
+    calendar = calendar[(calendar >= pd.Timestamp(start_date)) & (calendar <= pd.Timestamp(end_date))]
+    if frequency in ("daily", "signal"):
+        return calendar
+    positions = np.searchsorted(calendar.values, dates.values, side='left')
+    return calendar[np.unique(positions[positions < len(calendar)])]
+
+# Fonction pour trouver, pour chaque date de rebalancement, la dernière ligne de rendements disponible (-1 si aucune)
+def schedule_rows(returns_dates, dates):
+    return np.searchsorted(np.asarray(returns_dates), pd.DatetimeIndex(dates).values, side='right') - 1
+
+# Fonction pour ne garder que les rebalancements déclenchés par le signal (les autres lignes valent -1)
+def trigger_rows(decisions, rows, threshold):
+    """
+    Une date est retenue si la plus forte décision (en valeur absolue) atteint `threshold`.
+    `decisions` est la matrice (dates x produits) du moteur vectorisé, `rows` ses lignes.
+    """
+    rows = np.asarray(rows)
+    valid = rows >= 0
+    magnitude = np.zeros(len(rows))
+    if valid.any() and decisions.shape[1]:
+        selected = np.abs(decisions[rows[valid]])
+        magnitude[valid] = np.where(np.isnan(selected), 0, selected).max(axis=1)
+    return np.where(valid & (magnitude >= threshold), rows, -1)
+
+# Fonction pour découper un calendrier en fenêtres d'apprentissage et de test successives
+def walk_forward_windows(calendar, train_size, test_size, step=None, anchored=False, start_date=None, end_date=None):
+    """
+    Retourner la liste des fenêtres (train_start, train_end, test_start, test_end) : train_size
+    jours de bourse d'apprentissage suivis de test_size jours de test, décalées de `step` jours
+    (test_size par défaut). Avec anchored=True, l'apprentissage commence toujours au début du
+    calendrier (fenêtre croissante).
+    """
+    calendar = pd.DatetimeIndex(calendar)
+    if start_date is not None:
+        calendar = calendar[calendar >= pd.Timestamp(start_date)]
+    if end_date is not None:
+        calendar = calendar[calendar <= pd.Timestamp(end_date)]
+    step = step or test_size
+    windows = []
+    train_start = 0
+    test_start = train_size
+    while test_start < len(calendar):
+        test_end = min(test_start + test_size, len(calendar)) - 1
+        windows.append((calendar[0 if anchored else train_start], calendar[test_start - 1],
+                        calendar[test_start], calendar[test_end]))
+        train_start += step
+        test_start += step
+    return windows
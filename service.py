@@ -0,0 +1,353 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import pandas as pd
+import accumulators
+import performances
+import risk
+import snapshot
+from connections import open_reader
+from holdings import get_positions
+
+# Service HTTP/JSON en lecture seule sur la base des portefeuilles (asyncio, bibliothèque standard).
+# Routes (GET ou HEAD) :
+#   /wallets                        portefeuilles (paginé)
+#   /wallets/{id}                   un portefeuille et la liste de ses produits
+#   /wallets/{id}/holdings          positions courantes (table Holdings, paginé)
+#   /wallets/{id}/deals             derniers deals, comme performances.get_recent_deals (paginé)
+#   /wallets/{id}/metrics           métriques de performance et de risque d'un portefeuille
+#   /metrics                        métriques de tous les portefeuilles (paginé)
+# Pagination par ?limit=&offset= ; la réponse indique total et offset suivant.
+#
+# Toutes les requêtes SQLite passent par un seul thread et une seule connexion en lecture seule :
+# la boucle asyncio ne fait que lire et écrire les sockets. Les réponses sont mises en cache par
+# (chemin, paramètres) pour la version courante de la base (performances.get_db_version, vérifiée
+# au plus toutes les version_check_interval secondes : nouveaux deals et rendements, compteurs de
+# modifications de Deals, Returns, Portfolios, Products et Managers) ; l'ETag dérive de cette version, un client
+# qui renvoie If-None-Match reçoit 304 sans qu'aucune requête ne soit exécutée. Les métriques
+# sont calculées une fois par version de la base pour tous les portefeuilles ; celles de performance
+# sont tenues à jour en flux (accumulators.refresh_wallet_metrics, nouvelles dates seulement).
+
+# Taille de page par défaut et maximale
+default_page_size = 100
+max_page_size = 1000
+
+# Nombre maximal de réponses gardées en cache (les plus anciennes sont retirées)
+cache_size = 1024
+
+# Délai (s) pendant lequel la version de la base est considérée comme inchangée
+version_check_interval = 0.5
+
+# Taille maximale des en-têtes d'une requête HTTP
+max_header_size = 65536
+
+status_reasons = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+                  405: "Method Not Allowed", 500: "Internal Server Error"}
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+# Fonction pour convertir une DataFrame en liste de dictionnaires JSON (NaN -> null, types numpy -> Python)
+def _records(df):
+    if df.empty:
+        return []
+    return json.loads(df.to_json(orient='records', date_format='iso', double_precision=15))
+
+# Fonction pour lire un paramètre entier de la requête
+def _int_parameter(query, name, default, minimum=0, maximum=None):
+    values = query.get(name)
+    if not values:
+        return default
+    try:
+        value = int(values[0])
+    except ValueError:
+        raise HttpError(400, f"Paramètre '{name}' invalide : {values[0]}")
+    if value < minimum or (maximum is not None and value > maximum):
+        raise HttpError(400, f"Paramètre '{name}' hors limites : {value}")
+    return value
+
+# Fonction pour construire le corps JSON d'une erreur
+def _error_body(message):
+    return json.dumps({"error": message}, ensure_ascii=False).encode()
+
+def _page(query):
+    return (_int_parameter(query, 'limit', default_page_size, 1, max_page_size),
+            _int_parameter(query, 'offset', 0))
+
+def _paginated(items, total, limit, offset):
+    next_offset = offset + limit if offset + limit < total else None
+    return {"items": items, "total": total, "limit": limit, "offset": offset, "next_offset": next_offset}
+
+class PortfolioService:
+    def __init__(self, database=performances.DB_PATH):
+        self.database = database
+        # Service en lecture seule : aucun instantané n'est écrit à côté de la base
+        snapshot.disable_updates()
+        # Un seul thread pour SQLite : la connexion, le cache et la version n'ont pas besoin de verrou
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="service-sqlite")
+        self._conn = None
+        self._cache = OrderedDict()
+        self._version = None
+        self._version_checked = 0.0
+        self._metrics = None
+        self._wallet_accumulator = None
+        self.routes = [
+            (re.compile(r"^/wallets$"), self.wallets),
+            (re.compile(r"^/wallets/(\d+)$"), self.wallet),
+            (re.compile(r"^/wallets/(\d+)/holdings$"), self.holdings),
+            (re.compile(r"^/wallets/(\d+)/deals$"), self.deals),
+            (re.compile(r"^/wallets/(\d+)/metrics$"), self.wallet_metrics),
+            (re.compile(r"^/metrics$"), self.all_metrics),
+        ]
+
+    def _reader(self):
+        if self._conn is None:
+            self._conn = open_reader(self.database)
+        return self._conn
+
+    def current_version(self):
+        """Version de la base ; un changement vide le cache des réponses et des métriques."""
+        now = time.monotonic()
+        if self._version is None or now - self._version_checked >= version_check_interval:
+            version = performances.get_db_version(self._reader())
+            self._version_checked = now
+            if version != self._version:
+                self._version = version
+                self._cache.clear()
+                self._metrics = None
+        return self._version
+
+    def handle(self, target, if_none_match=None):
+        """
+        Traiter une requête GET (exécuté dans le thread SQLite) : retourne (statut, ETag, corps JSON).
+        """
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        key = (url.path, tuple(sorted((name, tuple(values)) for name, values in query.items())))
+        try:
+            version = self.current_version()
+            etag = '"' + hashlib.sha1(repr((version, key)).encode()).hexdigest()[:20] + '"'
+            if if_none_match is not None and etag in [tag.strip() for tag in if_none_match.split(",")]:
+                return 304, etag, b""
+            body = self._cache.get(key)
+            if body is not None:
+                self._cache.move_to_end(key)
+                return 200, etag, body
+            for pattern, handler in self.routes:
+                match = pattern.match(url.path)
+                if match:
+                    payload = handler(query, *(int(group) for group in match.groups()))
+                    break
+            else:
+                raise HttpError(404, f"Route inconnue : {url.path}")
+        except HttpError as e:
+            return e.status, None, _error_body(e.message)
+        except sqlite3.Error as e:
+            print(f"Erreur SQLite : {e}")
+            return 500, None, _error_body("Erreur de lecture de la base")
+
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        self._cache[key] = body
+        if len(self._cache) > cache_size:
+            self._cache.popitem(last=False)
+        return 200, etag, body
+
+    def _check_wallet(self, wallet_id):
+        row = self._reader().execute(
+            "SELECT wallet_id, wallet_name, risk_profile FROM Portfolios WHERE wallet_id = ?", (wallet_id,)
+        ).fetchone()
+        if row is None:
+            raise HttpError(404, f"Portefeuille {wallet_id} introuvable")
+        return row
+
+    def wallets(self, query):
+        limit, offset = _page(query)
+        conn = self._reader()
+        total = conn.execute("SELECT COUNT(*) FROM Portfolios").fetchone()[0]
+        df = pd.read_sql_query("""
+        SELECT p.wallet_id, p.wallet_name, p.risk_profile,
+               (SELECT MIN(m.manager_name) FROM Managers m WHERE m.wallets_managed_id = p.wallet_id) AS manager_name
+        FROM Portfolios p
+        ORDER BY p.wallet_id
+        LIMIT ? OFFSET ?
+        """, conn, params=(limit, offset))
+        return _paginated(_records(df), total, limit, offset)
+
+    def wallet(self, query, wallet_id):
+        wallet_id, wallet_name, risk_profile = self._check_wallet(wallet_id)
+        conn = self._reader()
+        product_ids = performances.get_products_for_wallet(conn, wallet_id)
+        products = pd.read_sql_query("SELECT product_id, ticker, name FROM Products", conn).set_index('product_id')
+        products = products.reindex([product_id for product_id in product_ids if product_id in products.index])
+        return {"wallet_id": wallet_id, "wallet_name": wallet_name, "risk_profile": risk_profile,
+                "products": _records(products.reset_index())}
+
+    def holdings(self, query, wallet_id):
+        # Positions tenues à jour à chaque deal dans la table Holdings (holdings.record_holdings) ;
+        # une base non migrée n'a pas cette table : les positions sont alors recalculées depuis Deals
+        self._check_wallet(wallet_id)
+        limit, offset = _page(query)
+        conn = self._reader()
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Holdings'").fetchone():
+            positions = get_positions(conn.cursor(), wallet_id)
+        else:
+            positions = dict(conn.execute(
+                "SELECT product_id, SUM(qty) FROM Deals WHERE wallet_id = ? GROUP BY product_id", (wallet_id,)
+            ).fetchall())
+        held = sorted(product_id for product_id, qty in positions.items() if qty)
+        page = held[offset:offset + limit]
+        placeholders = ",".join("?" for _ in page)
+        products = {product_id: (ticker, name) for product_id, ticker, name in conn.execute(
+            f"SELECT product_id, ticker, name FROM Products WHERE product_id IN ({placeholders})", page
+        )} if page else {}
+        items = [{"product_id": product_id, "ticker": products.get(product_id, (None, None))[0],
+                  "product_name": products.get(product_id, (None, None))[1], "qty": positions[product_id]}
+                 for product_id in page]
+        return _paginated(items, len(held), limit, offset)
+
+    def deals(self, query, wallet_id):
+        self._check_wallet(wallet_id)
+        limit, offset = _page(query)
+        conn = self._reader()
+        total = conn.execute("SELECT COUNT(*) FROM Deals WHERE wallet_id = ?", (wallet_id,)).fetchone()[0]
+        df = performances.get_recent_deals(conn, wallet_id, limit=limit, offset=offset)
+        return _paginated(_records(df), total, limit, offset)
+
+    def _benchmark_returns(self, conn):
+        # Lecture seule : le benchmark vient de Products ou du cache local, sans téléchargement
+        provider = performances.get_benchmark_provider(conn)
+        if isinstance(provider, performances.ProductBenchmark):
+            return provider.get_returns(conn)
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Benchmarks'").fetchone():
+            return pd.DataFrame()
+        df = pd.read_sql_query("""
+        SELECT date, return_value AS return
+        FROM Benchmarks
+        WHERE benchmark = ? AND date BETWEEN ? AND ?
+        ORDER BY date;
+        """, conn, params=(provider.name, performances.START_DATE, performances.END_DATE))
+        df['date'] = pd.to_datetime(df['date'])
+        return df
+
+    def metrics(self):
+        """Métriques de performance et de risque de tous les portefeuilles, une fois par version de la base."""
+        if self._metrics is None:
+            conn = self._reader()
+            portfolio_returns = performances.get_all_portfolio_returns(conn, weighting=performances.PORTFOLIO_WEIGHTING)
+            if portfolio_returns.empty:
+                self._metrics = pd.DataFrame()
+            else:
+                benchmark = self._benchmark_returns(conn)
+                # Métriques de performance en flux : seules les nouvelles dates sont intégrées à chaque version
+                self._wallet_accumulator = accumulators.refresh_wallet_metrics(
+                    self.database, conn, benchmark, accumulator=self._wallet_accumulator, update=False)
+                if self._wallet_accumulator is not None:
+                    metrics = self._wallet_accumulator.metrics()
+                else:
+                    metrics = performances.compute_all_metrics(portfolio_returns, benchmark)
+                metrics = metrics.join(risk.compute_risk_metrics(portfolio_returns, benchmark))
+                wallet_names = {wallet_id: wallet_name for wallet_name, wallet_id in performances.get_portfolio_ids(conn).items()}
+                metrics.insert(0, 'wallet_name', metrics.index.map(wallet_names))
+                self._metrics = metrics.reset_index()
+        return self._metrics
+
+    def all_metrics(self, query):
+        limit, offset = _page(query)
+        metrics = self.metrics()
+        return _paginated(_records(metrics.iloc[offset:offset + limit]), len(metrics), limit, offset)
+
+    def wallet_metrics(self, query, wallet_id):
+        self._check_wallet(wallet_id)
+        metrics = self.metrics()
+        selected = metrics[metrics['wallet_id'] == wallet_id] if not metrics.empty else metrics
+        if selected.empty:
+            raise HttpError(404, f"Aucune donnée de retour pour le portefeuille {wallet_id}")
+        return _records(selected)[0]
+
+    async def handle_connection(self, reader, writer):
+        """Connexion HTTP/1.1 (keep-alive) : une requête GET ou HEAD après l'autre."""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split("\r\n")
+                parts = lines[0].split()
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                keep_alive = (len(parts) == 3 and parts[2] == "HTTP/1.1"
+                              and headers.get("connection", "").lower() != "close")
+
+                if len(parts) != 3:
+                    status, etag, body = 400, None, _error_body("Requête invalide")
+                elif parts[0] not in ("GET", "HEAD"):
+                    status, etag, body = 405, None, _error_body(f"Méthode {parts[0]} non supportée")
+                else:
+                    try:
+                        status, etag, body = await loop.run_in_executor(
+                            self._executor, self.handle, parts[1], headers.get("if-none-match"))
+                    except Exception as e:
+                        print(f"Erreur lors du traitement de {parts[1]} : {e}")
+                        status, etag, body = 500, None, _error_body("Erreur interne")
+
+                response = [f"HTTP/1.1 {status} {status_reasons.get(status, '')}",
+                            "Content-Type: application/json; charset=utf-8",
+                            f"Content-Length: {len(body)}",
+                            "Cache-Control: no-cache",
+                            f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+                if etag is not None:
+                    response.append(f"ETag: {etag}")
+                writer.write(("\r\n".join(response) + "\r\n\r\n").encode())
+                if parts and parts[0] != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=max_header_size)
+        print(f"Service en écoute sur http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        def close_connection():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        self._executor.submit(close_connection).result()
+        self._executor.shutdown()
+
+if __name__ == "__main__":
+    # Exemple : python service.py project_database.db --port 8000 puis curl http://127.0.0.1:8000/wallets
+    parser = argparse.ArgumentParser(description="Service HTTP/JSON en lecture seule sur la base des portefeuilles")
+    parser.add_argument("database", nargs="?", default=performances.DB_PATH)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    service = PortfolioService(args.database)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
@@ -0,0 +1,78 @@
+import numpy as np
+
+# États glissants incrémentaux des signaux de stratégie.
+# Chaque nouvelle date coûte O(produits), quelle que soit la longueur de l'historique :
+# les fenêtres sont des tampons circulaires et l'écart-type glissant est tenu par des sommes
+# courantes. Les versions vectorisées sur tout l'historique (strategy.momentum_signals,
+# strategy.low_risk_signals...) restent utilisées par le backtest.
+
+# Momentum sur `window` dates, équivalent à pct_change(periods=window).iloc[-1] sur tout l'historique
+class MomentumState:
+    def __init__(self, window, n_products):
+        self.window = window
+        # Tampon des window + 1 dernières valeurs (après report de la dernière valeur connue)
+        self.buffer = np.full((window + 1, n_products), np.nan)
+        self.last_valid = np.full(n_products, np.nan)
+        self.position = 0
+        self.count = 0
+
+    def update(self, row):
+        # pct_change reporte la dernière valeur connue sur les valeurs manquantes
+        row = np.asarray(row, dtype=float)
+        self.last_valid = np.where(np.isnan(row), self.last_valid, row)
+        self.buffer[self.position] = self.last_valid
+        self.position = (self.position + 1) % (self.window + 1)
+        self.count += 1
+
+    def value(self):
+        if self.count <= self.window:
+            return np.full(self.buffer.shape[1], np.nan)
+        # Après une mise à jour, la case suivante contient la valeur d'il y a `window` dates
+        newest = self.buffer[(self.position - 1) % (self.window + 1)]
+        oldest = self.buffer[self.position]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return newest / oldest - 1
+
+# Écart-type glissant sur `window` dates (ddof=1), équivalent à rolling(window).std().iloc[-1]
+class RollingStdState:
+    def __init__(self, window, n_products):
+        self.window = window
+        self.buffer = np.full((window, n_products), np.nan)
+        self.sums = np.zeros(n_products)
+        self.squares = np.zeros(n_products)
+        self.missing = np.zeros(n_products, dtype=int)
+        self.position = 0
+        self.count = 0
+
+    def update(self, row):
+        row = np.asarray(row, dtype=float)
+        if self.count >= self.window:
+            removed = self.buffer[self.position]
+            removed_missing = np.isnan(removed)
+            self.sums -= np.where(removed_missing, 0, removed)
+            self.squares -= np.where(removed_missing, 0, removed ** 2)
+            self.missing -= removed_missing
+        added_missing = np.isnan(row)
+        self.sums += np.where(added_missing, 0, row)
+        self.squares += np.where(added_missing, 0, row ** 2)
+        self.missing += added_missing
+        self.buffer[self.position] = row
+        self.position = (self.position + 1) % self.window
+        self.count += 1
+        # Les sommes courantes sont recalculées à chaque tour complet du tampon pour borner les erreurs d'arrondi
+        if self.position == 0:
+            self.sums = np.nansum(self.buffer, axis=0)
+            self.squares = np.nansum(self.buffer ** 2, axis=0)
+
+    def value(self):
+        # Une valeur manquante dans la fenêtre donne un écart-type manquant (min_periods = window)
+        complete = (self.count >= self.window) & (self.missing == 0)
+        n = self.window
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = (self.squares - self.sums ** 2 / n) / (n - 1)
+        return np.where(complete, np.sqrt(np.maximum(variance, 0)), np.nan)
+
+# Volatilité annualisée glissante, équivalente à rolling(window).std().iloc[-1] * sqrt(252)
+class VolatilityState(RollingStdState):
+    def value(self):
+        return super().value() * np.sqrt(252)
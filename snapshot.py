@@ -0,0 +1,313 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from connections import reader
+
+# Instantané colonnaire (fichiers .npy lus par memmap) de la matrice des rendements et du registre des deals.
+# Le dossier "<base>-snapshot" contient, pour une génération donnée :
+#   returns_values.<gen>.npy  matrice dates x produits (float64, NaN si absent), colonnes triées par ticker
+#   returns_dates.<gen>.npy   dates (datetime64[ns])
+#   deals_<colonne>.<gen>.npy colonnes deal_id, date, wallet_id, manager_id, product_id, qty
+#   meta.json                 génération, tickers, product_id et versions des tables au moment de l'export
+# La lecture ne copie pas les données : les DataFrame retournées s'appuient sur les fichiers.
+#
+# Un seul rafraîchissement à la fois (verrou entre threads et fichier verrou entre processus).
+# Chaque fichier est écrit sous un nom temporaire puis renommé : un lecteur ne voit jamais un
+# fichier partiel. Les fichiers d'une génération remplacée sont gardés generation_grace_period
+# secondes, le temps que les lecteurs qui l'ont choisie (workers du balayage...) les ouvrent.
+# Un processus en lecture seule (tableau de bord, service) appelle disable_updates() : il utilise
+# l'instantané s'il est à jour et lit SQLite sinon, sans rien écrire sur le disque.
+
+snapshot_suffix = "-snapshot"
+deal_columns = ["deal_id", "date", "wallet_id", "manager_id", "product_id", "qty"]
+
+# Délai (s) avant la suppression des fichiers d'une génération remplacée
+generation_grace_period = 600
+
+# Attente maximale (s) du verrou de rafraîchissement, et âge au-delà duquel un verrou est abandonné
+lock_wait_timeout = 30
+stale_lock_age = 300
+
+_settings = {"update": True}
+_refresh_thread_lock = threading.Lock()
+
+# Fonctions pour autoriser ou interdire l'écriture de l'instantané dans le processus courant
+def enable_updates():
+    _settings["update"] = True
+
+def disable_updates():
+    _settings["update"] = False
+
+# Migration 5 : compteurs de modifications de Returns et Deals (mises à jour et suppressions).
+# Les insertions sont repérées par l'identifiant maximal (AUTOINCREMENT ne réutilise jamais un identifiant).
+def create_data_versions(conn):
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS DataVersions (table_name TEXT PRIMARY KEY, changes INTEGER);")
+    cursor.execute("INSERT OR IGNORE INTO DataVersions (table_name, changes) VALUES ('Returns', 0), ('Deals', 0);")
+    for table in ("Returns", "Deals"):
+        for event in ("UPDATE", "DELETE"):
+            cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table.lower()}_{event.lower()}_version AFTER {event} ON {table}
+            BEGIN
+                UPDATE DataVersions SET changes = changes + 1 WHERE table_name = '{table}';
+            END;
+            """)
+
+# Fonction pour lire l'état des tables : {table: [identifiant maximal, nombre de modifications]}
+def get_data_versions(conn):
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'DataVersions'").fetchone():
+        return None
+    changes = dict(conn.execute("SELECT table_name, changes FROM DataVersions").fetchall())
+    max_return_id, max_deal_id = conn.execute(
+        "SELECT (SELECT MAX(id_return) FROM Returns), (SELECT MAX(deal_id) FROM Deals)"
+    ).fetchone()
+    return {
+        "Returns": [max_return_id or 0, changes.get("Returns", 0)],
+        "Deals": [max_deal_id or 0, changes.get("Deals", 0)],
+    }
+
+def get_snapshot_directory(database):
+    return os.path.abspath(database) + snapshot_suffix
+
+def _read_meta(directory):
+    try:
+        with open(os.path.join(directory, "meta.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _path(directory, name, generation):
+    return os.path.join(directory, f"{name}.{generation}.npy")
+
+def _load(directory, name, generation):
+    return np.load(_path(directory, name, generation), mmap_mode='r')
+
+# Fonction pour écrire un tableau de façon atomique (nom temporaire puis renommage)
+def _save(directory, name, generation, values):
+    path = _path(directory, name, generation)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        np.save(f, values)
+    os.replace(temporary, path)
+
+# Verrou de rafraîchissement entre threads et entre processus (fichier créé de façon exclusive)
+@contextmanager
+def _refresh_lock(directory):
+    lock_path = os.path.join(directory, "refresh.lock")
+    with _refresh_thread_lock:
+        deadline = time.monotonic() + lock_wait_timeout
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    # Verrou laissé par un processus interrompu
+                    if time.time() - os.path.getmtime(lock_path) > stale_lock_age:
+                        os.remove(lock_path)
+                        continue
+                except OSError:
+                    continue
+                if time.monotonic() > deadline:
+                    raise OSError("rafraîchissement en cours dans un autre processus")
+                time.sleep(0.05)
+        try:
+            os.write(fd, str(os.getpid()).encode())
+            os.close(fd)
+            yield
+        finally:
+            os.remove(lock_path)
+
+# Fonction pour supprimer les fichiers des générations remplacées depuis plus que le délai de grâce
+def _remove_retired(directory, retired, generation):
+    """
+    `retired` associe chaque génération remplacée (clé texte) à l'heure de son remplacement.
+    Retourne les générations dont des fichiers restent (délai non écoulé ou fichier encore
+    ouvert sous Windows). Les fichiers orphelins (rafraîchissement interrompu) suivent le même délai.
+    """
+    now = time.time()
+    remaining = {}
+    for name in os.listdir(directory):
+        parts = name.split(".")
+        if len(parts) < 3 or parts[-1] not in ("npy", "tmp") or not parts[1].isdigit() or int(parts[1]) == generation:
+            continue
+        path = os.path.join(directory, name)
+        try:
+            retired_at = retired.get(parts[1], os.path.getmtime(path))
+            if now - retired_at > generation_grace_period:
+                os.remove(path)
+                continue
+        except OSError:
+            pass
+        if parts[1] in retired:
+            remaining[parts[1]] = retired[parts[1]]
+    return remaining
+
+# Fonction pour construire la matrice des rendements à partir de lignes (date, product_id, ticker, return_value)
+def _merge_returns(rows, dates=None, values=None, tickers=None, product_ids=None):
+    new_returns = pd.DataFrame(rows, columns=['date', 'product_id', 'ticker', 'return_value'])
+    new_returns['date'] = pd.to_datetime(new_returns['date'])
+    columns = dict(zip(tickers or [], product_ids or []))
+    mapping = pd.concat([pd.DataFrame({'ticker': list(columns), 'product_id': list(columns.values())}),
+                         new_returns[['ticker', 'product_id']]]).drop_duplicates()
+    if mapping['ticker'].duplicated().any() or mapping['product_id'].duplicated().any():
+        raise ValueError("un produit a plusieurs tickers (ou l'inverse) dans la table Returns")
+    columns = dict(zip(mapping['ticker'], mapping['product_id']))
+    all_tickers = sorted(columns)
+    all_dates = pd.DatetimeIndex(new_returns['date'].unique()).union(pd.DatetimeIndex([] if dates is None else dates))
+
+    matrix = np.full((len(all_dates), len(all_tickers)), np.nan)
+    if values is not None and len(dates):
+        matrix[np.ix_(all_dates.get_indexer(dates), pd.Index(all_tickers).get_indexer(tickers))] = values
+    matrix[all_dates.get_indexer(new_returns['date']), pd.Index(all_tickers).get_indexer(new_returns['ticker'])] = \
+        new_returns['return_value'].to_numpy(dtype=float)
+    return all_dates.values, matrix, all_tickers, [int(columns[ticker]) for ticker in all_tickers]
+
+# Fonction pour mettre à jour l'instantané si la base a changé (lecture des seules nouvelles lignes si possible)
+def refresh_snapshot(database, conn=None, update=None):
+    """
+    Mettre l'instantané à jour et retourner ses métadonnées, ou None s'il n'est pas disponible
+    (base non migrée, tickers en double, dossier non accessible en écriture). La connexion
+    fournie est utilisée pour la lecture ; à défaut, le lecteur partagé de la base.
+    Avec update=False (ou après disable_updates()), rien n'est écrit : l'instantané n'est
+    retourné que s'il correspond à la base.
+
+    Si les tables n'ont reçu que des insertions depuis le dernier export, seules les nouvelles
+    lignes sont lues dans SQLite et fusionnées ; sinon (mise à jour ou suppression) la table
+    concernée est réexportée entièrement.
+    """
+    directory = get_snapshot_directory(database)
+    update = _settings["update"] if update is None else update
+    try:
+        conn = conn or reader(database)
+        versions = get_data_versions(conn)
+        if versions is None:
+            return None
+        meta = _read_meta(directory)
+        if meta and meta["versions"] == versions:
+            return meta
+        if not update:
+            return None
+
+        os.makedirs(directory, exist_ok=True)
+        with _refresh_lock(directory):
+            # Une seule transaction de lecture : versions et lignes exportées viennent du même état de la base
+            own_transaction = not conn.in_transaction
+            if own_transaction:
+                conn.execute("BEGIN")
+            try:
+                return _export(directory, conn)
+            finally:
+                if own_transaction:
+                    conn.commit()
+
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"Instantané indisponible : {e}")
+        return None
+
+# Fonction pour écrire une nouvelle génération de l'instantané (appelée sous le verrou, dans une transaction de lecture)
+def _export(directory, conn):
+    versions = get_data_versions(conn)
+    # Un autre rafraîchissement a pu terminer pendant l'attente du verrou
+    meta = _read_meta(directory)
+    if meta and meta["versions"] == versions:
+        return meta
+
+    generation = meta["generation"] + 1 if meta else 1
+    new_meta = {"generation": generation, "versions": versions}
+    max_return_id = versions["Returns"][0]
+    max_deal_id = versions["Deals"][0]
+
+    # Rendements : fusion des nouvelles lignes ou export complet (jamais au-delà de l'identifiant enregistré)
+    returns_append = bool(meta) and meta["versions"]["Returns"][1] == versions["Returns"][1]
+    if returns_append:
+        rows = conn.execute("SELECT date, product_id, ticker, return_value FROM Returns WHERE id_return > ? AND id_return <= ?",
+                            (meta["versions"]["Returns"][0], max_return_id)).fetchall()
+        previous = (_load(directory, "returns_dates", meta["generation"]),
+                    _load(directory, "returns_values", meta["generation"]), meta["tickers"], meta["product_ids"])
+    else:
+        rows = conn.execute("SELECT date, product_id, ticker, return_value FROM Returns WHERE id_return <= ?",
+                            (max_return_id,)).fetchall()
+        previous = ()
+    dates, values, tickers, product_ids = _merge_returns(rows, *previous)
+    _save(directory, "returns_dates", generation, dates.astype('datetime64[ns]'))
+    _save(directory, "returns_values", generation, values)
+    new_meta.update({"tickers": tickers, "product_ids": product_ids})
+
+    # Registre des deals : ajout des nouveaux deals ou export complet
+    deals_append = bool(meta) and meta["versions"]["Deals"][1] == versions["Deals"][1]
+    min_deal_id = meta["versions"]["Deals"][0] if deals_append else 0
+    new_deals = pd.read_sql_query(
+        "SELECT deal_id, date, wallet_id, manager_id, product_id, qty FROM Deals WHERE deal_id > ? AND deal_id <= ? ORDER BY deal_id",
+        conn, params=(min_deal_id, max_deal_id)
+    )
+    new_deals['date'] = pd.to_datetime(new_deals['date'])
+    for column in deal_columns:
+        column_values = new_deals[column].to_numpy(dtype='datetime64[ns]' if column == 'date' else np.int64)
+        if deals_append:
+            column_values = np.concatenate([_load(directory, f"deals_{column}", meta["generation"]), column_values])
+        _save(directory, f"deals_{column}", generation, column_values)
+
+    # La génération précédente reste lisible pendant le délai de grâce
+    retired = dict(meta.get("retired", {})) if meta else {}
+    if meta:
+        retired[str(meta["generation"])] = time.time()
+    new_meta["retired"] = _remove_retired(directory, retired, generation)
+
+    # Les métadonnées sont remplacées en dernier : un lecteur voit l'ancienne ou la nouvelle génération
+    temporary_meta = os.path.join(directory, f"meta.{generation}.tmp")
+    with open(temporary_meta, "w") as f:
+        json.dump(new_meta, f)
+    os.replace(temporary_meta, os.path.join(directory, "meta.json"))
+    return new_meta
+
+# Fonction pour lire la matrice des rendements (dates x tickers) depuis l'instantané, sans copie
+def load_returns(database, conn=None, update=None):
+    """
+    Retourner la matrice des rendements (index 'date', colonnes 'ticker' triées), identique au
+    pivot de la table Returns, et la liste des product_id des colonnes ; ou (None, None).
+    """
+    meta = refresh_snapshot(database, conn, update)
+    if meta is None:
+        return None, None
+    directory = get_snapshot_directory(database)
+    try:
+        values = _load(directory, "returns_values", meta["generation"])
+        dates = _load(directory, "returns_dates", meta["generation"])
+    except OSError:
+        # Génération remplacée entre-temps par un autre processus
+        return None, None
+    returns_matrix = pd.DataFrame(values, index=pd.DatetimeIndex(dates, name='date'),
+                                  columns=pd.Index(meta["tickers"], name='ticker'), copy=False)
+    return returns_matrix, meta["product_ids"]
+
+# Fonction pour obtenir les fichiers de la matrice des rendements à jour (partageables entre processus par memmap)
+def get_returns_files(database, conn=None, update=None):
+    """
+    Retourner (fichier des valeurs, fichier des dates, tickers, product_id) de la génération
+    courante, ou None. Un processus qui a ouvert ces fichiers peut continuer à les lire même
+    si une génération plus récente les remplace (ils sont gardés generation_grace_period secondes).
+    """
+    meta = refresh_snapshot(database, conn, update)
+    if meta is None:
+        return None
+    directory = get_snapshot_directory(database)
+    return (_path(directory, "returns_values", meta["generation"]), _path(directory, "returns_dates", meta["generation"]),
+            meta["tickers"], meta["product_ids"])
+
+# Fonction pour lire le registre des deals (trié par deal_id) depuis l'instantané, sans copie
+def load_deals(database, conn=None, update=None):
+    meta = refresh_snapshot(database, conn, update)
+    if meta is None:
+        return None
+    directory = get_snapshot_directory(database)
+    try:
+        return pd.DataFrame({column: _load(directory, f"deals_{column}", meta["generation"])
+                             for column in deal_columns}, copy=False)
+    except OSError:
+        return None
@@ -2,21 +2,32 @@ import pandas as pd
 import numpy as np
 import sqlite3
 import json
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from holdings import ensure_holdings_tables, record_holdings, get_positions, get_month_deal_count
+from connections import reader, writer, timed_phase
+from snapshot import load_returns
+from signals import MomentumState, VolatilityState
+import scheduler
 
 # Fonction pour récupérer les données de rendement depuis la base de données
-def fetch_returns_from_db(database="project_database.db"):
+def fetch_returns_from_db(database="project_database.db", use_snapshot=True):
+    # Instantané colonnaire à jour : matrice lue par memmap, sans requête ni pivot
+    if use_snapshot:
+        returns_matrix, _ = load_returns(database)
+        if returns_matrix is not None:
+            return returns_matrix
     try:
-        conn = sqlite3.connect(database)
+        # Lecteur partagé en lecture seule : n'attend pas la fin d'une écriture en cours
         query = "SELECT date, ticker, return_value FROM Returns"
-        returns_data = pd.read_sql_query(query, conn, parse_dates=['date'])
-        conn.close()
+        returns_data = pd.read_sql_query(query, reader(database), parse_dates=['date'])
 
-        # Supprimer les doublons en gardant la première occurrence
-        returns_data_deduped = returns_data.drop_duplicates(subset=['date', 'ticker'], keep='first')
+        # Une base non migrée (sans index unique sur (product_id, date)) peut contenir des doublons :
+        # on garde la première occurrence, comme la migration 1
+        returns_data = returns_data.drop_duplicates(subset=['date', 'ticker'], keep='first')
 
         # Pivoter les données pour avoir les dates en index et les tickers en colonnes
-        returns_data_pivot = returns_data_deduped.pivot(index='date', columns='ticker', values='return_value')
+        returns_data_pivot = returns_data.pivot(index='date', columns='ticker', values='return_value')
         return returns_data_pivot
     except sqlite3.Error as e:
         print(f"Erreur SQLite : {e}")
@@ -69,95 +80,156 @@ def high_yield_equity_strategy(returns_data, equity_tickers, momentum_window=10)
 
     return decisions
 
-# Fonction pour enregistrer les transactions dans la base de données
-def record_deals(decisions, date, wallet_id, database="project_database.db", apply_deal_limit=False):
-    try:
-        conn = sqlite3.connect(database)
-        cursor = conn.cursor()
+# Fonction pour enregistrer les transactions d'un portefeuille avec un curseur existant (sans commit)
+def book_wallet_deals(cursor, decisions, date, wallet_id, apply_deal_limit=False):
+    cursor.execute("SELECT manager_id FROM Managers WHERE wallets_managed_id = ?", (wallet_id,))
+    manager_result = cursor.fetchone()
+    if not manager_result:
+        print(f"Aucun manager trouvé pour le portefeuille {wallet_id}")
+        return
 
-        cursor.execute("SELECT manager_id FROM Managers WHERE wallets_managed_id = ?", (wallet_id,))
-        manager_result = cursor.fetchone()
-        if not manager_result:
-            print(f"Aucun manager trouvé pour le portefeuille {wallet_id}")
-            return
+    manager_id = manager_result[0]
+    cursor.execute("SELECT product_id, name FROM Products")
+    product_id_map = {name: product_id for product_id, name in cursor.fetchall()}
 
-        manager_id = manager_result[0]
-        cursor.execute("SELECT product_id, name FROM Products")
-        product_id_map = {name: product_id for product_id, name in cursor.fetchall()}
+    # Positions courantes lues dans la table Holdings, tenue à jour à chaque transaction
+    current_positions = get_positions(cursor, wallet_id)
+
+    # Vérifier le nombre de transactions effectuées dans le mois en cours si la limite doit s'appliquer
+    current_month_deals_count = get_month_deal_count(cursor, wallet_id, date[:7])
+
+    # Limiter le nombre de transactions à 2 si le drapeau est défini
+    if apply_deal_limit and current_month_deals_count >= 2:
+        print(f"Limite de transactions atteinte pour le portefeuille {wallet_id} en {date[:7]}")
+        return
 
-        cursor.execute("""
-            SELECT p.name, SUM(d.qty) as total_qty
-            FROM Deals d JOIN Products p ON d.product_id = p.product_id
-            WHERE d.wallet_id = ? GROUP BY p.name
-        """, (wallet_id,))
-        current_positions = {row[0]: row[1] for row in cursor.fetchall()}
-
-        # Vérifier le nombre de transactions effectuées dans le mois en cours si la limite doit s'appliquer
-        current_month_start = date[:7] + '-01'
-        cursor.execute("""
-            SELECT COUNT(*)
-            FROM Deals
-            WHERE wallet_id = ? AND date >= ?
-        """, (wallet_id, current_month_start))
-        current_month_deals_count = cursor.fetchone()[0]
-
-        # Limiter le nombre de transactions à 2 si le drapeau est défini
+    insert_query = "INSERT INTO Deals (date, wallet_id, manager_id, product_id, qty) VALUES (?, ?, ?, ?, ?);"
+    for product, qty in decisions.items():
+        # Convertir qty en un entier ou un flottant, en s'assurant que c'est un nombre valide
+        try:
+            qty = float(qty)  # Convertir en flottant si possible
+        except ValueError:
+            continue  # Si qty ne peut pas être converti, passer à l'entrée suivante
+
+        qty = min(abs(qty), 100) * np.sign(qty)  # S'assurer de ne pas dépasser 100 en valeur absolue
+
+        # Continuer uniquement si la limite n'est pas atteinte
         if apply_deal_limit and current_month_deals_count >= 2:
             print(f"Limite de transactions atteinte pour le portefeuille {wallet_id} en {date[:7]}")
-            return
-
-        insert_query = "INSERT INTO Deals (date, wallet_id, manager_id, product_id, qty) VALUES (?, ?, ?, ?, ?);"
-        for product, qty in decisions.items():
-            # Convertir qty en un entier ou un flottant, en s'assurant que c'est un nombre valide
-            try:
-                qty = float(qty)  # Convertir en flottant si possible
-            except ValueError:
-                continue  # Si qty ne peut pas être converti, passer à l'entrée suivante
-
-            qty = min(abs(qty), 100) * np.sign(qty)  # S'assurer de ne pas dépasser 100 en valeur absolue
-
-            # Continuer uniquement si la limite n'est pas atteinte
-            if apply_deal_limit and current_month_deals_count >= 2:
-                print(f"Limite de transactions atteinte pour le portefeuille {wallet_id} en {date[:7]}")
-                break  # Arrêter le traitement des transactions suivantes
-
-            product_id = product_id_map.get(product)
-            if product_id:
-                current_position = current_positions.get(product, 0)
-                if qty > 0:
-                    cursor.execute(insert_query, (date, wallet_id, manager_id, product_id, qty))
-                    print(f"Achat de {qty} unités de {product} dans le portefeuille {wallet_id} le {date}")
+            break  # Arrêter le traitement des transactions suivantes
+
+        product_id = product_id_map.get(product)
+        if product_id:
+            current_position = current_positions.get(product_id, 0)
+            if qty > 0:
+                cursor.execute(insert_query, (date, wallet_id, manager_id, product_id, qty))
+                record_holdings(cursor, [(date, wallet_id, manager_id, product_id, qty)])
+                print(f"Achat de {qty} unités de {product} dans le portefeuille {wallet_id} le {date}")
+                current_month_deals_count += 1
+            elif qty < 0:
+                qty_to_sell = min(-qty, current_position)
+                if qty_to_sell > 0:
+                    cursor.execute(insert_query, (date, wallet_id, manager_id, product_id, -qty_to_sell))
+                    record_holdings(cursor, [(date, wallet_id, manager_id, product_id, -qty_to_sell)])
+                    print(f"Vente de {qty_to_sell} unités de {product} dans le portefeuille {wallet_id} le {date}")
                     current_month_deals_count += 1
-                elif qty < 0:
-                    qty_to_sell = min(-qty, current_position)
-                    if qty_to_sell > 0:
-                        cursor.execute(insert_query, (date, wallet_id, manager_id, product_id, -qty_to_sell))
-                        print(f"Vente de {qty_to_sell} unités de {product} dans le portefeuille {wallet_id} le {date}")
-                        current_month_deals_count += 1
-
-        conn.commit()
+
+# Fonction pour enregistrer les transactions dans la base de données
+def record_deals(decisions, date, wallet_id, database="project_database.db", apply_deal_limit=False):
+    try:
+        with writer(database) as conn:
+            ensure_holdings_tables(conn)
+            book_wallet_deals(conn.cursor(), decisions, date, wallet_id, apply_deal_limit)
     except sqlite3.Error as e:
         print(f"Erreur SQLite : {e}")
-    finally:
-        if conn:
-            conn.close()
+
+# Fonction pour calculer les décisions d'un portefeuille (indépendante de la base, exécutable dans un pool)
+def compute_wallet_decisions(risk_profile, filtered_returns, available_tickers):
+    strategy = get_strategy(risk_profile)
+    if strategy is None:
+        return None, False
+    # Seule la fenêtre nécessaire à la stratégie est transmise (utile pour un pool de processus)
+    start = lookback_start(filtered_returns.to_numpy(), len(filtered_returns) - 1, strategy.lookback())
+    return strategy.decide(filtered_returns[available_tickers].iloc[start:]), strategy.apply_deal_limit
+
+# État incrémental des signaux d'un portefeuille : une nouvelle date coûte O(produits)
+class WalletSignalState:
+    """
+    Signaux d'un portefeuille tenus à jour date par date, équivalents à compute_wallet_decisions
+    appliqué à tout l'historique (à l'arrondi près de l'écart-type glissant). Une stratégie non
+    vectorisable est évaluée par decide() sur sa fenêtre d'historique.
+    """
+    def __init__(self, risk_profile, tickers, strategy=None):
+        self.risk_profile = risk_profile
+        self.tickers = list(tickers)
+        self.strategy = strategy or get_strategy(risk_profile)
+        self.last_date = None
+        self.returns_data = None
+        self.states = {}
+        if self.strategy is not None and self.strategy.vectorizable:
+            self.states = {spec: signal_kinds[spec[0]][1](spec[1], len(self.tickers))
+                           for spec in self.strategy.signal_specs()}
+
+    # Fonction pour intégrer les nouvelles lignes de rendements (dates postérieures à last_date)
+    def advance(self, returns_data):
+        if self.strategy is not None and not self.strategy.vectorizable:
+            self.returns_data = returns_data[self.tickers]
+        if self.last_date is not None:
+            returns_data = returns_data[returns_data.index > self.last_date]
+        if returns_data.empty:
+            return
+        for row in returns_data[self.tickers].to_numpy():
+            for state in self.states.values():
+                state.update(row)
+        self.last_date = returns_data.index[-1]
+
+    # Fonction pour obtenir les décisions à la dernière date intégrée, au format de compute_wallet_decisions
+    def decisions(self):
+        if self.strategy is None:
+            return None, False
+        if not self.strategy.vectorizable:
+            return compute_wallet_decisions(self.risk_profile, self.returns_data, self.tickers)
+        if self.last_date is None:
+            return {}, self.strategy.apply_deal_limit
+        signals = {spec: state.value()[None, :] for spec, state in self.states.items()}
+        decisions = self.strategy.decisions_from_signals(signals)[0]
+        return decisions_to_dict(self.tickers, decisions, self.strategy.sort_by_magnitude), self.strategy.apply_deal_limit
 
 # Fonction pour mettre à jour les portefeuilles
-def update_portfolios(date, database="project_database.db"):
+@timed_phase("strategy")
+def update_portfolios(date, database="project_database.db", max_workers=None, use_threads=False, signal_states=None,
+                      executor=None):
+    """
+    Calculer les décisions de chaque portefeuille à la date donnée puis enregistrer toutes
+    les transactions dans une seule transaction SQLite.
+
+    Avec max_workers > 1, les signaux des portefeuilles (indépendants) sont calculés en
+    parallèle dans un pool de processus (ou de threads si use_threads=True). L'écriture reste
+    faite par une seule connexion, dans l'ordre des portefeuilles, pour éviter toute contention.
+    Un pool déjà ouvert peut être fourni (executor) : il est alors réutilisé au lieu d'être créé
+    pour ce seul appel, ce qui évite de relancer les processus à chaque date.
+
+    Avec signal_states (dictionnaire wallet_id -> WalletSignalState, conservé d'un appel à
+    l'autre), seules les dates postérieures au dernier appel sont intégrées aux signaux : le
+    coût d'un rebalancement ne dépend plus de la longueur de l'historique.
+    """
     try:
         current_date_dt = datetime.strptime(date, '%Y-%m-%d')
-        conn = sqlite3.connect(database)
-        cursor = conn.cursor()
+        cursor = reader(database).cursor()
 
         cursor.execute("SELECT wallet_id, risk_profile, products FROM Portfolios")
         portfolios = cursor.fetchall()
 
+        # Lignes jusqu'à la date (vue sur la matrice, sans copie de l'historique)
         full_returns_data = fetch_returns_from_db(database)
-        returns_data = full_returns_data[full_returns_data.index <= current_date_dt]
+        returns_data = full_returns_data.iloc[:np.searchsorted(full_returns_data.index.values,
+                                                               np.datetime64(current_date_dt), side='right')]
+        returns_values = returns_data.to_numpy()
 
         cursor.execute("SELECT ticker, name FROM Products")
         product_name_map = dict(cursor.fetchall())
 
+        wallet_tasks = []
         for wallet_id, risk_profile, products in portfolios:
             authorized_products_ids = json.loads(products)
             cursor.execute("SELECT ticker FROM Products WHERE product_id IN ({})".format(
@@ -166,41 +238,475 @@ def update_portfolios(date, database="project_database.db"):
             authorized_tickers = [row[0] for row in cursor.fetchall()]
             available_tickers = [ticker for ticker in authorized_tickers if ticker in returns_data.columns]
 
-            if not available_tickers:
+            strategy = get_strategy(risk_profile)
+            if not available_tickers or strategy is None:
                 continue
 
-            filtered_returns = returns_data[available_tickers]
-
-            if risk_profile == "low_risk":
-                decisions = low_risk_strategy(filtered_returns)
-                apply_deal_limit = False  # Pas de limite pour low_risk
-            elif risk_profile == "low_turnover":
-                decisions = low_turnover_strategy(filtered_returns)
-                apply_deal_limit = True  # Appliquer la limite pour low_turnover
-            elif risk_profile == "high_yield_equity_only":
-                decisions = high_yield_equity_strategy(filtered_returns, available_tickers)
-                apply_deal_limit = False  # Pas de limite pour high_yield_equity_only
-            else:
+            # Seule la fenêtre d'historique nécessaire à la stratégie est extraite
+            start = lookback_start(returns_values, len(returns_data) - 1, strategy.lookback(),
+                                   returns_data.columns.get_indexer(available_tickers))
+            wallet_tasks.append((wallet_id, risk_profile, returns_data.iloc[start:][available_tickers], available_tickers))
+
+        # Calcul des signaux : incrémental, en parallèle ou sur tout l'historique
+        task_arguments = [[task[i] for task in wallet_tasks] for i in (1, 2, 3)]
+        if signal_states is not None:
+            results = []
+            for wallet_id, risk_profile, filtered_returns, available_tickers in wallet_tasks:
+                state = signal_states.get(wallet_id)
+                # Nouvel univers de produits ou retour en arrière : l'état est reconstruit sur la fenêtre
+                if (state is None or state.risk_profile != risk_profile or state.tickers != available_tickers
+                        or (state.last_date is not None and state.last_date > current_date_dt)):
+                    state = signal_states[wallet_id] = WalletSignalState(risk_profile, available_tickers)
+                state.advance(filtered_returns)
+                results.append(state.decisions())
+        elif executor is not None and len(wallet_tasks) > 1:
+            results = list(executor.map(compute_wallet_decisions, *task_arguments))
+        elif max_workers and max_workers > 1 and len(wallet_tasks) > 1:
+            executor_class = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+            with executor_class(max_workers=max_workers) as executor:
+                results = list(executor.map(compute_wallet_decisions, *task_arguments))
+        else:
+            results = list(map(compute_wallet_decisions, *task_arguments))
+
+        # Écrivain unique : toutes les transactions de la date sont validées ensemble
+        with writer(database) as conn:
+            ensure_holdings_tables(conn)
+            cursor = conn.cursor()
+            for (wallet_id, _, _, _), (decisions, apply_deal_limit) in zip(wallet_tasks, results):
+                if decisions is None:
+                    continue
+                named_decisions = {product_name_map.get(ticker, ticker): qty for ticker, qty in decisions.items()}
+                book_wallet_deals(cursor, named_decisions, date, wallet_id, apply_deal_limit)
+    except sqlite3.Error as e:
+        print(f"Erreur SQLite : {e}")
+
+# Fonction pour exécuter les mises à jour hebdomadaires
+@timed_phase("strategy")
+def run_weekly_updates(database="project_database.db", vectorized=True, max_workers=None,
+                       start_date=datetime(2023, 1, 1), end_date=datetime(2024, 12, 31), frequency="weekly",
+                       calendar=None, trigger_threshold=None):
+    """
+    Rebalancer les portefeuilles de start_date à end_date (chaque lundi par défaut, voir
+    scheduler.rebalance_dates pour les autres fréquences et les calendriers de bourse).
+    La fréquence "signal" n'est disponible qu'avec le moteur vectorisé.
+    """
+    # Le moteur vectorisé produit exactement les mêmes deals que la boucle historique
+    if vectorized:
+        run_backtest(start_date, end_date, database, frequency=frequency, calendar=calendar,
+                     trigger_threshold=trigger_threshold)
+        return
+    if frequency == "signal":
+        raise ValueError("La fréquence 'signal' nécessite le moteur vectorisé (vectorized=True)")
+
+    # Signaux incrémentaux conservés d'une date à l'autre (sauf calcul parallèle sur tout l'historique)
+    if not (max_workers and max_workers > 1):
+        signal_states = {}
+        for current_date in scheduler.rebalance_dates(start_date, end_date, frequency, calendar):
+            update_portfolios(current_date.strftime('%Y-%m-%d'), database, signal_states=signal_states)
+        return
+
+    # Calcul parallèle : un seul pool de processus pour toutes les dates
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for current_date in scheduler.rebalance_dates(start_date, end_date, frequency, calendar):
+            update_portfolios(current_date.strftime('%Y-%m-%d'), database, max_workers, executor=executor)
+
+#######################################################################
+# Moteur de backtest vectorisé (équivalent à update_portfolios en boucle)
+#######################################################################
+
+# Calcul vectorisé du momentum pour toutes les dates : équivalent à pct_change(periods=window)
+def momentum_signals(returns_matrix, momentum_window):
+    # pct_change remplit les valeurs manquantes avec la valeur précédente avant le calcul
+    filled = pd.DataFrame(returns_matrix).ffill().to_numpy()
+    momentum = np.full(filled.shape, np.nan)
+    if momentum_window < len(filled):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            momentum[momentum_window:] = filled[momentum_window:] / filled[:-momentum_window] - 1
+    return momentum
+
+# Conversion d'un momentum en quantité entière (équivalent à int(momentum * factor))
+def _momentum_to_qty(momentum, factor):
+    with np.errstate(invalid='ignore', over='ignore'):
+        decisions = np.trunc(momentum * factor)
+    # Les momentums non finis ne donnent lieu à aucune décision
+    decisions[~np.isfinite(momentum)] = np.nan
+    return decisions
+
+# Version vectorisée de low_risk_strategy : une ligne de décisions par date
+def low_risk_signals(returns_matrix, volatility_target=0.10, volatility_window=30, momentum_window=30):
+    return LowRiskStrategy(volatility_target=volatility_target, volatility_window=volatility_window,
+                           momentum_window=momentum_window).signals(returns_matrix)
+
+# Version vectorisée de low_turnover_strategy : seules les max_deals_per_month plus fortes décisions sont gardées
+def low_turnover_signals(returns_matrix, momentum_window=30, max_deals_per_month=2):
+    return low_turnover_signals_from_momentum(momentum_signals(returns_matrix, momentum_window), max_deals_per_month)
+
+def low_turnover_signals_from_momentum(momentum, max_deals_per_month=2):
+    decisions = _momentum_to_qty(momentum, 10)
+    magnitude = np.where(np.isnan(decisions), -np.inf, np.abs(decisions))
+    # Tri stable par valeur absolue décroissante, comme sorted(..., reverse=True)
+    ranks = np.argsort(-magnitude, axis=1, kind='stable')[:, :max_deals_per_month]
+    limited = np.full(decisions.shape, np.nan)
+    rows = np.arange(len(decisions))[:, None]
+    limited[rows, ranks] = decisions[rows, ranks]
+    return limited
+
+# Version vectorisée de high_yield_equity_strategy
+def high_yield_equity_signals(returns_matrix, momentum_window=10):
+    return HighYieldEquityStrategy(momentum_window=momentum_window).signals(returns_matrix)
+
+#######################################################################
+# Registre des stratégies (une classe enregistrée par profil de risque)
+#######################################################################
+
+# Stratégies enregistrées, par profil de risque
+strategy_registry = {}
+
+# Décorateur pour enregistrer une stratégie sous son profil de risque
+def register_strategy(strategy_class):
+    strategy_registry[strategy_class.risk_profile] = strategy_class
+    return strategy_class
+
+# Fonction pour instancier la stratégie d'un profil de risque (None si le profil est inconnu)
+def get_strategy(risk_profile, **parameters):
+    strategy_class = strategy_registry.get(risk_profile)
+    return strategy_class(**parameters) if strategy_class else None
+
+# Signaux partagés entre stratégies : calcul vectorisé sur tout l'historique et état incrémental équivalent
+def volatility_signals(returns_matrix, volatility_window):
+    return pd.DataFrame(returns_matrix).rolling(window=volatility_window).std().to_numpy() * np.sqrt(252)
+
+signal_kinds = {
+    "momentum": (momentum_signals, MomentumState),
+    "volatility": (volatility_signals, VolatilityState),
+}
+
+# Signaux calculés une seule fois par matrice de rendements, réutilisés par toutes les stratégies qui les demandent
+class SignalCache:
+    def __init__(self, returns_matrix):
+        self.returns_matrix = returns_matrix
+        self.values = {}
+
+    def __getitem__(self, spec):
+        if spec not in self.values:
+            name, window = spec
+            self.values[spec] = signal_kinds[name][0](self.returns_matrix, window)
+        return self.values[spec]
+
+# Classe de base des stratégies
+class Strategy:
+    """
+    Stratégie associée à un profil de risque. Une sous-classe enregistrée par @register_strategy déclare :
+      risk_profile       profil de risque servi
+      parameters         paramètres par défaut (modifiables à l'instanciation)
+      vectorizable       True si decisions_from_signals calcule toutes les dates en une fois
+      sort_by_magnitude  décisions traitées par valeur absolue décroissante
+      apply_deal_limit   nombre de transactions limité chaque mois
+    Une stratégie vectorisable implémente signal_specs() et decisions_from_signals() ;
+    les autres implémentent decide(), évaluée date par date sur la fenêtre lookback().
+    """
+    risk_profile = None
+    parameters = {}
+    vectorizable = True
+    sort_by_magnitude = False
+    apply_deal_limit = False
+
+    def __init__(self, **parameters):
+        unknown = set(parameters) - set(self.parameters)
+        if unknown:
+            raise ValueError(f"Paramètres inconnus pour la stratégie {self.risk_profile} : {sorted(unknown)}")
+        self.params = {**self.parameters, **parameters}
+
+    # Signaux partagés nécessaires, sous forme de tuples (nom, fenêtre), par exemple ("momentum", 30)
+    def signal_specs(self):
+        return []
+
+    # Nombre de lignes d'historique nécessaires à la décision d'une date (None : tout l'historique)
+    def lookback(self):
+        if not self.vectorizable:
+            return None
+        # Le momentum compare la dernière valeur à celle d'il y a `window` lignes
+        return max((window + 1 if name == "momentum" else window for name, window in self.signal_specs()), default=1)
+
+    # Décisions pour toutes les lignes, à partir des signaux {spec: matrice dates x produits}
+    def decisions_from_signals(self, signals):
+        raise NotImplementedError
+
+    # Décisions à la dernière date de returns_data (index des dates, colonnes des tickers)
+    def decide(self, returns_data):
+        decisions = self.signals(returns_data.to_numpy())[-1] if len(returns_data) else []
+        return decisions_to_dict(list(returns_data.columns), decisions, self.sort_by_magnitude)
+
+    # Décisions pour toutes les lignes de la matrice (seulement aux lignes `rows` pour une stratégie non vectorisable)
+    def signals(self, returns_matrix, cache=None, rows=None):
+        if self.vectorizable:
+            cache = cache if cache is not None else SignalCache(returns_matrix)
+            return self.decisions_from_signals({spec: cache[spec] for spec in self.signal_specs()})
+        returns_data = pd.DataFrame(returns_matrix)
+        returns_values = returns_data.to_numpy()
+        decisions = np.full(returns_data.shape, np.nan)
+        for row in (range(len(returns_data)) if rows is None else rows):
+            if row < 0:
                 continue
+            start = lookback_start(returns_values, row, self.lookback())
+            row_decisions = self.decide(returns_data.iloc[start:row + 1])
+            decisions[row] = [row_decisions.get(column, np.nan) for column in returns_data.columns]
+        return decisions
+
+# Fonction pour convertir une ligne de décisions en dictionnaire ticker -> quantité entière
+def decisions_to_dict(tickers, decisions, sort_by_magnitude=False):
+    decisions = {ticker: int(qty) for ticker, qty in zip(tickers, decisions) if not np.isnan(qty)}
+    if sort_by_magnitude:
+        decisions = dict(sorted(decisions.items(), key=lambda x: abs(x[1]), reverse=True))
+    return decisions
+
+# Fonction pour trouver la première ligne de l'historique nécessaire au signal de la ligne `row`
+def lookback_start(returns_values, row, lookback, columns=None):
+    """
+    Retourner l'indice de la première ligne à charger pour décider à la ligne `row` avec une
+    fenêtre de `lookback` lignes (sur les colonnes `columns` seulement si fournies). Le momentum
+    reportant la dernière valeur connue (pct_change), la fenêtre est étendue vers le passé
+    jusqu'à ce que chaque produit y ait une valeur.
+    """
+    if lookback is None:
+        return 0
+    window_start = row - lookback + 1
+    start, size = max(window_start, 0), lookback
+
+    def has_gap(start):
+        block = returns_values[start:window_start + 1]
+        return np.isnan(block if columns is None else block[:, columns]).all(axis=0).any()
+
+    while start > 0 and has_gap(start):
+        start = max(window_start - size, 0)
+        size *= 2
+    return start
+
+# Stratégie pour les produits à faible risque
+@register_strategy
+class LowRiskStrategy(Strategy):
+    risk_profile = "low_risk"
+    parameters = {"volatility_target": 0.10, "volatility_window": 30, "momentum_window": 30}
+
+    def signal_specs(self):
+        return [("volatility", self.params["volatility_window"]), ("momentum", self.params["momentum_window"])]
 
-            named_decisions = {product_name_map.get(ticker, ticker): qty for ticker, qty in decisions.items()}
-            record_deals(named_decisions, date, wallet_id, database, apply_deal_limit)
+    def decisions_from_signals(self, signals):
+        decisions = _momentum_to_qty(signals[("momentum", self.params["momentum_window"])], 10)
+        # Acheter si la volatilité est sous la cible, vendre sinon (une volatilité NaN donne une vente)
+        volatility = signals[("volatility", self.params["volatility_window"])]
+        return np.where(volatility <= self.params["volatility_target"], decisions, -decisions)
+
+    def decide(self, returns_data):
+        return low_risk_strategy(returns_data, **self.params)
+
+# Stratégie pour les produits à faible turnover
+@register_strategy
+class LowTurnoverStrategy(Strategy):
+    risk_profile = "low_turnover"
+    parameters = {"momentum_window": 30, "max_deals_per_month": 2}
+    sort_by_magnitude = True
+    apply_deal_limit = True
+
+    def signal_specs(self):
+        return [("momentum", self.params["momentum_window"])]
+
+    def decisions_from_signals(self, signals):
+        return low_turnover_signals_from_momentum(signals[("momentum", self.params["momentum_window"])],
+                                                  self.params["max_deals_per_month"])
+
+    def decide(self, returns_data):
+        return low_turnover_strategy(returns_data, **self.params)
+
+# Stratégie pour les actions à haut rendement
+@register_strategy
+class HighYieldEquityStrategy(Strategy):
+    risk_profile = "high_yield_equity_only"
+    parameters = {"momentum_window": 10}
+
+    def signal_specs(self):
+        return [("momentum", self.params["momentum_window"])]
+
+    def decisions_from_signals(self, signals):
+        return _momentum_to_qty(signals[("momentum", self.params["momentum_window"])], 5)
+
+    def decide(self, returns_data):
+        return high_yield_equity_strategy(returns_data, list(returns_data.columns), **self.params)
+
+# Signaux et règles de transaction associés à chaque profil de risque
+def compute_backtest_signals(risk_profile, returns_matrix, cache=None, rows=None):
+    strategy = get_strategy(risk_profile)
+    if strategy is None:
+        return None, False, False
+    return strategy.signals(returns_matrix, cache, rows), strategy.sort_by_magnitude, strategy.apply_deal_limit
+
+# Fonction pour charger en une seule fois toutes les données nécessaires au backtest
+def load_backtest_data(database="project_database.db"):
+    returns_pivot = fetch_returns_from_db(database)
+    wallets = []
+    holdings = {}
+    deal_counts = {}
+    try:
+        with writer(database) as conn:
+            ensure_holdings_tables(conn)
+        cursor = reader(database).cursor()
+
+        cursor.execute("SELECT ticker, name FROM Products")
+        product_name_map = dict(cursor.fetchall())
+        cursor.execute("SELECT product_id, name FROM Products")
+        product_id_map = {name: product_id for product_id, name in cursor.fetchall()}
+
+        cursor.execute("SELECT wallet_id, risk_profile, products FROM Portfolios")
+        for wallet_id, risk_profile, products in cursor.fetchall():
+            cursor.execute("SELECT manager_id FROM Managers WHERE wallets_managed_id = ?", (wallet_id,))
+            manager_result = cursor.fetchone()
+            if not manager_result:
+                print(f"Aucun manager trouvé pour le portefeuille {wallet_id}")
+                continue
+
+            authorized_products_ids = json.loads(products)
+            cursor.execute("SELECT ticker FROM Products WHERE product_id IN ({})".format(
+                ','.join(map(str, authorized_products_ids))
+            ))
+            available_tickers = [row[0] for row in cursor.fetchall() if row[0] in returns_pivot.columns]
+            if not available_tickers:
+                continue
+
+            # Les transactions sont rattachées aux produits via leur nom, comme dans record_deals
+            product_ids = [product_id_map.get(product_name_map.get(ticker, ticker)) for ticker in available_tickers]
+            wallets.append({
+                'wallet_id': wallet_id,
+                'risk_profile': risk_profile,
+                'manager_id': manager_result[0],
+                'tickers': available_tickers,
+                'product_ids': product_ids,
+            })
+
+        # Positions et compteurs mensuels déjà présents en base
+        cursor.execute("SELECT wallet_id, product_id, qty FROM Holdings")
+        for wallet_id, product_id, qty in cursor.fetchall():
+            holdings.setdefault(wallet_id, {})[product_id] = qty
+        cursor.execute("SELECT wallet_id, month, deal_count FROM DealCounts")
+        for wallet_id, month, deal_count in cursor.fetchall():
+            deal_counts.setdefault(wallet_id, {})[month] = deal_count
     except sqlite3.Error as e:
         print(f"Erreur SQLite : {e}")
-    finally:
-        if conn:
-            conn.close()
 
-# Fonction pour exécuter les mises à jour hebdomadaires
-def run_weekly_updates(database="project_database.db"):
-    start_date = datetime(2023, 1, 1)
-    end_date = datetime(2024, 12, 31)
-    current_date = start_date
-
-    while current_date <= end_date:
-        if current_date.weekday() == 0:  # Mettre à jour les portefeuilles chaque lundi
-            update_portfolios(current_date.strftime('%Y-%m-%d'), database)
-        current_date += timedelta(days=1)
+    return returns_pivot, wallets, holdings, deal_counts
+
+# Simulation en mémoire des transactions d'un portefeuille sur toutes les dates de rebalancement
+def simulate_wallet_deals(wallet, decisions, rebalance_rows, rebalance_dates, holdings=None, deal_counts=None,
+                          max_deals_per_month=2):
+    holdings = holdings or {}
+    deal_counts = deal_counts or {}
+    product_ids = np.array([product_id or 0 for product_id in wallet['product_ids']])
+    positions = np.array([holdings.get(product_id, 0) for product_id in product_ids], dtype=float)
+
+    deals = []
+    current_month, month_count = None, 0
+    for row, date in zip(rebalance_rows, rebalance_dates):
+        if row < 0:
+            continue
+        row_decisions = decisions[row]
+        columns = np.flatnonzero(~np.isnan(row_decisions) & (product_ids > 0))
+        if wallet['sort_by_magnitude']:
+            columns = columns[np.argsort(-np.abs(row_decisions[columns]), kind='stable')]
+
+        # Quantité bornée à 100 en valeur absolue, ventes limitées à la position détenue
+        qty = np.clip(row_decisions[columns], -100, 100)
+        trades = np.where(qty > 0, qty, -np.minimum(-qty, positions[columns]))
+        traded = trades != 0
+        columns, trades = columns[traded], trades[traded]
+
+        if wallet['apply_deal_limit']:
+            if current_month != date[:7]:
+                # Les deals déjà en base pour ce mois comptent dans la limite
+                current_month = date[:7]
+                month_count = deal_counts.get(current_month, 0)
+            remaining = max(max_deals_per_month - month_count, 0)
+            columns, trades = columns[:remaining], trades[:remaining]
+            month_count += len(trades)
+
+        positions[columns] += trades
+        deals.extend(
+            (date, wallet['wallet_id'], wallet['manager_id'], int(product_ids[column]), int(trade))
+            for column, trade in zip(columns, trades)
+        )
+    return deals
+
+# Fonction pour écrire toutes les transactions du backtest dans une seule transaction SQLite
+def write_deals(deals, database="project_database.db"):
+    try:
+        insert_query = "INSERT INTO Deals (date, wallet_id, manager_id, product_id, qty) VALUES (?, ?, ?, ?, ?);"
+        # Transactions et positions sont validées ensemble par l'écrivain unique
+        with writer(database) as conn:
+            ensure_holdings_tables(conn)
+            cursor = conn.cursor()
+            cursor.executemany(insert_query, deals)
+            record_holdings(cursor, deals)
+        print(f"{len(deals)} transactions insérées dans la table Deals.")
+    except sqlite3.Error as e:
+        print(f"Erreur SQLite : {e}")
+
+# Fonction pour exécuter le backtest complet en une passe vectorisée
+@timed_phase("strategy")
+def run_backtest(start_date=datetime(2023, 1, 1), end_date=datetime(2024, 12, 31), database="project_database.db", write=True,
+                 frequency="weekly", calendar=None, trigger_threshold=None):
+    """
+    Rejouer les rebalancements de start_date à end_date en une passe vectorisée et écrire les
+    transactions (si write=True). Avec frequency="signal", un portefeuille n'est rebalancé que les
+    jours où l'une de ses décisions atteint trigger_threshold en valeur absolue.
+    """
+    returns_pivot, wallets, holdings, deal_counts = load_backtest_data(database)
+    if returns_pivot.empty or not wallets:
+        print("Aucune donnée disponible pour le backtest.")
+        return []
+
+    # Rebalancement (chaque lundi par défaut) sur la dernière ligne de rendements disponible à cette date
+    schedule = scheduler.rebalance_dates(start_date, end_date, frequency, calendar)
+    rebalance_rows = scheduler.schedule_rows(returns_pivot.index.values, schedule)
+    rebalance_dates = schedule.strftime('%Y-%m-%d')
+
+    valid_rows = rebalance_rows[rebalance_rows >= 0]
+    if not len(valid_rows):
+        return []
+    returns_values = returns_pivot.to_numpy()
+    last_row = valid_rows.max() + 1
+
+    # Signaux calculés une seule fois par univers de produits, fenêtre chargée et stratégie, puis partagés
+    # entre portefeuilles ; seules les lignes utiles à la stratégie sont extraites de l'historique
+    signal_caches = {}
+    decisions_cache = {}
+    deals_by_wallet = []
+    for wallet in wallets:
+        strategy = get_strategy(wallet['risk_profile'])
+        if strategy is None:
+            continue
+        columns = returns_pivot.columns.get_indexer(wallet['tickers'])
+        start = lookback_start(returns_values, valid_rows.min(), strategy.lookback(), columns)
+        matrix_key = (tuple(wallet['tickers']), start)
+        if matrix_key not in signal_caches:
+            signal_caches[matrix_key] = SignalCache(returns_pivot.iloc[start:last_row][wallet['tickers']])
+        cache = signal_caches[matrix_key]
+        decisions_key = matrix_key + (type(strategy), tuple(sorted(strategy.params.items())))
+        if decisions_key not in decisions_cache:
+            decisions_cache[decisions_key] = strategy.signals(cache.returns_matrix, cache, valid_rows - start)
+        wallet['sort_by_magnitude'] = strategy.sort_by_magnitude
+        wallet['apply_deal_limit'] = strategy.apply_deal_limit
+        wallet_rows = rebalance_rows - start
+        if frequency == "signal":
+            wallet_rows = scheduler.trigger_rows(decisions_cache[decisions_key], wallet_rows, trigger_threshold or 0)
+        deals_by_wallet.append(simulate_wallet_deals(
+            wallet, decisions_cache[decisions_key], wallet_rows, rebalance_dates,
+            holdings.get(wallet['wallet_id']), deal_counts.get(wallet['wallet_id']),
+            strategy.params.get("max_deals_per_month", 2)
+        ))
+
+    # Remise des transactions dans l'ordre chronologique puis par portefeuille, comme la boucle historique
+    deals = sorted((deal for wallet_deals in deals_by_wallet for deal in wallet_deals), key=lambda deal: deal[0])
+    if write:
+        write_deals(deals, database)
+    return deals
 
 # Exécuter les mises à jour hebdomadaires
 if __name__ == '__main__':
@@ -0,0 +1,212 @@
+import sqlite3
+import sys
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from faker import Faker
+import base_builder as bb
+from connections import connect, timed_phase
+
+# Générateur de bases synthétiques de grande taille (tests de charge et benchmarks).
+# Toutes les tirages aléatoires dérivent d'une graine unique via np.random.SeedSequence :
+# une même configuration produit la même base, quel que soit le nombre de processus.
+
+# Période simulée par défaut (plusieurs années d'historique)
+start_date_synthetic = "2020-01-01"
+end_date_synthetic = "2024-12-31"
+
+# Volatilité quotidienne et rendement moyen des rendements simulés, par profil de risque
+returns_parameters = {
+    "low_risk": (0.0001, 0.004),
+    "low_turnover": (0.0003, 0.010),
+    "high_yield_equity_only": (0.0005, 0.018),
+}
+
+# Nombre de clients générés par tâche parallèle
+clients_chunk_size = 100000
+
+# Fonction pour créer toutes les tables et appliquer les migrations
+def create_schema(database):
+    bb.create_table(bb.create_clients_query, "clients", database)
+    bb.create_table(bb.create_products_query, "produits", database)
+    bb.create_table(bb.create_wallet_query, "portfolios", database)
+    bb.create_table(bb.create_managers_query, "managers", database)
+    bb.create_table(bb.create_deals_query, "deals", database)
+    bb.create_table(bb.create_returns_query, "returns", database)
+    bb.migrate(database)
+
+# Nombre de valeurs Faker tirées par champ et par lot : les clients sont ensuite composés par
+# tirage dans ces réserves, Faker étant trop lent (environ 0,5 ms par client) pour des millions de lignes
+faker_pool_size = 2000
+
+# Fonction pour générer un lot de clients fictifs (exécutée dans un processus séparé)
+def generate_client_chunk(task):
+    count, risk_profiles, seed = task
+    rng = np.random.default_rng(seed)
+    fake = Faker()
+    fake.seed_instance(int(rng.integers(2**31)))
+    pool_size = min(count, faker_pool_size)
+    last_names = np.array([fake.last_name() for _ in range(pool_size)])
+    first_names = np.array([fake.first_name() for _ in range(pool_size)])
+    addresses = np.array([fake.address().replace("\n", ", ") for _ in range(pool_size)])
+    phone_numbers = np.array([fake.phone_number() for _ in range(pool_size)])
+    emails = np.array([fake.email() for _ in range(pool_size)])
+
+    # Dates tirées uniformément : naissance entre 18 et 80 ans, entrée sur la période simulée
+    today = np.datetime64('today', 'D')
+    birth_dates = today - rng.integers(18 * 365, 80 * 365, count).astype('timedelta64[D]')
+    entry_start = np.datetime64(start_date_synthetic, 'D')
+    entry_span = (np.datetime64(end_date_synthetic, 'D') - entry_start).astype(int) + 1
+    entry_dates = entry_start + rng.integers(0, entry_span, count).astype('timedelta64[D]')
+
+    return list(zip(
+        last_names[rng.integers(0, pool_size, count)].tolist(),
+        first_names[rng.integers(0, pool_size, count)].tolist(),
+        birth_dates.astype(str).tolist(),
+        addresses[rng.integers(0, pool_size, count)].tolist(),
+        phone_numbers[rng.integers(0, pool_size, count)].tolist(),
+        emails[rng.integers(0, pool_size, count)].tolist(),
+        entry_dates.astype(str).tolist(),
+        rng.choice(risk_profiles, count).tolist(),
+    ))
+
+# Fonction pour générer l'historique de transactions d'un portefeuille (exécutée dans un processus séparé)
+def generate_wallet_deals(task):
+    """
+    Tirer un historique réaliste : les dates suivent un processus de Poisson sur les jours ouvrés,
+    les ventes ne dépassent jamais la position détenue et les quantités restent entre 1 et 100.
+    Retourne une liste de tuples (date, wallet_id, manager_id, product_id, qty).
+    """
+    wallet_id, manager_id, product_ids, start_date, end_date, deals_per_month, sell_ratio, seed = task
+    rng = np.random.default_rng(seed)
+    business_days = pd.bdate_range(start_date, end_date).strftime('%Y-%m-%d')
+
+    deal_count = rng.poisson(deals_per_month * 12 / 252 * len(business_days))
+    day_index = np.sort(rng.integers(0, len(business_days), deal_count))
+    products = rng.choice(product_ids, deal_count)
+    quantities = rng.integers(1, 101, deal_count)
+    sells = rng.random(deal_count) < sell_ratio
+
+    positions = {}
+    deals = []
+    for day, product_id, qty, sell in zip(day_index.tolist(), products.tolist(), quantities.tolist(), sells.tolist()):
+        position = positions.get(product_id, 0)
+        if sell:
+            qty = -min(qty, position)
+            if qty == 0:
+                continue
+        positions[product_id] = position + qty
+        deals.append((business_days[day], wallet_id, manager_id, product_id, qty))
+    return deals
+
+# Fonction pour simuler des rendements quotidiens (loi de Student, queues épaisses) pour chaque produit
+def generate_returns(dict_prod, dict_risk_profile, start_date, end_date, seed):
+    business_days = pd.bdate_range(start_date, end_date)
+    product_seeds = np.random.SeedSequence(seed).spawn(len(dict_prod))
+    returns_data = {}
+    for (ticker, name), product_seed in zip(dict_prod.items(), product_seeds):
+        mean, volatility = returns_parameters[dict_risk_profile[ticker]]
+        rng = np.random.default_rng(product_seed)
+        # Une loi de Student à 4 degrés de liberté a une variance de 2 : on la ramène à 1
+        returns_data[name] = mean + volatility * rng.standard_t(4, len(business_days)) / np.sqrt(2)
+    return pd.DataFrame(returns_data, index=business_days)
+
+# Fonction principale pour construire une base synthétique
+@timed_phase("seeding")
+def build_synthetic_database(database, n_clients=1000, wallets_per_profile=10, deals_per_month=20,
+                             start_date=start_date_synthetic, end_date=end_date_synthetic, sell_ratio=0.4,
+                             seed=42, max_workers=None, wallet_prefix="Synthetic",
+                             dict_prod=bb.dict_products, dict_risk_profile=bb.dict_risk_type):
+    """
+    Peupler une base avec n_clients clients, wallets_per_profile portefeuilles par profil de risque
+    (un gestionnaire par portefeuille), un historique de transactions de start_date à end_date
+    et des rendements simulés. Le volume de transactions est d'environ
+    3 * wallets_per_profile * deals_per_month * nombre de mois (200 portefeuilles à 100 transactions
+    par mois sur cinq ans donnent 1,2e6 transactions).
+
+    La génération est répartie sur max_workers processus ; le chargement se fait en une seule
+    transaction, les transactions étant insérées au fur et à mesure de leur génération.
+    Retourne le nombre de lignes insérées par table.
+    """
+    create_schema(database)
+    clients_seed, managers_seed, deals_seed, returns_seed = np.random.SeedSequence(seed).spawn(4)
+    risk_profiles = sorted(set(dict_risk_profile.values()))
+
+    try:
+        conn = connect(database)
+        cursor = conn.cursor()
+
+        # Produits : l'univers de base_builder, inséré seulement si la table est vide
+        cursor.execute("SELECT COUNT(*) FROM Products")
+        products = []
+        if cursor.fetchone()[0] == 0:
+            products = [bb.Products(ticker, dict_risk_profile[ticker], name) for ticker, name in dict_prod.items()]
+
+        # Portefeuilles : tous les produits du profil, comme populate_wallets
+        if bb.bulk_to_base(products=products, conn=conn) is None:
+            raise sqlite3.Error("chargement interrompu")
+        cursor.execute("SELECT product_risk_profile, product_id FROM Products")
+        product_ids_by_profile = {}
+        for risk_profile, product_id in cursor.fetchall():
+            product_ids_by_profile.setdefault(risk_profile, []).append(product_id)
+        cursor.execute("SELECT COUNT(*) FROM Portfolios")
+        first_wallet = cursor.fetchone()[0] + 1
+        wallets = [bb.Wallet(f"{wallet_prefix}_{risk_profile}_{first_wallet + k:05d}", risk_profile,
+                             product_ids_by_profile.get(risk_profile, []))
+                   for risk_profile in risk_profiles for k in range(wallets_per_profile)]
+        if bb.bulk_to_base(wallets=wallets, conn=conn) is None:
+            raise sqlite3.Error("chargement interrompu")
+        cursor.execute("SELECT wallet_name, wallet_id FROM Portfolios")
+        wallet_ids = dict(cursor.fetchall())
+
+        # Un gestionnaire par portefeuille
+        fake = Faker()
+        fake.seed_instance(int(managers_seed.generate_state(1)[0]))
+        managers = [bb.Manager(fake.name(), fake.email(), wallet_ids[wallet.wallet_name]) for wallet in wallets]
+        if bb.bulk_to_base(managers=managers, conn=conn) is None:
+            raise sqlite3.Error("chargement interrompu")
+        cursor.execute("SELECT wallets_managed_id, manager_id FROM Managers")
+        manager_ids = dict(cursor.fetchall())
+
+        # Clients et transactions générés en parallèle, une graine par tâche
+        client_counts = [min(clients_chunk_size, n_clients - start) for start in range(0, n_clients, clients_chunk_size)]
+        client_tasks = [(count, risk_profiles, chunk_seed)
+                        for count, chunk_seed in zip(client_counts, clients_seed.spawn(len(client_counts)))]
+        deal_tasks = [(wallet_ids[wallet.wallet_name], manager_ids[wallet_ids[wallet.wallet_name]], wallet.products,
+                       start_date, end_date, deals_per_month, sell_ratio, wallet_seed)
+                      for wallet, wallet_seed in zip(wallets, deals_seed.spawn(len(wallets))) if wallet.products]
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            clients = (bb.Client(*row) for chunk in executor.map(generate_client_chunk, client_tasks) for row in chunk)
+            deals = (bb.Deal(*row) for wallet_deals in executor.map(generate_wallet_deals, deal_tasks)
+                     for row in wallet_deals)
+            inserted = bb.bulk_to_base(clients=clients, deals=deals, conn=conn)
+        if inserted is None:
+            raise sqlite3.Error("chargement interrompu")
+        conn.commit()
+        inserted.update({"Products": len(products), "Portfolios": len(wallets), "Managers": len(managers)})
+
+    except sqlite3.Error as e:
+        conn.rollback()
+        print(f"Erreur SQLite : {e}")
+        return None
+
+    finally:
+        if conn:
+            conn.close()
+
+    # Rendements simulés, insérés avec le chargement en masse de base_builder
+    returns_df = generate_returns(dict_prod, dict_risk_profile, start_date, end_date,
+                                  int(returns_seed.generate_state(1)[0]))
+    bb.populate_returns_table(bb.fetch_product_ids(database), bb.fetch_product_name(database), returns_df, database)
+    print(f"Base synthétique {database} générée : {inserted}")
+    return inserted
+
+if __name__ == "__main__":
+    # Exemple : python synthetic_data.py load_test.db 100000 100 100
+    build_synthetic_database(
+        sys.argv[1] if len(sys.argv) > 1 else "synthetic_database.db",
+        n_clients=int(sys.argv[2]) if len(sys.argv) > 2 else 1000,
+        wallets_per_profile=int(sys.argv[3]) if len(sys.argv) > 3 else 10,
+        deals_per_month=int(sys.argv[4]) if len(sys.argv) > 4 else 20,
+    )
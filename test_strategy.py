@@ -0,0 +1,43 @@
+import os
+import shutil
+import sqlite3
+import pytest
+import strategy
+
+# Test de non-régression du moteur de backtest : le moteur vectorisé (run_backtest) doit produire
+# exactement les mêmes deals que la boucle historique (update_portfolios date par date), sur la
+# base livrée dont la table Deals a été vidée. Lancer "python -m pytest" dans ce répertoire.
+
+shipped_database = os.path.join(os.path.dirname(os.path.abspath(__file__)), "project_database.db")
+
+# Fonction pour copier la base livrée sans ses deals (ni les positions qui en découlent)
+def _empty_deals_copy(tmp_path, name):
+    database = str(tmp_path / name)
+    shutil.copyfile(shipped_database, database)
+    conn = sqlite3.connect(database)
+    conn.execute("DELETE FROM Deals")
+    for table in ("Holdings", "DealCounts"):
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone():
+            conn.execute(f"DELETE FROM {table}")
+    conn.commit()
+    conn.close()
+    return database
+
+def _deals(database):
+    conn = sqlite3.connect(database)
+    try:
+        return sorted(conn.execute("SELECT date, wallet_id, manager_id, product_id, qty FROM Deals").fetchall())
+    finally:
+        conn.close()
+
+@pytest.mark.skipif(not os.path.exists(shipped_database), reason="base livrée absente")
+def test_vectorized_backtest_matches_weekly_loop(tmp_path):
+    vectorized_database = _empty_deals_copy(tmp_path, "vectorized.db")
+    loop_database = _empty_deals_copy(tmp_path, "loop.db")
+
+    strategy.run_weekly_updates(vectorized_database, vectorized=True)
+    strategy.run_weekly_updates(loop_database, vectorized=False)
+
+    vectorized_deals = _deals(vectorized_database)
+    assert vectorized_deals
+    assert vectorized_deals == _deals(loop_database)
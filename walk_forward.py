@@ -0,0 +1,113 @@
+import argparse
+import numpy as np
+import pandas as pd
+import parameter_sweep as ps
+import scheduler
+import strategy
+from connections import timed_phase
+
+# Backtest walk-forward : sur chaque fenêtre glissante, les paramètres d'une stratégie sont choisis
+# sur la période d'apprentissage puis évalués hors échantillon sur la période de test qui suit.
+# Chaque configuration est simulée une seule fois sur toute la période à partir de la matrice des
+# rendements en mémoire (signaux partagés entre configurations) ; les métriques d'une fenêtre sont
+# celles de cette simulation restreinte à la fenêtre. 20 fenêtres coûtent donc à peu près une passe
+# complète. Rien n'est écrit en base.
+
+# Fonction pour choisir la meilleure configuration selon une métrique (None si aucune n'est évaluable)
+def _best_configuration(results, rank_by):
+    scores = np.array([result.get(rank_by, np.nan) for result in results], dtype=float)
+    if np.isnan(scores).all():
+        return None
+    return int(np.nanargmin(scores) if rank_by in ps.lower_is_better else np.nanargmax(scores))
+
+# Fonction principale : walk-forward d'un profil de risque sur une grille de paramètres
+@timed_phase("strategy")
+def run_walk_forward(database="project_database.db", risk_profile="low_risk", grid=None, train_size=252, test_size=63,
+                     step=None, anchored=False, start_date=None, end_date=None, frequency="weekly", calendar=None,
+                     trigger_threshold=None, rank_by="sharpe_ratio"):
+    """
+    Découper le calendrier (celui des rendements par défaut) en fenêtres de train_size jours
+    d'apprentissage et test_size jours de test (voir scheduler.walk_forward_windows), choisir sur
+    chaque apprentissage la configuration de `grid` (ps.default_grids du profil par défaut) qui
+    maximise `rank_by` (ou la minimise pour volatilité, drawdown et turnover), puis l'évaluer sur
+    le test. Retourne le tableau des fenêtres (paramètres retenus, score d'apprentissage,
+    métriques de test) et la série des retours hors échantillon mis bout à bout.
+    """
+    returns_matrix = strategy.fetch_returns_from_db(database)
+    if returns_matrix.empty:
+        print("Aucune donnée disponible pour le walk-forward.")
+        return pd.DataFrame(), pd.Series(dtype=float)
+    tickers = list(returns_matrix.columns)
+    universe = ps.get_profile_universes(database, tickers).get(risk_profile)
+    if not universe:
+        print(f"Aucun produit disponible pour le profil {risk_profile}.")
+        return pd.DataFrame(), pd.Series(dtype=float)
+    columns = [tickers.index(ticker) for ticker in universe]
+    values, dates = returns_matrix.to_numpy(), returns_matrix.index.values
+
+    windows = scheduler.walk_forward_windows(returns_matrix.index if calendar is None else calendar,
+                                             train_size, test_size, step, anchored, start_date, end_date)
+    if not windows:
+        print("Historique trop court pour une fenêtre d'apprentissage et de test.")
+        return pd.DataFrame(), pd.Series(dtype=float)
+
+    # Rebalancements de toute la période, découpés ensuite par fenêtre
+    schedule = scheduler.rebalance_dates(windows[0][0], windows[-1][3], frequency, calendar)
+    rebalance_rows = scheduler.schedule_rows(dates, schedule)
+    rebalance_dates = schedule.strftime('%Y-%m-%d')
+    threshold = trigger_threshold if frequency == "signal" else None
+
+    # Décisions de chaque configuration calculées une seule fois, signaux partagés entre configurations
+    configurations = [parameters for _, parameters in
+                      ps.build_configurations({risk_profile: grid or ps.default_grids.get(risk_profile, {})})]
+    strategies = [strategy.get_strategy(risk_profile, **parameters) for parameters in configurations]
+    if strategies and strategies[0] is None:
+        raise ValueError(f"Aucune stratégie enregistrée pour le profil '{risk_profile}'")
+    universe_returns = returns_matrix[universe]
+    cache = strategy.SignalCache(universe_returns)
+    decisions = [selected_strategy.signals(universe_returns, cache, rebalance_rows) for selected_strategy in strategies]
+
+    # Une simulation par configuration sur toute la période : tableaux quotidiens (dates x configurations)
+    daily = [ps.simulate_portfolio(selected_strategy, configuration_decisions, 0, values, dates, columns,
+                                   rebalance_rows, rebalance_dates, windows[0][0], windows[-1][3], threshold)
+             for selected_strategy, configuration_decisions in zip(strategies, decisions)]
+    simulated = {name: pd.concat([frame[name] for frame in daily], axis=1, keys=range(len(daily)))
+                 for name in ('return', 'position', 'traded', 'deals')}
+
+    records = []
+    out_of_sample = []
+    for number, (train_start, train_end, test_start, test_end) in enumerate(windows, start=1):
+        train_metrics = ps.summarize_portfolios(*(frame.loc[train_start:train_end] for frame in simulated.values()))
+        best = _best_configuration(train_metrics.to_dict('records'), rank_by)
+        record = {"window": number, "train_start": train_start, "train_end": train_end,
+                  "test_start": test_start, "test_end": test_end}
+        if best is not None:
+            test_metrics = ps.summarize_portfolios(*(frame.loc[test_start:test_end, [best]] for frame in simulated.values()))
+            record.update(configurations[best])
+            record[f"train_{rank_by}"] = train_metrics[rank_by].iloc[best]
+            record.update({f"test_{name}": value for name, value in test_metrics.to_dict('records')[0].items()})
+            out_of_sample.append(simulated['return'].loc[test_start:test_end, best])
+        records.append(record)
+
+    oos_returns = pd.concat(out_of_sample) if out_of_sample else pd.Series(dtype=float)
+    # Fenêtres de test qui se chevauchent (step < test_size) : la première évaluation de chaque date est gardée
+    oos_returns = oos_returns[~oos_returns.index.duplicated()].rename("return")
+    return pd.DataFrame(records), oos_returns
+
+if __name__ == "__main__":
+    # Exemple : python walk_forward.py project_database.db low_risk --train 252 --test 63 --frequency monthly
+    parser = argparse.ArgumentParser(description="Backtest walk-forward d'une stratégie (sans écriture en base)")
+    parser.add_argument("database", nargs="?", default="project_database.db")
+    parser.add_argument("risk_profile", nargs="?", default="low_risk")
+    parser.add_argument("--train", type=int, default=252)
+    parser.add_argument("--test", type=int, default=63)
+    parser.add_argument("--step", type=int, default=None)
+    parser.add_argument("--anchored", action="store_true")
+    parser.add_argument("--frequency", default="weekly", choices=list(scheduler.frequencies))
+    parser.add_argument("--trigger", type=float, default=None)
+    parser.add_argument("--rank-by", default="sharpe_ratio")
+    args = parser.parse_args()
+    windows, returns = run_walk_forward(args.database, args.risk_profile, None, args.train, args.test, args.step,
+                                        args.anchored, frequency=args.frequency, trigger_threshold=args.trigger,
+                                        rank_by=args.rank_by)
+    print(windows.to_string())